@@ -7,7 +7,17 @@ This module documents a URL download process
 
 # --Standard lib modules------------------------------------------------------
 from datetime import datetime
+import tempfile
 import logging
+import mmap
+import io
+import os
+
+try:
+    # Memory maps do not support memoryview before Python 3.
+    _map_view = buffer  # Python 2
+except NameError:
+    _map_view = memoryview
 
 
 # ----------------------------------------------------------------------------
@@ -19,7 +29,18 @@ class Document(object):
     url = None
     local_path = None
     transfer_time = None
+    transfer_duration = None
     length = None
+    # Holder of a reference on a copy kept by a document cache.
+    cache_ref = None
+    # False when local_path is an original file, which cleanup must keep.
+    owned = True
+    # Content of documents kept in memory rather than in a local file.
+    data = None
+    # Hexadecimal SHA-256 digest of the content, when computed while
+    # downloading.
+    sha256 = None
+    _map = None
 
     def __init__(self, url=None, path=None):
         """
@@ -35,6 +56,104 @@ class Document(object):
         self.local_path = path
         self.transfer_time = datetime.now()
 
+    def throughput(self):
+        """
+        :returns: Transfer rate of the last upload or download in bytes per
+                  second, or None if unknown.
+        """
+        if not self.length or not self.transfer_duration:
+            return None
+        return self.length / self.transfer_duration
+
+    @property
+    def in_memory(self):
+        """
+        True if the content is kept in memory (data) rather than in a local
+        file.
+        """
+        return self.data is not None and self.local_path is None
+
+    def view(self):
+        """
+        Zero-copy access to the content.
+
+        :returns: Read-only memoryview of the content (a buffer for a local
+                  copy on Python 2). The local copy is mapped in memory on
+                  first use and unmapped by :py:meth:`close`.
+        """
+        if self.data is not None:
+            return memoryview(self.data)
+        if self._map is None:
+            if not os.path.getsize(self.local_path):
+                return memoryview(b'')
+            self._map = self.mmap()
+        return _map_view(self._map)
+
+    def mmap(self):
+        """
+        :returns: Read-only memory map of the local copy, to be closed by the
+                  caller. The document must not be empty.
+        """
+        with open(self.local_path, 'rb') as file_handle:
+            return mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def size(self):
+        """
+        :returns: Size of the content in bytes.
+        """
+        if self.in_memory:
+            return len(self.data)
+        return os.path.getsize(self.local_path)
+
+    def filename(self):
+        """
+        :returns: Name of the local copy, or of the source document for
+                  documents kept in memory.
+        """
+        path = self.local_path or (self.url or '').split('?')[0]
+        return os.path.basename(path.rstrip('/')) or 'document'
+
+    def open(self):
+        """
+        :returns: Binary file object reading the content.
+        """
+        if self.in_memory:
+            return io.BytesIO(self.data)
+        return open(self.local_path, 'rb')
+
+    def to_file(self):
+        """
+        Write the content of a document kept in memory to a local file, for
+        tools which need a path. The content is then only kept in the file.
+
+        :returns: The local path of the document.
+        """
+        if self.in_memory:
+            # RemoteAccess imports this module.
+            from .RemoteAccess import temp_prefix
+            handle, path = tempfile.mkstemp(
+                prefix=temp_prefix(),
+                suffix=os.path.splitext(self.url or '')[-1])
+            with os.fdopen(handle, 'wb') as file_handle:
+                file_handle.write(self.data)
+            self.local_path = path
+            self.owned = True
+            self.data = None
+        return self.local_path
+
+    def close(self):
+        """
+        Release the memory map of the local copy, once the views obtained
+        from :py:meth:`view` are released.
+        """
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Views still in use : unmapped once they are collected.
+                self.logger.debug("Views of %s are still in use", self.url)
+            self._map = None
+
     def __repr__(self):
         """
         Printable representation
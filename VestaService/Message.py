@@ -12,6 +12,8 @@ from datetime import datetime
 
 # -- Configuration ------------------------------------------------------------
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# Header of a task message which can carry the URL notified of its completion.
+CALLBACK_HEADER = 'callback_url'
 
 
 def mk_timestamp():
@@ -7,155 +7,874 @@ services working on a AMQP.
 """
 
 # --Standard lib modules------------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
 from logging import getLogger
+import threading
+import tempfile
+import hashlib
+import socket
+import io
+import time
+import re
 import os
-import shutil
+
+try:
+    from urllib.parse import urlsplit, unquote
+    from urllib.request import url2pathname
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+    from urllib import unquote, url2pathname
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 # --3rd party modules----------------------------------------------------------
 import requests
 
 # --Project specific----------------------------------------------------------
-from .service_exceptions import (DownloadError, UploadError)
+from .service_exceptions import (DownloadError, UploadError,
+                                 CircuitOpenError)
+from .retry import RetryPolicy
 from .Document import Document
+from . import document_cache
+from . import http_session
+from . import metrics
 
 TIMEOUT = 10
 MAX_TRY = 5
+# Instance of document_cache.DocumentCache used by default by download.
+DOCUMENT_CACHE = None
+# Retry policy of the requests sent by this module.
+RETRY_POLICY = RetryPolicy(max_try=MAX_TRY)
+# Size of the blocks read from the network.
+CHUNK_SIZE = 1024 * 1024
+# Documents smaller than this are never split into parallel ranges.
+MIN_PARALLEL_SIZE = 8 * 1024 * 1024
+# Prefix of the local copies, followed by a token of the host (and boot) and
+# by the id of the process which owns them so that sweep_orphans can
+# recognize those left by dead processes of the same host.
+TEMP_PREFIX = 'vesta-'
+# Local copies younger than this (in seconds) are never swept. Those of live
+# processes are never swept whatever their age : the modification time of a
+# hard link is the one of its (possibly old) source.
+SWEEP_MIN_AGE = 600.
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+# How documents read in place refer to their file (see link_local).
+LOCAL_LINK = 'path'
+# Directory of the links to documents read in place (defaults to the
+# temporary directory).
+LINK_DIR = None
+# Local directories of shared mounts keyed by URL prefix (see register_mount).
+SHARED_MOUNTS = {}
+# Local directories from which file:// URLs are read (see
+# register_local_dir). Other file:// URLs are refused.
+LOCAL_DIRS = []
+# Documents up to this size in bytes are kept in memory by default (0 : never).
+IN_MEMORY_MAX = 0
+# ioctl cloning a file (Linux).
+FICLONE = 0x40049409
+
+_HOST_TOKEN = None
 
 
-def download(doc_msg, timeout=TIMEOUT, max_try=MAX_TRY):
+def download(doc_msg, timeout=TIMEOUT, max_try=MAX_TRY, cache=None,
+             ranged=False, nb_parallel=1, progress_callback=None,
+             in_memory_max=None):
     """
     Download a given document to a local file.
     The calling function is responsible for the resulting file.
 
+    The document is obtained by the handler registered for the scheme of its
+    URL (see :py:func:`register_scheme`). URLs under a shared mount (see
+    :py:func:`register_mount`) and file:// URLs (under a directory declared
+    with :py:func:`register_local_dir`) are not copied : the
+    resulting document refers to the original file (or a link to it).
+
     :param doc_msg: Dictionary containing the following keys:
 
        :url: path to a distant document
     :param timeout: Request timeout in seconds
     :param max_try: Maximal number of tries
+    :param cache: Instance of :py:class:`~.document_cache.DocumentCache`
+                  through which the document is obtained. Defaults to
+                  DOCUMENT_CACHE.
+    :param ranged: Use HTTP Range requests when the server accepts them, so
+                   that an interrupted transfer resumes from the last byte
+                   written instead of starting over.
+    :param nb_parallel: In ranged mode, number of ranges fetched in parallel
+                        into a preallocated file.
+    :param progress_callback: Function called with the number of bytes
+                              received so far and the total number of bytes
+                              (None if unknown) as the download progresses.
+    :param in_memory_max: Documents up to this size in bytes are kept in
+                          memory (Document.data) rather than written to a
+                          local file. Defaults to IN_MEMORY_MAX.
     :returns: object of type Document.
     """
+    url = doc_msg['url']
+    start = time.time()
+    local_path = _mounted_path(url)
+    if local_path is not None:
+        doc = link_local(url, local_path,
+                         progress_callback=progress_callback)
+    else:
+        scheme = urlsplit(url).scheme.lower()
+        handler = SCHEME_HANDLERS.get(scheme)
+        if handler is None:
+            raise DownloadError("No handler for the scheme of URL {}"
+                                .format(url))
+        doc = handler(doc_msg, timeout=timeout, max_try=max_try, cache=cache,
+                      ranged=ranged, nb_parallel=nb_parallel,
+                      progress_callback=progress_callback,
+                      in_memory_max=in_memory_max)
+    metrics.observe(metrics.STAGE_SECONDS, time.time() - start,
+                    stage='download')
+    if doc.owned and doc.length:
+        metrics.inc(metrics.BYTES, doc.length, direction='download')
+    return doc
+
+
+def register_scheme(scheme, handler):
+    """
+    Register the handler downloading the documents of a URL scheme.
+
+    :param scheme: URL scheme (e.g. 's3').
+    :param handler: Function called with the document message and the
+                    keyword arguments of :py:func:`download` (handlers ignore
+                    those which do not apply), returning a
+                    :py:class:`~.Document.Document`.
+    """
+    SCHEME_HANDLERS[scheme.lower()] = handler
+
+
+def register_mount(url_prefix, local_dir):
+    """
+    Declare a shared file system (NFS, CephFS, ...) mounted on the worker,
+    from which the documents of URLs starting with a given prefix are read
+    in place.
+
+    :param url_prefix: Prefix of the URLs of the shared documents
+                       (e.g. 'http://storage/data/').
+    :param local_dir: Directory where the prefix is mounted
+                      (e.g. '/mnt/data/').
+    """
+    SHARED_MOUNTS[url_prefix] = local_dir
+
+
+def register_local_dir(local_dir):
+    """
+    Allow the documents of file:// URLs under a local directory to be read,
+    since requests could otherwise read any file of the worker.
+
+    :param local_dir: Directory of the documents (e.g. '/mnt/data/').
+    """
+    LOCAL_DIRS.append(local_dir)
+
+
+def download_http(doc_msg, timeout=TIMEOUT, max_try=MAX_TRY, cache=None,
+                  ranged=False, nb_parallel=1, progress_callback=None,
+                  in_memory_max=None, **options):
+    """
+    Handler of the http and https schemes, see :py:func:`download`.
+    """
     logger = getLogger(__name__)
     url = doc_msg['url']
     logger.info("Getting remote document at %s", url)
     extension = os.path.splitext(url)[-1]
-    cur_try = 1
-    response = None
+    cache = cache or DOCUMENT_CACHE
+    entry = cache.lookup(url) if cache else None
+    headers = entry.conditional_headers() if entry else None
+    valid_codes = [200, 201, 304] if entry else [200, 201]
+    if ranged:
+        # Byte ranges must refer to the bytes written to disk.
+        headers = dict(headers or {}, **{'Accept-Encoding': 'identity'})
+    policy = RETRY_POLICY.with_max_try(max_try)
 
-    while cur_try <= max_try and response is None:
+    try:
         try:
             # shutil.copyfileobj doesn't work well if stream=False
-            response = requests.get(url, timeout=timeout, stream=True)
-            if response.status_code not in [200, 201]:
-                logger.error(("Could not download document at URL {}."
-                              " Response code from the server : {}")
-                             .format(url, response.status_code))
-                raise DownloadError(("Could not download document at URL {}. "
-                                     "Response code from the server : {}")
-                                    .format(url, response.status_code))
-        except requests.Timeout as error:
-            # Handle timeout error separately
-            if cur_try < max_try:
-                cur_try += 1
-                logger.warning("Timeout occurred while downloading document "
-                               "%s. Retry (%s/%s)", url, cur_try, max_try)
-            else:
-                logger.error("Could not download document %s", url)
-                raise DownloadError(error)
-        except requests.exceptions.RequestException as error:
+            response = policy.call(http_session.get_session(url).get, url,
+                                   headers=headers, timeout=timeout,
+                                   stream=True)
+        except (requests.exceptions.RequestException,
+                CircuitOpenError) as error:
             logger.error("Could not download document %s", url)
             raise DownloadError(error)
+        if response.status_code not in valid_codes:
+            response.close()
+            logger.error(("Could not download document at URL {}."
+                          " Response code from the server : {}")
+                         .format(url, response.status_code))
+            raise DownloadError(("Could not download document at URL {}. "
+                                 "Response code from the server : {}")
+                                .format(url, response.status_code))
+    except DownloadError:
+        if entry:
+            cache.discard(entry)
+        raise
+
+    if entry:
+        if response.status_code == 304:
+            response.close()
+            doc = cache.validated(entry)
+            doc.length = os.path.getsize(doc.local_path)
+            return doc
+        cache.discard(entry)
+
+    start = time.time()
+    total = int(response.headers.get('Content-Length', 0)) or None
+    progress = _Progress(total, progress_callback)
+    can_range = (ranged and total and
+                 response.headers.get('Accept-Ranges') == 'bytes')
+    # Make sure the ranges still refer to the same version of the document.
+    validator = (response.headers.get('ETag') or
+                 response.headers.get('Last-Modified'))
+
+    if in_memory_max is None:
+        in_memory_max = IN_MEMORY_MAX
+    if in_memory_max and not cache and not can_range and \
+            (total or 0) <= in_memory_max:
+        try:
+            data, path = _spooled_copy(response, extension, in_memory_max,
+                                       progress)
+        finally:
+            response.close()
+        doc = Document(url=url, path=path)
+        doc.data = data
+    else:
+        doc = _download_to_file(response, url, extension, cache, total,
+                                can_range, nb_parallel, validator, timeout,
+                                policy, progress)
+    doc.length = progress.done
+    doc.sha256 = progress.hexdigest()
+    doc.transfer_duration = time.time() - start
+    logger.info("Download of URL %s complete", doc.url)
+    logger.debug("Local copy name is : %s", doc.local_path)
+    return doc
+
+
+def _download_to_file(response, url, extension, cache, total, can_range,
+                      nb_parallel, validator, timeout, policy, progress):
+    """
+    Write the body of a response to a local file.
 
+    :returns: object of type Document.
+    """
     with NamedTemporaryFile(mode='w+b',
+                            prefix=temp_prefix(),
                             suffix=extension,
+                            dir=cache.cache_dir if cache else None,
                             delete=False) as destination:
-        response.raw.decode_content = True
-        shutil.copyfileobj(response.raw, destination)
+        try:
+            if can_range and nb_parallel > 1 and total >= MIN_PARALLEL_SIZE:
+                response.close()
+                destination.truncate(total)
+                destination.flush()
+                # Ranges are received out of order : no digest.
+                progress.digest = None
+                _parallel_download(url, destination.name, total, nb_parallel,
+                                   validator, timeout, policy, progress)
+            elif can_range:
+                _resumable_copy(response, destination, url, total,
+                                validator, timeout, policy, progress)
+            else:
+                _copy_response(response, destination, progress)
+        except BaseException:
+            response.close()
+            destination.close()
+            os.remove(destination.name)
+            raise
+    # Hand the connection back to the pool of the session.
+    response.close()
+    if cache:
+        return cache.store(url, destination.name, response.headers)
+    return Document(url=url, path=destination.name)
+
+
+def _spooled_copy(response, extension, max_size, progress):
+    """
+    Read a streamed response body in memory, spooling it to a local file
+    once it exceeds max_size bytes.
+
+    :returns: Tuple (content, None) or (None, path of the local file).
+    """
+    buffer = io.BytesIO()
+    chunks = response.iter_content(CHUNK_SIZE)
+    for chunk in chunks:
+        buffer.write(chunk)
+        progress.add(len(chunk), chunk)
+        if buffer.tell() > max_size:
+            break
+    else:
+        return buffer.getvalue(), None
+    with NamedTemporaryFile(mode='w+b', prefix=temp_prefix(),
+                            suffix=extension, delete=False) as destination:
+        try:
+            destination.write(buffer.getvalue())
+            buffer.close()
+            for chunk in chunks:
+                destination.write(chunk)
+                progress.add(len(chunk), chunk)
+        except BaseException:
+            destination.close()
+            os.remove(destination.name)
+            raise
+    return None, destination.name
+
+
+class _Progress(object):
+    """
+    Thread-safe count of the bytes received for a download, along with their
+    SHA-256 digest when they are received in order.
+    """
+
+    def __init__(self, total, callback):
+        self.total = total
+        self.callback = callback
+        self.done = 0
+        self.digest = hashlib.sha256()
+        self.digested = 0
+        self.lock = threading.Lock()
+
+    def add(self, nb_bytes, chunk=None):
+        with self.lock:
+            self.done += nb_bytes
+            if chunk is not None and self.digest is not None:
+                self.digest.update(chunk)
+                self.digested += len(chunk)
+            if self.callback:
+                self.callback(self.done, self.total)
+
+    def hexdigest(self):
+        """
+        :returns: Digest of the bytes received, or None if some were not
+                  digested.
+        """
+        if self.digest is None or self.digested != self.done:
+            return None
+        return self.digest.hexdigest()
+
+
+def _copy_response(response, destination, progress):
+    """
+    Write a streamed response body to an opened file.
+    """
+    for chunk in response.iter_content(CHUNK_SIZE):
+        destination.write(chunk)
+        progress.add(len(chunk), chunk)
+
+
+def _resumable_copy(response, destination, url, total, validator, timeout,
+                    policy, progress):
+    """
+    Write a streamed response body to an opened file, resuming with Range
+    requests from the last byte written if the transfer is interrupted.
+    """
+    logger = getLogger(__name__)
+    try:
+        _copy_response(response, destination, progress)
+        return
+    except requests.exceptions.RequestException as error:
+        logger.warning("Transfer of %s interrupted after %s bytes : %s",
+                       url, destination.tell(), error)
+    response.close()
+    destination.flush()
+    _fetch_range(url, destination.name, destination.tell(), total - 1,
+                 validator, timeout, policy, progress)
+    destination.seek(0, os.SEEK_END)
+
+
+def _parallel_download(url, path, total, nb_parallel, validator, timeout,
+                       policy, progress):
+    """
+    Fetch a document as nb_parallel byte ranges written in place into a
+    preallocated file.
+    """
+    logger = getLogger(__name__)
+    range_size = -(-total // nb_parallel)
+    bounds = [(start, min(start + range_size, total) - 1)
+              for start in range(0, total, range_size)]
+    logger.info("Downloading %s in %s ranges", url, len(bounds))
+    with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+        futures = [executor.submit(_fetch_range, url, path, start, end,
+                                   validator, timeout, policy, progress)
+                   for start, end in bounds]
+        for future in futures:
+            future.result()
+
+
+def _fetch_range(url, path, start, end, validator, timeout, policy,
+                 progress):
+    """
+    Write the bytes start to end (inclusive) of a document in place in a
+    local file, resuming from the last byte written after a failure.
+
+    Each request is sent with the retries of the policy, and the transfer is
+    resumed up to policy.max_try times, waiting as the policy says before
+    each resumption.
+    """
+    logger = getLogger(__name__)
+    session = http_session.get_session(url)
+    position = start
+    cur_try = 1
+    with open(path, 'r+b') as destination:
+        while position <= end:
+            headers = {'Range': 'bytes={}-{}'.format(position, end),
+                       'Accept-Encoding': 'identity'}
+            if validator:
+                headers['If-Range'] = validator
+            try:
+                response = policy.call(session.get, url, headers=headers,
+                                       timeout=timeout, stream=True)
+                try:
+                    if response.status_code != 206:
+                        raise DownloadError(
+                            ("Could not resume download of document at URL "
+                             "{}. Response code from the server : {}")
+                            .format(url, response.status_code))
+                    destination.seek(position)
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        chunk = chunk[:end + 1 - position]
+                        destination.write(chunk)
+                        position += len(chunk)
+                        progress.add(len(chunk), chunk)
+                finally:
+                    response.close()
+            except requests.exceptions.RequestException as error:
+                logger.warning("Transfer of bytes %s-%s of %s interrupted at "
+                               "byte %s : %s", start, end, url, position,
+                               error)
+            except CircuitOpenError as error:
+                raise DownloadError(error)
+            if position <= end:
+                if cur_try >= policy.max_try:
+                    logger.error("Could not download document %s", url)
+                    raise DownloadError(
+                        "Could not download bytes {}-{} of document at URL "
+                        "{}".format(position, end, url))
+                delay = policy.backoff(cur_try)
+                cur_try += 1
+                logger.warning("Resuming download of %s at byte %s in "
+                               "%.2fs (%s/%s)", url, position, delay,
+                               cur_try, policy.max_try)
+                time.sleep(delay)
+
+
+def download_file(doc_msg, progress_callback=None, **options):
+    """
+    Handler of the file scheme, see :py:func:`download`.
+    """
+    url = doc_msg['url']
+    path = url2pathname(urlsplit(url).path)
+    if not any(_is_under(path, local_dir) for local_dir in LOCAL_DIRS):
+        getLogger(__name__).error("Refusing to read %s : not under a local "
+                                  "directory", url)
+        raise DownloadError("URL {} is not under a local directory (see "
+                            "register_local_dir)".format(url))
+    return link_local(url, path, progress_callback=progress_callback)
+
+
+def download_s3(doc_msg, max_try=MAX_TRY, progress_callback=None,
+                **options):
+    """
+    Handler of the s3 scheme (s3://bucket/key), see :py:func:`download`.
+
+    Requires the optional boto3 package (``pip install VestaService[s3]``),
+    configured as usual (environment, ~/.aws/...).
+    """
+    logger = getLogger(__name__)
+    try:
+        import boto3
+        import botocore.config
+        import botocore.exceptions
+    except ImportError:
+        raise DownloadError("The boto3 package is required to download {}"
+                            .format(doc_msg['url']))
+    url = doc_msg['url']
+    logger.info("Getting S3 document at %s", url)
+    parts = urlsplit(url)
+    client = boto3.client('s3', config=botocore.config.Config(
+        retries={'max_attempts': max_try}))
+    progress = _Progress(None, progress_callback)
+    start = time.time()
+    with NamedTemporaryFile(mode='w+b', prefix=temp_prefix(),
+                            suffix=os.path.splitext(parts.path)[-1],
+                            delete=False) as destination:
+        try:
+            client.download_fileobj(parts.netloc, parts.path.lstrip('/'),
+                                    destination, Callback=progress.add)
+        except botocore.exceptions.BotoCoreError as error:
+            destination.close()
+            os.remove(destination.name)
+            logger.error("Could not download document %s", url)
+            raise DownloadError(error)
+        except botocore.exceptions.ClientError as error:
+            destination.close()
+            os.remove(destination.name)
+            logger.error("Could not download document %s", url)
+            raise DownloadError(error)
     doc = Document(url=url, path=destination.name)
+    doc.length = progress.done
+    doc.transfer_duration = time.time() - start
     logger.info("Download of URL %s complete", doc.url)
-    logger.debug("Local copy name is : %s", doc.local_path)
     return doc
 
 
-def upload(doc):
+def link_local(url, path, link=None, progress_callback=None):
     """
-    Upload a given document from a local file.
+    Obtain a document from a file readable by the worker, without copying
+    it.
+
+    :param url: URL of the document.
+    :param path: Local path of the file.
+    :param link: How the document refers to the file (defaults to
+                 LOCAL_LINK) :
+
+       :'path': The document refers to the original file.
+       :'hardlink': The document refers to a hard link to the file, created
+                    in LINK_DIR.
+       :'reflink': The document refers to a copy-on-write clone of the file,
+                   created in LINK_DIR (on file systems supporting it, e.g.
+                   Btrfs or XFS).
+
+       Links which cannot be created (other file system, ...) fall back to
+       a hard link and then to the original file.
+    :param progress_callback: As for :py:func:`download`.
+    :returns: object of type Document. Original files are flagged as not
+              owned by the document.
+    """
+    logger = getLogger(__name__)
+    if not os.path.isfile(path):
+        logger.error("Could not find document %s at %s", url, path)
+        raise DownloadError("No such file : {} (URL {})".format(path, url))
+    size = os.path.getsize(path)
+    link = link or LOCAL_LINK
+    link_path = None
+    if link == 'reflink':
+        link_path = _reflink(path)
+    if link in ('reflink', 'hardlink') and link_path is None:
+        link_path = _hardlink(path)
+    if link_path is None:
+        doc = Document(url=url, path=path)
+        doc.owned = False
+    else:
+        doc = Document(url=url, path=link_path)
+    doc.length = size
+    doc.transfer_duration = 0.
+    if progress_callback:
+        progress_callback(size, size)
+    logger.info("Document %s is read in place from %s", url, doc.local_path)
+    return doc
+
+
+def _link_path(path):
+    """
+    :returns: Path of a new empty file named after a file, where a link to
+              it can be created.
+    """
+    handle, link_path = tempfile.mkstemp(prefix=temp_prefix(),
+                                         suffix=os.path.splitext(path)[-1],
+                                         dir=LINK_DIR)
+    os.close(handle)
+    return link_path
+
+
+def _hardlink(path):
+    """
+    :returns: Path of a new hard link to a file, or None if it cannot be
+              created.
+    """
+    link_path = _link_path(path)
+    try:
+        os.remove(link_path)
+        os.link(path, link_path)
+    except (OSError, AttributeError) as exc:
+        getLogger(__name__).debug("Could not hard link %s : %s", path, exc)
+        if os.path.exists(link_path):
+            os.remove(link_path)
+        return None
+    return link_path
+
+
+def _reflink(path):
+    """
+    :returns: Path of a new copy-on-write clone of a file, or None if it
+              cannot be created.
+    """
+    if fcntl is None:
+        return None
+    link_path = _link_path(path)
+    try:
+        with open(path, 'rb') as source, open(link_path, 'wb') as clone:
+            fcntl.ioctl(clone.fileno(), FICLONE, source.fileno())
+    except (IOError, OSError) as exc:
+        getLogger(__name__).debug("Could not clone %s : %s", path, exc)
+        os.remove(link_path)
+        return None
+    return link_path
+
+
+def _mounted_path(url):
+    """
+    :returns: Local path of a URL under a shared mount, or None.
+    :raises DownloadError: if the URL designates a file outside of the
+                           local directory of the mount.
+    """
+    for url_prefix, local_dir in SHARED_MOUNTS.items():
+        if url.startswith(url_prefix):
+            relative_path = unquote(url[len(url_prefix):].split('?')[0])
+            segments = re.split(r'[/\\]', relative_path)
+            if os.path.isabs(relative_path) or '..' in segments:
+                raise DownloadError("URL {} is outside of the mount {}"
+                                    .format(url, url_prefix))
+            path = os.path.join(local_dir, relative_path)
+            if not _is_under(path, local_dir):
+                # e.g. through a symbolic link.
+                raise DownloadError("URL {} is outside of the mount {}"
+                                    .format(url, url_prefix))
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def _is_under(path, local_dir):
+    """
+    :returns: True if a path designates a file of a directory, once symbolic
+              links and '..' are resolved.
+    """
+    root = os.path.join(os.path.realpath(local_dir), '')
+    return os.path.realpath(path).startswith(root)
+
+
+def upload(doc, timeout=TIMEOUT, max_try=MAX_TRY, upload_target=None,
+           chunked=False):
+    """
+    Upload a given document from a local file, or from memory.
 
     This function is built to upload exclusively to the Vesta storage service.
 
+    A local file is streamed from disk, so memory use does not depend on its
+    size, and it is sent again from its first byte on each try.
+
     :param doc: Instance of :py:class:`~.Document.Document` with valid values.
+    :param timeout: Request timeout in seconds
+    :param max_try: Maximal number of tries
+    :param upload_target: (upload_url, storage_doc_id) pair obtained
+                          beforehand through :py:func:`prefetch_upload_urls`.
+                          Requested from the storage service if not given.
+    :param chunked: Send the file with a chunked transfer encoding rather
+                    than with a Content-Length.
     :returns: Instance of :py:class:`~.Document.Document` with the URL updated
        by the one that should be used to download the uploaded file.
     """
     logger = getLogger(__name__)
     logger.info("Uploading document to remote URL %s", doc.url)
-    logger.debug("Uploading «%s» to remote URL %s", doc.local_path,
-                 doc.url)
+    logger.debug("Uploading «%s» to remote URL %s",
+                 doc.local_path or doc.filename(), doc.url)
 
-    file_handle = open(doc.local_path, 'rb')
     headers = {'Content-Type': 'application/octet-stream'}
 
-    cur_try = 1
-    max_try = 5
-    result = None
-    upload_url = None
-    storage_doc_id = None
-    while cur_try <= max_try and result is None:
-        try:
-            if upload_url is None or storage_doc_id is None:
-                result_inter = requests.get('{url}?filename={fn}'.format(
-                    url=doc.url,
-                    fn=os.path.basename(doc.local_path)), timeout=TIMEOUT)
-
-                if result_inter.status_code != requests.codes.ok:
-                    result_inter.raise_for_status()
-
-                json_struct = result_inter.json()
-                upload_url = json_struct['upload_url']
-                storage_doc_id = json_struct['storage_doc_id']
-
-                logger.info("Retrieved an upload temporary url for document "
-                            "%s : %s", upload_url, storage_doc_id)
-
-            result = requests.put(upload_url,
-                                  headers=headers,
-                                  data=file_handle,
-                                  verify=False,
-                                  timeout=TIMEOUT)
-
-        except requests.exceptions.Timeout as error:
-            # Handle timeout error separately
-            if cur_try < max_try:
-                cur_try += 1
-                logger.warning("Timeout occurred while uploading document to "
-                               "%s. Retry (%s/%s)",
-                               doc.url, cur_try, max_try)
-            else:
-                logger.error("Could not upload document to %s", doc.url)
-                raise UploadError(error)
+    policy = RETRY_POLICY.with_max_try(max_try)
+    upload_url, storage_doc_id = upload_target or (None, None)
+
+    def put(url):
+        # Send the whole content again on each try.
+        with doc.open() as file_handle:
+            data = _iter_file(file_handle) if chunked else file_handle
+            return http_session.get_session(url).put(url,
+                                                     headers=headers,
+                                                     data=data,
+                                                     verify=False,
+                                                     timeout=timeout)
 
-        except requests.exceptions.RequestException as error:
-            logger.error("Could not upload document to %s", doc.url)
-            raise UploadError(error)
+    start = time.time()
+    try:
+        if upload_url is None or storage_doc_id is None:
+            upload_url, storage_doc_id = _get_upload_target(doc, timeout,
+                                                            policy)
+        result = policy.call(put, upload_url)
+    except (requests.exceptions.RequestException,
+            CircuitOpenError) as error:
+        logger.error("Could not upload document to %s", doc.url)
+        raise UploadError(error)
 
     if result.status_code != requests.codes.ok:
         result.raise_for_status()
 
-    logger.info("Upload to %s complete, document can be retrieved with id "
-                "%s", upload_url, storage_doc_id)
+    doc.length = doc.size()
+    doc.transfer_duration = time.time() - start
+    metrics.observe(metrics.STAGE_SECONDS, doc.transfer_duration,
+                    stage='upload')
+    metrics.inc(metrics.BYTES, doc.length, direction='upload')
+    logger.info("Upload to %s complete (%s bytes at %.1f kB/s), document can "
+                "be retrieved with id %s", upload_url, doc.length,
+                (doc.throughput() or 0) / 1024, storage_doc_id)
 
     doc.url = storage_doc_id
 
     return doc
 
 
+def prefetch_upload_urls(docs, timeout=TIMEOUT, nb_workers=8,
+                         max_try=MAX_TRY):
+    """
+    Obtain the temporary upload URLs of many documents at once.
+
+    :param docs: Instances of :py:class:`~.Document.Document` to upload.
+    :param timeout: Request timeout in seconds
+    :param nb_workers: Number of requests sent concurrently to the storage
+                       service.
+    :param max_try: Maximal number of tries
+    :returns: list of (upload_url, storage_doc_id) pairs, in the order of
+              docs, to be given to :py:func:`upload` as upload_target.
+    """
+    docs = list(docs)
+    if not docs:
+        return []
+    policy = RETRY_POLICY.with_max_try(max_try)
+    try:
+        with ThreadPoolExecutor(max_workers=min(nb_workers,
+                                                len(docs))) as executor:
+            return list(executor.map(
+                lambda doc: _get_upload_target(doc, timeout, policy), docs))
+    except (requests.exceptions.RequestException,
+            CircuitOpenError) as error:
+        raise UploadError(error)
+
+
+def _get_upload_target(doc, timeout, policy):
+    """
+    Ask the storage service where a document should be uploaded.
+    """
+    logger = getLogger(__name__)
+    result_inter = policy.call(
+        http_session.get_session(doc.url).get,
+        '{url}?filename={fn}'.format(url=doc.url,
+                                     fn=doc.filename()),
+        timeout=timeout)
+
+    if result_inter.status_code != requests.codes.ok:
+        result_inter.raise_for_status()
+
+    json_struct = result_inter.json()
+    upload_url = json_struct['upload_url']
+    storage_doc_id = json_struct['storage_doc_id']
+
+    logger.info("Retrieved an upload temporary url for document "
+                "%s : %s", upload_url, storage_doc_id)
+    return upload_url, storage_doc_id
+
+
+def _iter_file(file_handle):
+    """
+    Read an opened file by blocks of CHUNK_SIZE bytes.
+    """
+    chunk = file_handle.read(CHUNK_SIZE)
+    while chunk:
+        yield chunk
+        chunk = file_handle.read(CHUNK_SIZE)
+
+
+def host_token():
+    """
+    :returns: Token identifying the current host (or container) and boot,
+              so that local copies in a directory shared with other hosts
+              are only swept by their own host.
+    """
+    global _HOST_TOKEN
+    if _HOST_TOKEN is None:
+        try:
+            with open(BOOT_ID_PATH) as file_handle:
+                boot_id = file_handle.read().strip()
+        except (IOError, OSError):
+            boot_id = ''
+        identity = '{}/{}'.format(socket.gethostname(), boot_id)
+        _HOST_TOKEN = hashlib.sha1(identity.encode('utf-8')).hexdigest()[:8]
+    return _HOST_TOKEN
+
+
+def temp_prefix():
+    """
+    :returns: Prefix of the local copies created by the current process.
+    """
+    return '{}{}-{}-'.format(TEMP_PREFIX, host_token(), os.getpid())
+
+
+def sweep_orphans(directories=None, min_age=SWEEP_MIN_AGE):
+    """
+    Remove the local copies left behind by processes of the current host
+    which died before cleaning them up (e.g. crashed or killed workers).
+
+    :param directories: Directories to sweep. Defaults to the temporary
+                        directory and the directory of DOCUMENT_CACHE.
+    :param min_age: Age in seconds under which a copy is kept.
+    :returns: Number of files removed.
+    """
+    logger = getLogger(__name__)
+    if directories is None:
+        directories = [tempfile.gettempdir()]
+        if DOCUMENT_CACHE:
+            directories.append(DOCUMENT_CACHE.cache_dir)
+    pattern = re.compile(r'{}(\d+)-'.format(
+        re.escape('{}{}-'.format(TEMP_PREFIX, host_token()))))
+    now = time.time()
+    nb_removed = 0
+    for directory in directories:
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        for name in names:
+            match = pattern.match(name)
+            if not match:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                age = now - os.path.getmtime(path)
+            except OSError:
+                continue
+            if age < min_age or \
+                    document_cache.pid_exists(int(match.group(1))):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Removed meanwhile by another sweeper.
+                continue
+            nb_removed += 1
+    if nb_removed:
+        logger.info("Removed %s orphaned local copies", nb_removed)
+    return nb_removed
+
+
 def cleanup(doc):
     """
     Remove a given local document.
 
+    A document obtained from a cache only releases its reference on the cached
+    copy, which may still be in use by other tasks, and the original files
+    referred to by local documents (see :py:func:`link_local`) are never
+    removed.
+
     :param doc: Document on which the cleanup will act.
     """
     logger = getLogger(__name__)
-    if doc.local_path:
+    doc.close()
+    if doc.cache_ref:
+        logger.debug("Releasing cached copy %s", doc)
+        document_cache.release(doc)
+    elif doc.local_path and doc.owned:
         logger.debug("Removing local copy %s", doc)
         os.remove(doc.local_path)
+
+
+# Download handlers keyed by URL scheme (see register_scheme).
+SCHEME_HANDLERS = {
+    'http': download_http,
+    'https': download_http,
+    'file': download_file,
+    's3': download_s3,
+}
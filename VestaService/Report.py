@@ -7,9 +7,19 @@ after each task and sent to the platform.
 """
 
 # -- standard library ---------------------------------------------------------
+from collections import deque
+from bisect import bisect_left
+from array import array
 from enum import Enum
 import json
-import copy
+import time
+import sys
+import os
+
+try:
+    intern = sys.intern
+except AttributeError:  # Python 2
+    pass
 
 
 class ReportStatus(Enum):
@@ -27,20 +37,247 @@ class TaskStatus(Enum):
     Ignore = 4
 
 
+_TASK_STATUSES = dict((status.value, status) for status in TaskStatus)
+
+
+# Number of task reports encoded in each chunk of a streamed report.
+CHUNK_SIZE = 100
+
+# Stages of a task whose duration is recorded in its report.
+QUEUE_WAIT = "queue_wait"
+DOWNLOAD = "download"
+PROCESSING = "processing"
+UPLOAD = "upload"
+STAGES = (QUEUE_WAIT, DOWNLOAD, PROCESSING, UPLOAD)
+
+# Upper bounds in seconds of the buckets of the latency histograms.
+LATENCY_BUCKETS = tuple(base * 10 ** exponent
+                        for exponent in range(-3, 4)
+                        for base in (1, 2.5, 5))
+PERCENTILES = (50, 90, 99)
+# Length in seconds of the periods over which the throughput is measured and
+# number of periods kept.
+THROUGHPUT_INTERVAL = 60.
+THROUGHPUT_PERIODS = 60
+
+
 class WorkerReportEncoder(json.JSONEncoder):
     """
-    JSON encoder for the worker report
+    JSON encoder for the worker report. A worker report is encoded
+    incrementally by iterencode (and thus json.dump).
     """
     def encode(self, o):
         if isinstance(o, WorkerReport):
-            obj = copy.deepcopy(o)
-            obj.status = obj.status.name.lower()
-            obj.detail = [tr.to_dict() for tr in obj.detail]
-            return json.JSONEncoder().encode(vars(obj))
+            return "".join(o.iter_json())
         return json.JSONEncoder().encode(o)
 
+    def iterencode(self, o, _one_shot=False):
+        if isinstance(o, WorkerReport):
+            return o.iter_json()
+        return json.JSONEncoder.iterencode(self, o, _one_shot)
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of durations, from which percentiles are estimated with a
+    constant memory.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last count is that of the durations above all the buckets.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, duration):
+        self.counts[bisect_left(self.buckets, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def mean(self):
+        if not self.count:
+            return 0.
+        return self.total / self.count
+
+    def percentile(self, percent):
+        """
+        Estimate a percentile, interpolating within its bucket.
+        :param percent: Percentage between 0 and 100
+        :return: The duration in seconds
+        """
+        if not self.count:
+            return 0.
+        rank = percent / 100. * self.count
+        cumulated = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulated + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.
+                upper = self.buckets[index] \
+                    if index < len(self.buckets) else self.max
+                upper = min(upper, self.max)
+                lower = min(lower, upper)
+                return lower + (upper - lower) * (rank - cumulated) / count
+            cumulated += count
+        return self.max
+
+    def to_dict(self):
+        """
+        :return: The count, mean, maximum and percentiles in a dict form
+        """
+        hist_dict = dict(count=self.count, mean=self.mean(), max=self.max)
+        for percent in PERCENTILES:
+            hist_dict["p{}".format(percent)] = self.percentile(percent)
+        return hist_dict
+
+
+class Throughput(object):
+    """
+    Number of tasks completed over the last periods.
+    """
+
+    def __init__(self, interval=THROUGHPUT_INTERVAL,
+                 nb_periods=THROUGHPUT_PERIODS):
+        self.interval = interval
+        self.periods = deque(maxlen=nb_periods)
+
+    def add(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        start = timestamp - timestamp % self.interval
+        if self.periods and self.periods[-1][0] == start:
+            self.periods[-1][1] += 1
+        else:
+            self.periods.append([start, 1])
+
+    def to_list(self):
+        """
+        :return: For each period, its start, number of tasks and rate of
+                 tasks per second
+        """
+        return [dict(start=start, tasks=count, rate=count / self.interval)
+                for start, count in self.periods]
+
+
+class TaskColumns(object):
+    """
+    Sequence of the task reports of a worker report, stored by columns :
+    statuses, error codes and step ids in arrays and step names interned, so
+    that a report of millions of tasks stays compact.
+
+    Items are :py:class:`TaskReport` snapshots of the tasks when they were
+    added.
+    """
+
+    def __init__(self):
+        self.doc_ids = []
+        self.statuses = array('b')
+        self.step_ids = array('l')
+        self.codes = array('l')
+        # Values which most tasks do not have, keyed by task index.
+        self.messages = {}
+        self.deliveries = {}
+        # Durations of the stages of the tasks, NaN when unknown.
+        self.timings = {}
+        self.steps = []
+        self._step_ids = {}
+
+    def append(self, task_report):
+        """
+        Add a task report.
+
+        :param task_report: Instance of :py:class:`TaskReport`.
+        """
+        index = len(self.doc_ids)
+        step_id = self._step_ids.get(task_report.step)
+        if step_id is None:
+            step_id = len(self.steps)
+            self.steps.append(_intern(task_report.step))
+            self._step_ids[task_report.step] = step_id
+        code = task_report.code
+        if isinstance(self.codes, array):
+            try:
+                self.codes.append(code)
+            except (TypeError, OverflowError):
+                # Codes which are not machine integers.
+                self.codes = list(self.codes)
+        if not isinstance(self.codes, array):
+            self.codes.append(code)
+        self.doc_ids.append(task_report.doc_id)
+        self.statuses.append(task_report.status.value)
+        self.step_ids.append(step_id)
+        if task_report.message:
+            self.messages[index] = task_report.message
+        if task_report.delivery is not None:
+            self.deliveries[index] = task_report.delivery
+        for stage, duration in (task_report.timings or {}).items():
+            column = self.timings.get(stage)
+            if column is None:
+                column = self.timings[stage] = array('d', [_NAN] * index)
+            column.append(duration)
+        for column in self.timings.values():
+            if len(column) == index:
+                column.append(_NAN)
+
+    def _timings(self, index):
+        timings = dict((stage, column[index])
+                       for stage, column in self.timings.items()
+                       if column[index] == column[index])
+        return timings or None
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("task report index out of range")
+        task_report = TaskReport(self.doc_ids[index],
+                                 self.steps[self.step_ids[index]])
+        task_report.status = _TASK_STATUSES[self.statuses[index]]
+        task_report.code = self.codes[index]
+        task_report.message = self.messages.get(index, "")
+        task_report.delivery = self.deliveries.get(index)
+        task_report.timings = self._timings(index)
+        return task_report
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def iter_dicts(self, start=0):
+        """
+        Iterate on the task reports in dict form (see
+        :py:meth:`TaskReport.to_dict`) without building TaskReport objects.
+
+        :param start: Index of the first task report.
+        """
+        failure = TaskStatus.Failure.value
+        for index in range(start, len(self)):
+            status = self.statuses[index]
+            tr_dict = dict()
+            tr_dict["doc_id"] = self.doc_ids[index]
+            tr_dict["step"] = self.steps[self.step_ids[index]]
+            if status == failure:
+                tr_dict["code"] = self.codes[index]
+                tr_dict["message"] = self.messages.get(index, "")
+            tr_dict["status"] = _STATUS_NAMES[status]
+            delivery = self.deliveries.get(index)
+            if delivery is not None:
+                tr_dict["delivery"] = delivery
+            if self.timings:
+                timings = self._timings(index)
+                if timings is not None:
+                    tr_dict["timings"] = timings
+            yield tr_dict
+
 
-class WorkerReport:
+class WorkerReport(object):
 
     def __init__(self, nb_tasks=0):
         """
@@ -53,7 +290,61 @@ class WorkerReport:
         self.nb_success = 0
         self.nb_ignores = 0
         self.nb_failures = 0
-        self.detail = []
+        self.detail = TaskColumns()
+        # Number of task reports written to the checkpoint file and
+        # published as deltas.
+        self.nb_checkpointed = 0
+        self.nb_published = 0
+        # Aggregates updated along with the report.
+        self.failures_per_code = {}
+        self.latencies = {}
+        self.throughput = Throughput()
+
+    @classmethod
+    def resume(cls, path):
+        """
+        Rebuild a report from its checkpoint file (see :py:meth:`checkpoint`)
+        so that a batch interrupted by the death of its worker can go on.
+        A line left incomplete by the interruption is removed from the file.
+        :param path: Path of the checkpoint file
+        :return: The report as of its last checkpoint
+        """
+        report = cls()
+        summary = None
+        nb_published = 0
+        throughput = []
+        valid_size = 0
+        with open(path, "rb") as fp:
+            for line in fp:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Incomplete line")
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    break
+                valid_size += len(line)
+                if "summary" in record:
+                    summary = record["summary"]
+                    nb_published = record.get("published", 0)
+                    throughput = record.get("throughput", [])
+                else:
+                    # The tasks were completed before : their throughput is
+                    # restored from the summary.
+                    report._update(TaskReport.from_dict(record),
+                                   replay=True)
+        if valid_size < os.path.getsize(path):
+            with open(path, "r+b") as fp:
+                fp.truncate(valid_size)
+        if summary is not None:
+            report.status = ReportStatus[summary["status"].capitalize()]
+            report.nb_tasks = summary["nb_tasks"]
+            report.completion_ratio = summary["completion_ratio"]
+        for period in throughput:
+            report.throughput.periods.append([period["start"],
+                                              period["tasks"]])
+        report.nb_checkpointed = len(report.detail)
+        report.nb_published = min(nb_published, len(report.detail))
+        return report
 
     def set_nb_tasks(self, nb_tasks):
         """
@@ -65,11 +356,15 @@ class WorkerReport:
 
     def update(self, task_report):
         """
-        Update the worker report after the execution of a task
+        Update the worker report after the execution of a task.
+        The state of the task report at this time is recorded.
         :param task_report: The report produced after the execution of a task
         :type task_report: TaskReport
         :return:
         """
+        self._update(task_report)
+
+    def _update(self, task_report, replay=False):
         self.detail.append(task_report)
         if task_report.status == TaskStatus.Success:
             self.nb_success += 1
@@ -77,6 +372,18 @@ class WorkerReport:
             self.nb_ignores += 1
         else:
             self.nb_failures += 1
+            code = str(task_report.code)
+            self.failures_per_code[code] = \
+                self.failures_per_code.get(code, 0) + 1
+        if task_report.timings:
+            step_latencies = self.latencies.setdefault(task_report.step, {})
+            for stage, duration in task_report.timings.items():
+                histogram = step_latencies.get(stage)
+                if histogram is None:
+                    histogram = step_latencies[stage] = LatencyHistogram()
+                histogram.add(duration)
+        if not replay:
+            self.throughput.add()
 
     def set_processing(self):
         """
@@ -105,6 +412,31 @@ class WorkerReport:
                 (self.nb_success + self.nb_ignores + self.nb_failures) \
                 / self.nb_tasks
 
+    def summary(self):
+        """
+        :return: The report without its detail in a dict form
+        """
+        return dict(status=self.status.name.lower(),
+                    completion_ratio=self.completion_ratio,
+                    nb_tasks=self.nb_tasks,
+                    nb_success=self.nb_success,
+                    nb_ignores=self.nb_ignores,
+                    nb_failures=self.nb_failures)
+
+    def aggregates(self):
+        """
+        :return: The failures per error code, the latency statistics of each
+                 stage of each step and the throughput over time in a dict
+                 form
+        """
+        latencies = dict(
+            (step, dict((stage, histogram.to_dict())
+                        for stage, histogram in step_latencies.items()))
+            for step, step_latencies in self.latencies.items())
+        return dict(failures_per_code=dict(self.failures_per_code),
+                    latencies=latencies,
+                    throughput=self.throughput.to_list())
+
     def to_json(self):
         """
         :return: The report as a JSON document
@@ -112,6 +444,102 @@ class WorkerReport:
         encoder = WorkerReportEncoder()
         return encoder.encode(self)
 
+    def iter_json(self, chunk_size=CHUNK_SIZE):
+        """
+        Encode the report incrementally : the summary first, then the task
+        reports by chunks, so that a large report is never held in memory as
+        a whole.
+        :param chunk_size: Number of task reports per chunk
+        :return: Generator of the chunks of the JSON document
+        """
+        encoder = json.JSONEncoder()
+        header = encoder.encode(self.summary())
+        yield header[:-1] + ', "detail": ['
+        chunk = []
+        separator = ""
+        for tr_dict in self.detail.iter_dicts():
+            chunk.append(encoder.encode(tr_dict))
+            if len(chunk) >= chunk_size:
+                yield separator + ", ".join(chunk)
+                separator = ", "
+                chunk = []
+        if chunk:
+            yield separator + ", ".join(chunk)
+        yield "]}"
+
+    def dump(self, fp, chunk_size=CHUNK_SIZE):
+        """
+        Write the report as a JSON document to a file object, incrementally
+        :param fp: File object open in text mode
+        :param chunk_size: Number of task reports written at once
+        """
+        for chunk in self.iter_json(chunk_size):
+            fp.write(chunk)
+
+    def iter_ndjson(self, start=0):
+        """
+        Encode the task reports as newline delimited JSON, one task per line
+        :param start: Index of the first task report
+        :return: Generator of the lines
+        """
+        encoder = json.JSONEncoder()
+        for tr_dict in self.detail.iter_dicts(start):
+            yield encoder.encode(tr_dict) + "\n"
+
+    def dump_ndjson(self, fp, start=0):
+        """
+        Append the task reports added since start to a newline delimited
+        JSON file object, which can thus be written to (and tailed) while the
+        batch runs::
+
+            written = report.dump_ndjson(fp)
+            ...
+            written = report.dump_ndjson(fp, start=written)
+
+        :param fp: File object open in text mode
+        :param start: Index of the first task report to write
+        :return: Number of task reports written in total, the start of the
+                 next call
+        """
+        end = len(self.detail)
+        fp.writelines(self.iter_ndjson(start))
+        fp.flush()
+        return end
+
+    def checkpoint(self, path, sync=False):
+        """
+        Append the task reports added since the last checkpoint and the
+        summary of the report to a checkpoint file, from which the report
+        can be resumed (see :py:meth:`resume`)
+        :param path: Path of the checkpoint file
+        :param sync: Wait for the file to be written to disk
+        """
+        with open(path, "a") as fp:
+            self.nb_checkpointed = self.dump_ndjson(fp, self.nb_checkpointed)
+            fp.write(json.JSONEncoder().encode(
+                {"summary": self.summary(),
+                 "published": self.nb_published,
+                 "throughput": self.throughput.to_list()}) + "\n")
+            fp.flush()
+            if sync:
+                os.fsync(fp.fileno())
+
+    def delta_json(self):
+        """
+        Encode the summary of the report and the task reports added since
+        the last delta, whose cost only depends on the number of new tasks.
+        The index of the first task report of the delta is given by
+        first_task.
+        :return: The delta as a JSON document
+        """
+        end = len(self.detail)
+        report_dict = self.summary()
+        report_dict["first_task"] = self.nb_published
+        report_dict["detail"] = list(self.detail.iter_dicts(
+            self.nb_published))
+        self.nb_published = end
+        return json.JSONEncoder().encode(report_dict)
+
     def abbreviated_json(self, url):
         """
         Encode the report in an abbreviated form,
@@ -119,18 +547,16 @@ class WorkerReport:
         :param url: the url of the full report
         :return:
         """
-        report_dict = dict(status=self.status.name.lower(),
-                           completion_ratio=self.completion_ratio,
-                           nb_tasks=self.nb_tasks,
-                           nb_success=self.nb_success,
-                           nb_ignores=self.nb_ignores,
-                           nb_failures=self.nb_failures,
-                           full_report_url=url)
+        report_dict = self.summary()
+        report_dict["full_report_url"] = url
+        report_dict["aggregates"] = self.aggregates()
         encoder = json.JSONEncoder()
         return encoder.encode(report_dict)
 
 
-class TaskReport:
+class TaskReport(object):
+    __slots__ = ('status', 'doc_id', 'step', 'code', 'message', 'delivery',
+                 'timings')
 
     def __init__(self, doc_id, tool):
         """
@@ -143,6 +569,8 @@ class TaskReport:
         self.step = tool
         self.code = 0
         self.message = ""
+        self.delivery = None
+        self.timings = None
 
     def to_dict(self):
         """
@@ -155,8 +583,26 @@ class TaskReport:
             tr_dict["code"] = self.code
             tr_dict["message"] = self.message
         tr_dict["status"] = self.status.name.lower()
+        if self.delivery is not None:
+            tr_dict["delivery"] = self.delivery
+        if self.timings:
+            tr_dict["timings"] = dict(self.timings)
         return tr_dict
 
+    @classmethod
+    def from_dict(cls, tr_dict):
+        """
+        :param tr_dict: A report in the form given by :py:meth:`to_dict`
+        :return: The task report
+        """
+        task_report = cls(tr_dict["doc_id"], tr_dict["step"])
+        task_report.status = TaskStatus[tr_dict["status"].capitalize()]
+        task_report.code = tr_dict.get("code", 0)
+        task_report.message = tr_dict.get("message", "")
+        task_report.delivery = tr_dict.get("delivery")
+        task_report.timings = tr_dict.get("timings")
+        return task_report
+
     def set_succeeded(self):
         """
         Set the status of the report to "Success"
@@ -181,3 +627,37 @@ class TaskReport:
 
     def set_processing(self):
         self.status = TaskStatus.Processing
+
+    def set_timing(self, stage, duration):
+        """
+        Record the duration of a stage of the task
+        :param stage: the stage (QUEUE_WAIT, DOWNLOAD, PROCESSING, UPLOAD or
+                      any other name)
+        :param duration: the duration in seconds
+        """
+        if self.timings is None:
+            self.timings = {}
+        self.timings[stage] = duration
+
+    def set_delivery(self, nb_batches, nb_annotations, nb_failures=0):
+        """
+        Record the delivery of the annotations by batches
+        :param nb_batches: the number of batches sent
+        :param nb_annotations: the number of annotations sent
+        :param nb_failures: the number of batches which could not be delivered
+        """
+        self.delivery = dict(batches=nb_batches,
+                             annotations=nb_annotations,
+                             failed_batches=nb_failures)
+
+
+_NAN = float("nan")
+_STATUS_NAMES = dict((status.value, status.name.lower())
+                     for status in TaskStatus)
+
+
+def _intern(value):
+    # Only native strings can be interned.
+    if type(value) is str:
+        return intern(value)
+    return value
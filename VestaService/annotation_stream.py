@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+This module offers a way to send annotations to the Annotation Storage
+Service (JASS) while they are being produced.
+
+Annotations pushed on an :py:class:`AnnotationStream` are buffered and sent
+in the background whenever the buffer reaches a given size or age. When the
+JASS cannot keep up, at most max_pending batches wait to be sent after which
+pushing blocks, so that the memory used by a long running annotator stays
+bounded.
+"""
+
+# -- standard library --------------------------------------------------------
+from threading import Thread, Lock
+import logging
+import time
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:  # Python 2
+    from Queue import Queue, Empty, Full
+
+# -- project-specific --------------------------------------------------------
+from .annotations_dispatcher import submit_annotations
+from .service_exceptions import AnnotationsUndeliverable
+
+# -- Configuration ------------------------------------------------------------
+FLUSH_SIZE = 1000
+FLUSH_INTERVAL = 5.0
+MAX_PENDING = 4
+
+_CLOSE = object()
+
+
+class AnnotationStream(object):
+    """
+    Buffered, background delivery of annotations to a JASS.
+    """
+
+    def __init__(self, ann_srv_url, flush_size=FLUSH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING,
+                 compression=None):
+        """
+        Constructor.
+
+        :param ann_srv_url: URL of the annotation service where the
+                            annotations will be stored.
+        :param flush_size: Number of buffered annotations triggering a send.
+        :param flush_interval: Age in seconds of the oldest buffered
+                               annotation triggering a send.
+        :param max_pending: Number of batches waiting to be sent over which
+                            pushing blocks.
+        :param compression: How the batches are compressed, as for
+                            submit_annotations.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.ann_srv_url = ann_srv_url
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.compression = compression
+        self.nb_annotations = 0
+        self.nb_batches = 0
+        self.closed = False
+        self._buffer = []
+        self._buffer_time = None
+        self._lock = Lock()
+        self._error = None
+        self._queue = Queue(maxsize=max_pending)
+        self._thread = Thread(target=self._run, name='annotation-stream')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def push(self, annotation):
+        """
+        Add an annotation to the stream.
+
+        :param annotation: Annotation to append to the annotations Document.
+        """
+        self.extend([annotation])
+
+    def extend(self, annotations):
+        """
+        Add annotations to the stream.
+
+        :param annotations: Iterable of annotations.
+        """
+        self._check()
+        batch = None
+        with self._lock:
+            if not self._buffer:
+                self._buffer_time = time.time()
+            self._buffer.extend(annotations)
+            if len(self._buffer) >= self.flush_size:
+                batch = self._take()
+        if batch:
+            self._queue.put(batch)
+
+    def flush(self):
+        """
+        Schedule the sending of the buffered annotations.
+        """
+        self._check()
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._queue.put(batch)
+
+    def close(self):
+        """
+        Send the remaining annotations and wait for all of them to be
+        delivered.
+
+        :raises AnnotationsUndeliverable: if some annotations could not be
+                                          delivered.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._queue.put(batch)
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        self.logger.info("Annotation stream closed after sending %s "
+                         "annotations in %s batches", self.nb_annotations,
+                         self.nb_batches)
+        if self._error is not None:
+            raise AnnotationsUndeliverable(self._error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _take(self):
+        """
+        Remove the buffered annotations. Must be called with the lock held.
+        """
+        batch = self._buffer
+        self._buffer = []
+        return batch
+
+    def _check(self):
+        if self._error is not None:
+            raise AnnotationsUndeliverable(self._error)
+        if self.closed:
+            raise AnnotationsUndeliverable("Annotation stream is closed")
+
+    def _run(self):
+        """
+        Send the batches of the queue, along with the buffered annotations
+        which are older than flush_interval.
+        """
+        while True:
+            try:
+                batch = self._queue.get(timeout=self.flush_interval / 2.)
+            except Empty:
+                batch = None
+            if batch is _CLOSE:
+                return
+            if batch:
+                self._send(batch)
+            # Checked after each batch too, so that a steady flow of batches
+            # does not hold a partial buffer past flush_interval.
+            self._flush_old()
+
+    def _flush_old(self):
+        """
+        Queue the buffered annotations older than flush_interval, after the
+        batches already waiting so that annotations keep their order.
+        """
+        with self._lock:
+            if not self._buffer or \
+                    time.time() - self._buffer_time < self.flush_interval:
+                return
+            try:
+                self._queue.put_nowait(self._buffer)
+            except Full:
+                # Queued once a batch is sent.
+                return
+            self._buffer = []
+
+    def _send(self, batch):
+        if self._error is not None:
+            # Do not deliver more annotations once some were lost.
+            return
+        if not self.ann_srv_url:
+            self.logger.warning("Not submitting annotations to a null URL")
+            return
+        try:
+            submit_annotations(self.ann_srv_url, batch,
+                               compression=self.compression)
+        except Exception as exc:
+            self.logger.error("Could not deliver %s annotations : %s",
+                              len(batch), exc)
+            self._error = exc
+            return
+        self.nb_annotations += len(batch)
+        self.nb_batches += 1
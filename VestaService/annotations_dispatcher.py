@@ -7,124 +7,343 @@ an annotation storage request. It is adapted to the Annotations Storage Service
 """
 
 # Standard library requirements ----------------------------------------------
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import optparse
 import logging
-import json
-import zipfile
 import tempfile
-import os
+import zipfile
+import json
+import zlib
+import sys
+
+try:
+    TEXT_TYPES = (str, bytes, unicode)  # Python 2
+except NameError:
+    TEXT_TYPES = (str, bytes)
 
 # 3rd party requirements -----------------------------------------------------
 import requests
 
 # -- project - specific ------------------------------------------------------
-from .service_exceptions import (UploadError, InvalidAnnotationFormat)
+from .service_exceptions import (UploadError, InvalidAnnotationFormat,
+                                 InvalidConfigType, CircuitOpenError)
+from .retry import RetryPolicy, MAX_TRY
+from . import http_session
+from . import metrics
 
 TIMEOUT = 10
+# Retry policy of the submissions.
+RETRY_POLICY = RetryPolicy(max_try=MAX_TRY)
+CHUNK_SIZE = 1024 * 1024
+# Encoded payloads larger than this are spooled to a temporary file rather
+# than kept in memory.
+SPOOL_THRESHOLD = 64 * 1024 * 1024
+COMPRESSIONS = (None, 'zip', 'gzip', 'zstd')
+# Default number of batches sent concurrently.
+NB_WORKERS = 4
 
 
-def submit_annotations(ann_srv_url, annotations, send_zip=False):
+def submit_annotations(ann_srv_url, annotations, send_zip=False,
+                       compression=None):
     """
     Call the Annotation Storage Service to save annotations.
 
+    The annotations are encoded one at a time straight into the compressor,
+    and the encoded (and possibly compressed) payload is kept in memory, or
+    spooled to an anonymous temporary file if it exceeds SPOOL_THRESHOLD
+    bytes. Memory use thus does not depend on the number of annotations when
+    they are given as an iterator.
+
     :param ann_srv_url: URL of the annotation service where the annotations
                         will be stored.
-    :param annotations: Annotations to append to the annotations Document.
+    :param annotations: Annotations to append to the annotations Document,
+                        as a list or any other iterable.
     :param send_zip: indicates if the annotations should be sent in a zip file
-    :type annotations: list
+                     (same as compression='zip').
+    :param compression: How the annotations are compressed. One of :
+
+       :None: Plain JSON body.
+       :'zip': JSON document in a zip file sent as form-data.
+       :'gzip': JSON body with a gzip Content-Encoding.
+       :'zstd': JSON body with a zstd Content-Encoding (requires the
+                zstandard package).
+    :type annotations: iterable
     """
     logger = logging.getLogger(__name__)
     logger.info("Submitting annotations to target %s", ann_srv_url)
 
-    if not isinstance(annotations, list):
+    if isinstance(annotations, (dict,) + TEXT_TYPES) or \
+            not hasattr(annotations, '__iter__'):
         raise InvalidAnnotationFormat("Annotations should be an object of type"
-                                      " list")
-
-    cur_try = 1
-    max_tries = 5
-    result = None
-
-    payload = json.dumps({'common': {},
-                          'data': annotations})
+                                      " list (or another iterable)")
+    if send_zip:
+        compression = 'zip'
+    if compression not in COMPRESSIONS:
+        raise InvalidConfigType("Unknown annotations compression : {}"
+                                .format(compression))
 
     logger.debug("Upload URL is %s", ann_srv_url)
-    logger.debug("Submitted data is %s", payload)
 
-    files = None
-    temp_text_file = None
-    temp_zip_file = None
+    session = http_session.get_session(ann_srv_url)
+    body = _encode(iter_payload(annotations), compression)
+    logger.debug("Encoded payload has %s bytes", len(body))
 
-    if send_zip:
+    if compression == 'zip':
         headers = {'accept': 'application/json'}
-        # creating annotations.txt file to be zipped
-        temp_dir = tempfile.gettempdir()
-        text_file_name = "annotations.txt"
-        zip_file_name = "annotations.zip"
-        temp_text_file = os.path.join(temp_dir, text_file_name)
-        temp_zip_file = os.path.join(temp_dir, zip_file_name)
-        with open(temp_text_file, 'w') as file_to_zip:
-            file_to_zip.write(str(payload))
-
-        # creating zipped file
-        with zipfile.ZipFile(temp_zip_file, "w",
-                             compression=zipfile.ZIP_DEFLATED) as zippy:
-            zippy.write(temp_text_file, text_file_name)
-            zippy.close()
-
-        # Opened for transport (HTTP POST via form-data, as bytes)
-            opened_zipped_file = open(temp_zip_file, "rb")
-            files = {"file": opened_zipped_file}
     else:
         headers = {'content-type': 'application/json',
                    'accept': 'application/json'}
+        if compression:
+            headers['content-encoding'] = compression
 
-    while cur_try <= max_tries and not result:
-        logger.debug("Trying HTTP POST request %s/%s", cur_try, max_tries)
+    def post(url):
+        body.rewind()
+        if compression == 'zip':
+            return session.post(url,
+                                files={'file': ('annotations.zip', body)},
+                                timeout=TIMEOUT,
+                                headers=headers)
+        return session.post(url,
+                            data=body,
+                            timeout=TIMEOUT,
+                            headers=headers)
 
-        try:
-            if files is None:
-                result = requests.post(ann_srv_url,
-                                       data=payload,
-                                       timeout=TIMEOUT,
-                                       headers=headers)
-            else:
-                result = requests.post(ann_srv_url,
-                                       files=files,
-                                       timeout=TIMEOUT,
-                                       headers=headers)
-
-            if result.status_code not in [200, 201, 204]:
-                logger.error("Got following code : %s", result.status_code)
-                result.raise_for_status()
-
-        except requests.exceptions.Timeout as error:
-            # Handle timeout error separately
-            if cur_try < max_tries:
-                cur_try += 1
-                logger.debug("Current try : %s", cur_try)
-                logger.warning("Timeout occurred while uploading document to "
-                               "%s. Retry (%s/%s)",
-                               ann_srv_url, cur_try, max_tries)
-            else:
-                logger.error("Could not upload document to %s", ann_srv_url)
-                raise UploadError(error)
-
-        except requests.exceptions.RequestException as error:
-            logger.error("Could not upload document to %s", ann_srv_url)
-            raise UploadError(error)
-
-        finally:
-            # Delete artifacts
-            if temp_text_file and os.path.exists(temp_text_file) and\
-               os.path.isfile(temp_text_file):
-                os.remove(temp_text_file)
-            if temp_zip_file and os.path.exists(temp_zip_file) and\
-               os.path.isfile(temp_zip_file):
-                os.remove(temp_zip_file)
+    try:
+        with metrics.timer(metrics.STAGE_SECONDS, stage='annotations'):
+            result = RETRY_POLICY.call(post, ann_srv_url)
+        if result.status_code not in [200, 201, 204]:
+            logger.error("Got following code : %s", result.status_code)
+            result.raise_for_status()
+        metrics.inc(metrics.BYTES, len(body), direction='annotations')
+    except (requests.exceptions.RequestException,
+            CircuitOpenError) as error:
+        logger.error("Could not upload document to %s", ann_srv_url)
+        raise UploadError(error)
+    finally:
+        body.close()
 
     return result
 
 
+def submit_annotations_batches(ann_srv_url, annotations, batch_size=None,
+                               batch_bytes=None, nb_workers=NB_WORKERS,
+                               compression=None, task_report=None):
+    """
+    Call the Annotation Storage Service to save annotations in several
+    smaller requests sent concurrently.
+
+    Each batch is retried on its own as done by :py:func:`submit_annotations`.
+    Once a batch fails for good, no other batch is sent and the batches in
+    progress are awaited before raising.
+
+    :param ann_srv_url: URL of the annotation service where the annotations
+                        will be stored.
+    :param annotations: Iterable of annotations to append to the annotations
+                        Document.
+    :param batch_size: Maximal number of annotations per batch.
+    :param batch_bytes: Maximal size of the encoded annotations of a batch.
+    :param nb_workers: Number of batches sent concurrently.
+    :param compression: How the batches are compressed (see
+                        :py:func:`submit_annotations`).
+    :param task_report: Instance of :py:class:`~.Report.TaskReport` in which
+                        the delivery is recorded.
+    :returns: list of the responses of the annotation service, in batch order.
+    """
+    logger = logging.getLogger(__name__)
+    logger.info("Submitting annotations to target %s by batches of %s "
+                "annotations / %s bytes", ann_srv_url, batch_size,
+                batch_bytes)
+
+    futures = []
+    in_progress = set()
+    nb_annotations = 0
+    error = None
+    with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+        # Annotations encoded to measure the batches are not encoded again.
+        for batch in iter_batches(annotations, batch_size, batch_bytes,
+                                  encoded=bool(batch_bytes)):
+            if len(in_progress) >= nb_workers:
+                done, in_progress = wait(in_progress,
+                                         return_when=FIRST_COMPLETED)
+                error = next((f.exception() for f in done if f.exception()),
+                             None)
+                if error:
+                    break
+            nb_annotations += len(batch)
+            future = executor.submit(metrics.propagate(submit_annotations),
+                                     ann_srv_url, batch,
+                                     compression=compression)
+            futures.append(future)
+            in_progress.add(future)
+        wait(in_progress)
+
+    nb_failures = sum(1 for future in futures if future.exception())
+    logger.info("Submitted %s annotations in %s batches (%s failed)",
+                nb_annotations, len(futures), nb_failures)
+    if task_report is not None:
+        task_report.set_delivery(len(futures), nb_annotations, nb_failures)
+    error = error or next((f.exception() for f in futures if f.exception()),
+                          None)
+    if error:
+        raise error
+    return [future.result() for future in futures]
+
+
+class EncodedAnnotation(str):
+    """
+    JSON encoding of an annotation, which :py:func:`iter_payload` does not
+    encode again.
+    """
+
+
+def iter_batches(annotations, batch_size=None, batch_bytes=None,
+                 encoded=False):
+    """
+    Split annotations in batches.
+
+    :param annotations: Iterable of annotations.
+    :param batch_size: Maximal number of annotations per batch.
+    :param batch_bytes: Maximal size of the encoded annotations of a batch. A
+                        single annotation larger than this makes a batch of
+                        its own.
+    :param encoded: Yield the annotations as encoded to measure them
+                    (instances of :py:class:`EncodedAnnotation`) when
+                    batch_bytes is given.
+    :returns: Generator of lists of annotations.
+    """
+    encoder = json.JSONEncoder()
+    batch = []
+    size = 0
+    for annotation in annotations:
+        if batch_bytes:
+            text = encoder.encode(annotation)
+            length = len(text)
+            if encoded:
+                annotation = EncodedAnnotation(text)
+            if batch and size + length > batch_bytes:
+                yield batch
+                batch = []
+                size = 0
+            size += length
+        batch.append(annotation)
+        if batch_size and len(batch) >= batch_size:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+class _SpooledBody(object):
+    """
+    Request body kept in memory up to SPOOL_THRESHOLD bytes and in an
+    anonymous temporary file beyond.
+
+    Exposes a length and an iterator so that requests streams it with a
+    Content-Length without forcing it to disk.
+    """
+
+    def __init__(self):
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_THRESHOLD)
+        self.size = 0
+
+    def write(self, data):
+        self.spool.write(data)
+        self.size += len(data)
+
+    def rewind(self):
+        self.spool.seek(0)
+
+    def read(self, size=-1):
+        return self.spool.read(size)
+
+    def close(self):
+        self.spool.close()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        chunk = self.spool.read(CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = self.spool.read(CHUNK_SIZE)
+
+
+def iter_payload(annotations, common=None):
+    """
+    Encode the JSON document expected by the annotation service
+    incrementally.
+
+    :param annotations: Iterable of annotations, some of which may already
+                        be encoded (:py:class:`EncodedAnnotation`).
+    :param common: Values common to all annotations.
+    :returns: Generator of bytes, each holding at least CHUNK_SIZE bytes of
+              the document (save for the last one).
+    """
+    encoder = json.JSONEncoder()
+    parts = ['{"common": ', encoder.encode(common or {}), ', "data": [']
+    size = 0
+    separator = ''
+    for annotation in annotations:
+        if isinstance(annotation, EncodedAnnotation):
+            encoded = annotation
+        else:
+            encoded = encoder.encode(annotation)
+        parts.append(separator)
+        parts.append(encoded)
+        separator = ', '
+        size += len(encoded)
+        if size >= CHUNK_SIZE:
+            yield ''.join(parts).encode('utf-8')
+            parts = []
+            size = 0
+    parts.append(']}')
+    yield ''.join(parts).encode('utf-8')
+
+
+def _encode(chunks, compression):
+    """
+    Compress an encoded document into a spooled request body.
+
+    :param chunks: Iterable of bytes of the JSON document.
+    :param compression: One of COMPRESSIONS.
+    :returns: Instance of _SpooledBody.
+    """
+    body = _SpooledBody()
+    if compression == 'zip':
+        with zipfile.ZipFile(body.spool, "w",
+                             compression=zipfile.ZIP_DEFLATED) as zippy:
+            if sys.version_info >= (3, 6):
+                with zippy.open("annotations.txt", "w") as entry:
+                    for chunk in chunks:
+                        entry.write(chunk)
+            else:
+                # Zip entries can only be written at once before Python 3.6.
+                zippy.writestr("annotations.txt", b"".join(chunks))
+        body.size = body.spool.tell()
+    else:
+        compressor = _compressor(compression)
+        for chunk in chunks:
+            body.write(compressor.compress(chunk) if compressor else chunk)
+        if compressor:
+            body.write(compressor.flush())
+    return body
+
+
+def _compressor(compression):
+    """
+    :returns: Object with compress and flush methods producing a stream in the
+              given Content-Encoding, or None for no compression.
+    """
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+    return None
+
+
 def main():
     """
     Command line entry point to test upload of annotations.
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+This module offers asyncio counterparts of the downloading, uploading and
+annotation submission functions, so that a single event loop can handle many
+concurrent transfers.
+
+The functions behave as their blocking counterparts of
+:py:mod:`~.RemoteAccess` and :py:mod:`~.annotations_dispatcher` (same retry
+policy and circuit breakers, same exceptions, same
+:py:class:`~.Document.Document` results)
+and are backed by the optional `aiohttp <https://docs.aiohttp.org/>`_ package
+(``pip install VestaService[async]``). This module requires Python 3.5.3 or
+later, like aiohttp.
+
+The number of transfers in progress at any time on an event loop is bounded
+by CONCURRENCY.
+"""
+
+# --Standard lib modules------------------------------------------------------
+from tempfile import NamedTemporaryFile
+from logging import getLogger
+import asyncio
+import weakref
+import time
+import os
+
+# --3rd party modules----------------------------------------------------------
+import aiohttp
+
+# --Project specific----------------------------------------------------------
+from .service_exceptions import (DownloadError, UploadError,
+                                 InvalidAnnotationFormat, InvalidConfigType,
+                                 CircuitOpenError)
+from .annotations_dispatcher import (COMPRESSIONS, TEXT_TYPES, iter_payload,
+                                     _encode)
+from .Document import Document
+from . import RemoteAccess
+from . import metrics
+from . import retry
+
+TIMEOUT = RemoteAccess.TIMEOUT
+MAX_TRY = RemoteAccess.MAX_TRY
+# Maximal number of transfers in progress on an event loop.
+CONCURRENCY = 100
+# Retry policy of the requests sent by this module.
+RETRY_POLICY = retry.RetryPolicy(
+    max_try=MAX_TRY,
+    retry_exceptions=(asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+_LOOP_STATES = weakref.WeakKeyDictionary()
+
+
+class _LoopState(object):
+    """
+    Session and concurrency limiter shared by the transfers of a loop.
+    """
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(CONCURRENCY)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=CONCURRENCY))
+
+
+def _loop_state():
+    # Only called from coroutines, where it is the running loop
+    # (asyncio.get_running_loop requires Python 3.7).
+    loop = asyncio.get_event_loop()
+    state = _LOOP_STATES.get(loop)
+    if state is None or state.session.closed:
+        state = _LoopState()
+        _LOOP_STATES[loop] = state
+    return state
+
+
+def _client_timeout(timeout):
+    # Same meaning as the timeout of requests : connection and read timeouts.
+    return aiohttp.ClientTimeout(total=None, sock_connect=timeout,
+                                 sock_read=timeout)
+
+
+async def close():
+    """
+    Close the HTTP session of the running event loop.
+    """
+    state = _LOOP_STATES.pop(asyncio.get_event_loop(), None)
+    if state is not None:
+        await state.session.close()
+
+
+async def download(doc_msg, timeout=TIMEOUT, max_try=MAX_TRY):
+    """
+    Download a given document to a local file.
+    The calling function is responsible for the resulting file.
+
+    :param doc_msg: Dictionary containing the following keys:
+
+       :url: path to a distant document
+    :param timeout: Request timeout in seconds
+    :param max_try: Maximal number of tries
+    :returns: object of type Document.
+    """
+    logger = getLogger(__name__)
+    url = doc_msg['url']
+    logger.info("Getting remote document at %s", url)
+    extension = os.path.splitext(url)[-1]
+    state = _loop_state()
+    paths = []
+    progresses = []
+
+    async def get(url):
+        async with state.session.get(
+                url, timeout=_client_timeout(timeout)) as resp:
+            if resp.status in [200, 201]:
+                progress = RemoteAccess._Progress(resp.content_length, None)
+                progresses.append(progress)
+                with NamedTemporaryFile(mode='w+b',
+                                        prefix=RemoteAccess.temp_prefix(),
+                                        suffix=extension,
+                                        delete=False) as destination:
+                    paths.append(destination.name)
+                    async for chunk in resp.content.iter_chunked(
+                            RemoteAccess.CHUNK_SIZE):
+                        destination.write(chunk)
+                        progress.add(len(chunk), chunk)
+            return resp
+
+    start = time.time()
+    async with state.semaphore:
+        try:
+            try:
+                resp = await _call(RETRY_POLICY.with_max_try(max_try), get,
+                                   url)
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    CircuitOpenError) as error:
+                logger.error("Could not download document %s", url)
+                raise DownloadError(error)
+            if resp.status not in [200, 201]:
+                logger.error("Could not download document at URL %s."
+                             " Response code from the server : %s",
+                             url, resp.status)
+                raise DownloadError(("Could not download document at URL {}. "
+                                     "Response code from the server : {}")
+                                    .format(url, resp.status))
+        except DownloadError:
+            for path in paths:
+                os.remove(path)
+            raise
+    for path in paths[:-1]:
+        # Partial copies of failed tries.
+        os.remove(path)
+
+    doc = Document(url=url, path=paths[-1])
+    doc.length = progresses[-1].done
+    doc.sha256 = progresses[-1].hexdigest()
+    doc.transfer_duration = time.time() - start
+    metrics.observe(metrics.STAGE_SECONDS, doc.transfer_duration,
+                    stage='download')
+    metrics.inc(metrics.BYTES, doc.length, direction='download')
+    logger.info("Download of URL %s complete", doc.url)
+    logger.debug("Local copy name is : %s", doc.local_path)
+    return doc
+
+
+async def upload(doc, timeout=TIMEOUT, max_try=MAX_TRY):
+    """
+    Upload a given document from a local file.
+
+    This function is built to upload exclusively to the Vesta storage service.
+
+    :param doc: Instance of :py:class:`~.Document.Document` with valid values.
+    :param timeout: Request timeout in seconds
+    :param max_try: Maximal number of tries
+    :returns: Instance of :py:class:`~.Document.Document` with the URL updated
+       by the one that should be used to download the uploaded file.
+    """
+    logger = getLogger(__name__)
+    logger.info("Uploading document to remote URL %s", doc.url)
+    headers = {'Content-Type': 'application/octet-stream'}
+    state = _loop_state()
+    client_timeout = _client_timeout(timeout)
+    policy = RETRY_POLICY.with_max_try(max_try)
+    json_struct = {}
+
+    async def get(url):
+        async with state.session.get(
+                url, params={'filename': doc.filename()},
+                timeout=client_timeout) as resp:
+            if resp.status not in policy.retry_statuses:
+                resp.raise_for_status()
+                json_struct.update(await resp.json(content_type=None))
+            return resp
+
+    async def put(url):
+        # Send the whole content again on each try.
+        with doc.open() as file_handle:
+            async with state.session.put(
+                    url, headers=headers, data=file_handle, ssl=False,
+                    timeout=client_timeout) as resp:
+                return resp
+
+    start = time.time()
+    async with state.semaphore:
+        try:
+            resp = await _call(policy, get, doc.url)
+            resp.raise_for_status()
+            upload_url = json_struct['upload_url']
+            storage_doc_id = json_struct['storage_doc_id']
+            logger.info("Retrieved an upload temporary url for document "
+                        "%s : %s", upload_url, storage_doc_id)
+            resp = await _call(policy, put, upload_url)
+            resp.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                CircuitOpenError) as error:
+            logger.error("Could not upload document to %s", doc.url)
+            raise UploadError(error)
+
+    doc.length = doc.size()
+    doc.transfer_duration = time.time() - start
+    metrics.observe(metrics.STAGE_SECONDS, doc.transfer_duration,
+                    stage='upload')
+    metrics.inc(metrics.BYTES, doc.length, direction='upload')
+    logger.info("Upload to %s complete (%s bytes at %.1f kB/s), document can "
+                "be retrieved with id %s", upload_url, doc.length,
+                (doc.throughput() or 0) / 1024, storage_doc_id)
+    doc.url = storage_doc_id
+    return doc
+
+
+async def submit_annotations(ann_srv_url, annotations, send_zip=False,
+                             compression=None, timeout=TIMEOUT,
+                             max_try=MAX_TRY):
+    """
+    Call the Annotation Storage Service to save annotations.
+
+    The payload is encoded as done by
+    :py:func:`~.annotations_dispatcher.submit_annotations`.
+
+    :param ann_srv_url: URL of the annotation service where the annotations
+                        will be stored.
+    :param annotations: Annotations to append to the annotations Document,
+                        as a list or any other iterable.
+    :param send_zip: indicates if the annotations should be sent in a zip file
+                     (same as compression='zip').
+    :param compression: As for
+                        :py:func:`~.annotations_dispatcher.submit_annotations`.
+    :param timeout: Request timeout in seconds
+    :param max_try: Maximal number of tries
+    :type annotations: iterable
+    :returns: Response of the annotation service (its body is read).
+    """
+    logger = getLogger(__name__)
+    logger.info("Submitting annotations to target %s", ann_srv_url)
+
+    if isinstance(annotations, (dict,) + TEXT_TYPES) or \
+            not hasattr(annotations, '__iter__'):
+        raise InvalidAnnotationFormat("Annotations should be an object of type"
+                                      " list (or another iterable)")
+    if send_zip:
+        compression = 'zip'
+    if compression not in COMPRESSIONS:
+        raise InvalidConfigType("Unknown annotations compression : {}"
+                                .format(compression))
+
+    body = _encode(iter_payload(annotations), compression)
+    try:
+        body.rewind()
+        payload = body.read()
+    finally:
+        body.close()
+    logger.debug("Encoded payload has %s bytes", len(payload))
+
+    if compression == 'zip':
+        headers = {'accept': 'application/json'}
+    else:
+        headers = {'content-type': 'application/json',
+                   'accept': 'application/json'}
+        if compression:
+            headers['content-encoding'] = compression
+
+    state = _loop_state()
+
+    async def post(url):
+        if compression == 'zip':
+            data = aiohttp.FormData()
+            data.add_field('file', payload, filename='annotations.zip')
+        else:
+            data = payload
+        async with state.session.post(
+                url, data=data, headers=headers,
+                timeout=_client_timeout(timeout)) as resp:
+            await resp.read()
+            return resp
+
+    async with state.semaphore:
+        try:
+            with metrics.timer(metrics.STAGE_SECONDS, stage='annotations'):
+                resp = await _call(RETRY_POLICY.with_max_try(max_try), post,
+                                   ann_srv_url)
+            if resp.status not in [200, 201, 204]:
+                logger.error("Got following code : %s", resp.status)
+                resp.raise_for_status()
+            metrics.inc(metrics.BYTES, len(payload), direction='annotations')
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                CircuitOpenError) as error:
+            logger.error("Could not upload document to %s", ann_srv_url)
+            raise UploadError(error)
+    return resp
+
+
+async def _call(policy, func, url):
+    """
+    Asynchronous counterpart of :py:meth:`~.retry.RetryPolicy.call`.
+    """
+    breaker = policy.breaker(url)
+    cur_try = 1
+    while True:
+        if breaker:
+            breaker.before_call()
+        try:
+            resp = await func(url)
+        except policy.retry_exceptions as error:
+            delay = policy.on_error(error, url, cur_try, breaker)
+            if delay is None:
+                raise
+        except BaseException:
+            if breaker:
+                breaker.cancel_trial()
+            raise
+        else:
+            delay = policy.on_response(resp, url, cur_try, breaker)
+            if delay is None:
+                return resp
+        await asyncio.sleep(delay)
+        cur_try += 1
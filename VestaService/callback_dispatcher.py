@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+This module offers the background delivery of the completion callbacks of
+processing requests.
+
+Callbacks are queued by the worker when a task ends and batched by a
+:py:class:`CallbackDispatcher` thread, so that a slow or unreachable callback
+receiver never holds a worker slot. Batches are posted by a pool of
+nb_workers threads, one batch at a time per URL, so that a slow receiver
+does not delay the callbacks of the others. Posts have a timeout and are
+retried following a :py:class:`~.retry.RetryPolicy`. When batch_size is more
+than 1, the completions bound for the same URL within batch_interval seconds
+(or while the previous batch is posted) are posted together as a JSON list.
+
+At most max_pending callbacks wait to be sent : past that, new callbacks are
+dropped (and logged) rather than blocking the worker.
+"""
+
+# -- standard library --------------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Condition
+import logging
+import atexit
+import time
+import os
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:  # Python 2
+    from Queue import Queue, Empty, Full
+
+# -- third-party --------------------------------------------------------------
+from requests.exceptions import RequestException
+from celery.signals import worker_process_shutdown
+
+# -- project-specific --------------------------------------------------------
+from .service_exceptions import CircuitOpenError
+from .retry import RetryPolicy, MAX_TRY
+from . import http_session
+from . import metrics
+
+# -- Configuration ------------------------------------------------------------
+TIMEOUT = 10
+RETRY_POLICY = RetryPolicy(max_try=MAX_TRY)
+MAX_PENDING = 1000
+BATCH_SIZE = 1
+BATCH_INTERVAL = 0.5
+# Number of URLs to which callbacks are posted at once.
+NB_WORKERS = 4
+# Time given to the waiting callbacks to be sent when the process exits.
+SHUTDOWN_TIMEOUT = 5.
+
+_LOCK = Lock()
+_DISPATCHER = None
+_PID = None
+_FLUSH = object()
+_WAKE = object()
+
+
+class LatencyStats(object):
+    """
+    Time elapsed between the completion of tasks and the delivery of their
+    callbacks.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+        self.last = None
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+        self.last = latency
+
+    def mean(self):
+        """
+        :returns: Mean latency in seconds.
+        """
+        if not self.count:
+            return 0.
+        return self.total / self.count
+
+
+class CallbackDispatcher(object):
+    """
+    Background thread posting callbacks.
+    """
+
+    def __init__(self, timeout=TIMEOUT, retry_policy=RETRY_POLICY,
+                 max_pending=MAX_PENDING, batch_size=BATCH_SIZE,
+                 batch_interval=BATCH_INTERVAL, nb_workers=NB_WORKERS):
+        """
+        Constructor.
+
+        :param timeout: Request timeout in seconds.
+        :param retry_policy: Instance of :py:class:`~.retry.RetryPolicy`.
+        :param max_pending: Number of waiting callbacks over which new ones
+                            are dropped.
+        :param batch_size: Maximal number of completions posted together to
+                           the same URL.
+        :param batch_interval: Longest time in seconds a completion waits for
+                               others bound for the same URL.
+        :param nb_workers: Number of URLs to which callbacks are posted at
+                           once.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.timeout = timeout
+        self.retry_policy = retry_policy
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.latency = LatencyStats()
+        self.nb_sent = 0
+        self.nb_failed = 0
+        self.nb_dropped = 0
+        self.closed = False
+        self._batches = {}
+        # URLs to which a batch is being posted.
+        self._posting = set()
+        self._forced = False
+        self._unfinished = 0
+        self._condition = Condition()
+        self._queue = Queue(maxsize=max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=nb_workers)
+        self._thread = Thread(target=self._run, name='callback-dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def send(self, url, payload, service_type=None):
+        """
+        Queue a callback.
+
+        :param url: URL to which the payload is posted.
+        :param payload: JSON serializable payload.
+        :param service_type: Service type with which the metrics of the
+                             callback are labelled.
+        :returns: False if the callback was dropped.
+        """
+        if self.closed:
+            self.logger.error("Dropping callback to %s : dispatcher is "
+                              "closed", url)
+            self._drop(service_type)
+            return False
+        with self._condition:
+            self._unfinished += 1
+        try:
+            self._queue.put_nowait((url, payload, time.time(), service_type))
+        except Full:
+            self._done(1)
+            self.logger.error("Dropping callback to %s : %s callbacks are "
+                              "already waiting", url, self._queue.maxsize)
+            self._drop(service_type)
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Send the waiting callbacks at once and wait for their delivery.
+
+        :param timeout: Maximal time to wait in seconds.
+        :returns: True if no callback remains to be sent.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            self._queue.put(_FLUSH, timeout=timeout)
+        except Full:
+            return False
+        with self._condition:
+            while self._unfinished:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Send the waiting callbacks and stop the dispatcher.
+
+        :param timeout: Maximal time to wait in seconds.
+        """
+        if self.closed:
+            return
+        self.flush(timeout)
+        self.closed = True
+        try:
+            self._queue.put_nowait(None)
+        except Full:
+            pass
+        self.logger.info("Callback dispatcher closed after sending %s "
+                         "callbacks (%s failed, %s dropped), mean latency "
+                         "%.3fs", self.nb_sent, self.nb_failed,
+                         self.nb_dropped, self.latency.mean())
+
+    def _drop(self, service_type):
+        self.nb_dropped += 1
+        metrics.inc(metrics.CALLBACKS, outcome='dropped',
+                    service_type=service_type)
+
+    def _done(self, count):
+        with self._condition:
+            self._unfinished -= count
+            self._condition.notify_all()
+
+    def _run(self):
+        closing = False
+        while True:
+            try:
+                item = self._queue.get(timeout=self._next_timeout())
+            except Empty:
+                item = _WAKE
+            if item is None:
+                closing = self._forced = True
+            elif item is _FLUSH:
+                # Until the waiting callbacks are all posted.
+                self._forced = True
+            elif item is not _WAKE:
+                self._batches.setdefault(item[0], []).append(item)
+            self._send_batches()
+            if not self._batches:
+                self._forced = False
+                if closing:
+                    self._executor.shutdown(wait=True)
+                    return
+
+    def _next_timeout(self):
+        """
+        :returns: Time until the oldest batch which can be posted is due, or
+                  None to wait for the next item.
+        """
+        with self._condition:
+            times = [batch[0][2] for url, batch in self._batches.items()
+                     if url not in self._posting]
+        if not times:
+            return None
+        return max(min(times) + self.batch_interval - time.time(), 0)
+
+    def _send_batches(self):
+        now = time.time()
+        for url, batch in list(self._batches.items()):
+            with self._condition:
+                if url in self._posting:
+                    # Sent once the previous batch is posted.
+                    continue
+            if self._forced or len(batch) >= self.batch_size or \
+                    now - batch[0][2] >= self.batch_interval:
+                del self._batches[url]
+                with self._condition:
+                    self._posting.add(url)
+                self._executor.submit(self._post_batch, url, batch)
+
+    def _post_batch(self, url, batch):
+        try:
+            self._post(url, batch)
+        finally:
+            with self._condition:
+                self._posting.discard(url)
+            self._done(len(batch))
+            try:
+                # The next batch bound for the URL may be waiting.
+                self._queue.put_nowait(_WAKE)
+            except Full:
+                pass
+
+    def _post(self, url, batch):
+        if self.batch_size > 1:
+            payload = [item[1] for item in batch]
+        else:
+            payload = batch[0][1]
+        session = http_session.get_session(url)
+        metrics.set_service_type(batch[0][3])
+        try:
+            res = self.retry_policy.call(session.post, url, json=payload,
+                                         timeout=self.timeout)
+            res.raise_for_status()
+        except (RequestException, CircuitOpenError) as exc:
+            self._failed(batch)
+            self.logger.error("Could not complete callback to %s : %s", url,
+                              exc)
+            return
+        except Exception:
+            self._failed(batch)
+            self.logger.exception("Could not complete callback to %s", url)
+            return
+        now = time.time()
+        for item in batch:
+            metrics.observe(metrics.STAGE_SECONDS, now - item[2],
+                            stage='callback', service_type=item[3])
+            metrics.inc(metrics.CALLBACKS, outcome='sent',
+                        service_type=item[3])
+        with self._condition:
+            for item in batch:
+                self.latency.add(now - item[2])
+            self.nb_sent += len(batch)
+        self.logger.debug("Delivered %s callbacks to %s", len(batch), url)
+
+    def _failed(self, batch):
+        with self._condition:
+            self.nb_failed += len(batch)
+        for item in batch:
+            metrics.inc(metrics.CALLBACKS, outcome='failed',
+                        service_type=item[3])
+
+
+def get_dispatcher():
+    """
+    :returns: The :py:class:`CallbackDispatcher` of the current process.
+    """
+    global _DISPATCHER, _PID
+    with _LOCK:
+        if _DISPATCHER is None or _PID != os.getpid():
+            # A forked process does not inherit the thread of its parent.
+            _DISPATCHER = CallbackDispatcher(
+                timeout=TIMEOUT, retry_policy=RETRY_POLICY,
+                max_pending=MAX_PENDING, batch_size=BATCH_SIZE,
+                batch_interval=BATCH_INTERVAL, nb_workers=NB_WORKERS)
+            _PID = os.getpid()
+        return _DISPATCHER
+
+
+def send_callback(url, payload, service_type=None):
+    """
+    Queue a callback on the dispatcher of the current process.
+
+    :param url: URL to which the payload is posted.
+    :param payload: JSON serializable payload.
+    :param service_type: Service type with which the metrics of the callback
+                         are labelled.
+    :returns: False if the callback was dropped.
+    """
+    return get_dispatcher().send(url, payload, service_type=service_type)
+
+
+@worker_process_shutdown.connect
+def shutdown(**kwargs):
+    """
+    Give the waiting callbacks of the current process a chance to be sent.
+    """
+    global _DISPATCHER
+    with _LOCK:
+        dispatcher = _DISPATCHER if _PID == os.getpid() else None
+        _DISPATCHER = None
+    if dispatcher is not None:
+        dispatcher.close(SHUTDOWN_TIMEOUT)
+
+
+atexit.register(shutdown)
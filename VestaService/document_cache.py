@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+This module offers an on-disk cache of remote documents shared by all the
+worker processes of a host.
+
+Entries are keyed by the document URL along with its ``ETag`` and
+``Last-Modified`` validators so that a cached copy can be revalidated with a
+conditional GET. The cache is bounded in size and evicts its least recently
+used entries first.
+
+Each :py:class:`~.Document.Document` obtained from the cache holds a
+reference on its local copy, materialized as a holder file, so that a file in
+use by a task (of this process or of another one) is never evicted. The
+reference is released by :py:func:`release`, which is what
+:py:func:`~.RemoteAccess.cleanup` does for such documents.
+
+Directory layout::
+
+   <cache_dir>/<url key>.json         Current version of a URL.
+   <cache_dir>/<data key><extension>  Cached copy.
+   <cache_dir>/<data key>.meta        Description of the cached copy.
+   <cache_dir>/<data key>.refs/       One holder file per reference.
+"""
+
+# --Standard lib modules------------------------------------------------------
+from logging import getLogger
+import threading
+import hashlib
+import tempfile
+import shutil
+import errno
+import json
+import uuid
+import os
+
+try:
+    import fcntl
+except ImportError:  # Not a POSIX platform, only serialize local threads.
+    fcntl = None
+
+# --Project specific----------------------------------------------------------
+from .Document import Document
+
+# -- Configuration ------------------------------------------------------------
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'vesta_document_cache')
+MAX_BYTES = 10 * 1024 ** 3
+
+
+class CacheEntry(object):
+    """
+    Cached version of a URL, on which a reference is held until it is either
+    validated or discarded.
+    """
+
+    def __init__(self, url, data_key, path, etag, last_modified, ref):
+        self.url = url
+        self.data_key = data_key
+        self.path = path
+        self.etag = etag
+        self.last_modified = last_modified
+        self.ref = ref
+
+    def conditional_headers(self):
+        """
+        :returns: Headers turning a GET on the URL into a revalidation.
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class DocumentCache(object):
+    """
+    Size-bounded, reference counted, least recently used cache of documents.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+        """
+        Constructor.
+
+        :param cache_dir: Directory holding the cached documents. Workers
+                          sharing this directory share their documents.
+        :param max_bytes: Total size over which unused entries are evicted.
+        """
+        self.logger = getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._thread_lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    def stats(self):
+        """
+        :returns: dict with the hits, misses and evictions counted by this
+                  process.
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def lookup(self, url):
+        """
+        Find the cached version of a URL and hold a reference on it.
+
+        :param url: URL of the document.
+        :returns: Instance of :py:class:`CacheEntry` or None if the URL is not
+                  cached.
+        """
+        with self._lock():
+            index = self._read_json(self._index_path(url))
+            if index is None:
+                return None
+            meta = self._read_json(self._meta_path(index['data_key']))
+            path = self._data_path(index['data_key'], index['extension'])
+            if meta is None or not os.path.exists(path):
+                return None
+            ref = self._add_ref(index['data_key'])
+        return CacheEntry(url, index['data_key'], path, meta['etag'],
+                          meta['last_modified'], ref)
+
+    def validated(self, entry):
+        """
+        Turn an entry confirmed by the server into a document.
+
+        :param entry: Entry obtained through :py:meth:`lookup`.
+        :returns: Instance of :py:class:`~.Document.Document`.
+        """
+        self.hits += 1
+        self._touch(self._meta_path(entry.data_key))
+        self.logger.info("Using cached copy %s of %s", entry.path, entry.url)
+        doc = Document(url=entry.url, path=entry.path)
+        doc.cache_ref = entry.ref
+        return doc
+
+    def discard(self, entry):
+        """
+        Release an entry which turned out to be stale.
+
+        :param entry: Entry obtained through :py:meth:`lookup`.
+        """
+        self._remove(entry.ref)
+
+    def store(self, url, path, headers):
+        """
+        Move a freshly downloaded document into the cache.
+
+        Responses without validators cannot be revalidated and are left where
+        they are.
+
+        :param url: URL of the document.
+        :param path: Local path of the downloaded copy. Must reside in the
+                     cache directory.
+        :param headers: Response headers of the download.
+        :returns: Instance of :py:class:`~.Document.Document`.
+        """
+        self.misses += 1
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            self.logger.debug("No validator for %s, not caching it", url)
+            return Document(url=url, path=path)
+
+        data_key = self._key(url, etag or '', last_modified or '')
+        extension = os.path.splitext(path)[-1]
+        data_path = self._data_path(data_key, extension)
+        size = os.path.getsize(path)
+        with self._lock():
+            if os.path.exists(data_path):
+                # Another worker cached the same version meanwhile.
+                os.remove(path)
+            else:
+                os.rename(path, data_path)
+            self._write_json(self._meta_path(data_key),
+                             {'url': url,
+                              'etag': etag,
+                              'last_modified': last_modified,
+                              'extension': extension,
+                              'size': size})
+            self._write_json(self._index_path(url),
+                             {'data_key': data_key,
+                              'extension': extension})
+            ref = self._add_ref(data_key)
+            self._evict()
+        doc = Document(url=url, path=data_path)
+        doc.cache_ref = ref
+        return doc
+
+    def _evict(self):
+        """
+        Remove unused entries, least recently used first, until the cache
+        fits in its size budget. Must be called with the lock held.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.meta'):
+                continue
+            meta_path = os.path.join(self.cache_dir, name)
+            meta = self._read_json(meta_path)
+            if meta is None:
+                continue
+            total += meta['size']
+            entries.append((os.path.getmtime(meta_path), name[:-5], meta))
+
+        for _, data_key, meta in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            if self._has_refs(data_key):
+                continue
+            self.logger.debug("Evicting cached copy of %s", meta['url'])
+            self._remove(self._data_path(data_key, meta['extension']))
+            self._remove(self._meta_path(data_key))
+            shutil.rmtree(self._refs_path(data_key), ignore_errors=True)
+            index_path = self._index_path(meta['url'])
+            index = self._read_json(index_path)
+            if index and index['data_key'] == data_key:
+                self._remove(index_path)
+            total -= meta['size']
+            self.evictions += 1
+
+    def _add_ref(self, data_key):
+        refs_path = self._refs_path(data_key)
+        if not os.path.isdir(refs_path):
+            os.mkdir(refs_path)
+        ref = os.path.join(refs_path, '{}-{}'.format(os.getpid(),
+                                                     uuid.uuid4().hex))
+        open(ref, 'w').close()
+        return ref
+
+    def _has_refs(self, data_key):
+        """
+        Tell whether a cached copy is in use, forgetting the references held
+        by processes which no longer exist.
+        """
+        refs_path = self._refs_path(data_key)
+        if not os.path.isdir(refs_path):
+            return False
+        in_use = False
+        for name in os.listdir(refs_path):
+            pid = int(name.split('-')[0])
+            if pid_exists(pid):
+                in_use = True
+            else:
+                self._remove(os.path.join(refs_path, name))
+        return in_use
+
+    def _lock(self):
+        return _CacheLock(os.path.join(self.cache_dir, '.lock'),
+                          self._thread_lock)
+
+    def _index_path(self, url):
+        return os.path.join(self.cache_dir, self._key(url) + '.json')
+
+    def _meta_path(self, data_key):
+        return os.path.join(self.cache_dir, data_key + '.meta')
+
+    def _refs_path(self, data_key):
+        return os.path.join(self.cache_dir, data_key + '.refs')
+
+    def _data_path(self, data_key, extension):
+        return os.path.join(self.cache_dir, data_key + extension)
+
+    @staticmethod
+    def _key(*parts):
+        return hashlib.sha256(
+            '\0'.join(parts).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path) as json_file:
+                return json.load(json_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_json(path, obj):
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'w') as json_file:
+            json.dump(obj, json_file)
+        os.rename(temp_path, path)
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _CacheLock(object):
+    """
+    Lock serializing cache updates among the threads and processes of a host.
+    """
+
+    def __init__(self, path, thread_lock):
+        self.path = path
+        self.thread_lock = thread_lock
+        self.handle = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if fcntl is not None:
+            self.handle = open(self.path, 'a')
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.handle is not None:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+            self.handle.close()
+            self.handle = None
+        self.thread_lock.release()
+
+
+def release(doc):
+    """
+    Release the reference a document holds on its cached copy.
+
+    :param doc: Document obtained from a cache.
+    """
+    if doc.cache_ref:
+        DocumentCache._remove(doc.cache_ref)
+        doc.cache_ref = None
+
+
+def pid_exists(pid):
+    """
+    :param pid: Process id.
+    :returns: True if a process with this id is running on this host.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+This module offers a registry of pooled, keep-alive HTTP sessions shared by
+all remote calls issued from a worker process.
+
+One :py:class:`requests.Session` is kept per remote host (scheme and network
+location) so that consecutive documents, annotation submissions and callbacks
+going to the same host reuse their TCP and TLS connections instead of paying
+for a new handshake each time.
+
+The registry is fork safe: a child process created after sessions were opened
+(as is the case with the Celery prefork pool) never reuses the sockets of its
+parent and builds its own sessions on first use.
+"""
+
+# --Standard lib modules------------------------------------------------------
+from logging import getLogger
+import threading
+import os
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+
+# --3rd party modules----------------------------------------------------------
+import requests
+from requests.adapters import HTTPAdapter
+
+# -- Configuration ------------------------------------------------------------
+# Number of distinct connection pools cached by each host session (redirects
+# can lead a session to other hosts).
+POOL_CONNECTIONS = 10
+# Default number of connections kept alive for a single host.
+POOL_MAXSIZE = 10
+# Block when the pool of a host is exhausted instead of opening a throw-away
+# connection.
+POOL_BLOCK = False
+# Per-host override of POOL_MAXSIZE, keyed by network location
+# (e.g. {'jass.example.com:8080': 20}).
+HOST_POOL_SIZES = {}
+
+_LOCK = threading.Lock()
+_SESSIONS = {}
+_PID = os.getpid()
+
+
+def configure(pool_maxsize=None, pool_connections=None, pool_block=None,
+              host_pool_sizes=None):
+    """
+    Change the pool configuration of the sessions.
+
+    Sessions already opened are discarded so that the new values apply to all
+    subsequent calls.
+
+    :param pool_maxsize: Default number of connections kept per host.
+    :param pool_connections: Number of connection pools cached per session.
+    :param pool_block: Whether to block when a host pool is exhausted.
+    :param host_pool_sizes: Dictionary of per-host pool sizes keyed by network
+                            location (host[:port]).
+    """
+    global POOL_MAXSIZE, POOL_CONNECTIONS, POOL_BLOCK
+    if pool_maxsize is not None:
+        POOL_MAXSIZE = pool_maxsize
+    if pool_connections is not None:
+        POOL_CONNECTIONS = pool_connections
+    if pool_block is not None:
+        POOL_BLOCK = pool_block
+    if host_pool_sizes is not None:
+        HOST_POOL_SIZES.update(host_pool_sizes)
+    reset()
+
+
+def get_session(url):
+    """
+    Obtain the shared session used to reach the host of a given URL.
+
+    :param url: Any URL on the target host.
+    :returns: Instance of :py:class:`requests.Session`.
+    """
+    _check_pid()
+    parts = urlsplit(url)
+    key = '{}://{}'.format(parts.scheme, parts.netloc)
+    session = _SESSIONS.get(key)
+    if session is None:
+        with _LOCK:
+            session = _SESSIONS.get(key)
+            if session is None:
+                session = _new_session(parts.scheme, parts.netloc)
+                _SESSIONS[key] = session
+    return session
+
+
+def reset():
+    """
+    Close and forget every session of the current process.
+    """
+    with _LOCK:
+        sessions = list(_SESSIONS.values())
+        _SESSIONS.clear()
+    for session in sessions:
+        session.close()
+
+
+def connection_stats():
+    """
+    Report the connection reuse of the sessions opened by this process.
+
+    :returns: dict with the following keys:
+
+       :requests: Number of HTTP requests sent.
+       :connections: Number of connections that had to be opened.
+       :reused: Number of requests which were sent on an already opened
+                connection.
+    """
+    _check_pid()
+    nb_requests = 0
+    nb_connections = 0
+    with _LOCK:
+        sessions = list(_SESSIONS.values())
+    for session in sessions:
+        for adapter in session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                nb_requests += pool.num_requests
+                nb_connections += pool.num_connections
+    return {'requests': nb_requests,
+            'connections': nb_connections,
+            'reused': max(nb_requests - nb_connections, 0)}
+
+
+def _new_session(scheme, netloc):
+    """
+    Build a session whose adapters use the pool size configured for a host.
+    """
+    logger = getLogger(__name__)
+    maxsize = HOST_POOL_SIZES.get(netloc, POOL_MAXSIZE)
+    logger.debug("Opening HTTP session for %s://%s with a pool of %s "
+                 "connections", scheme, netloc, maxsize)
+    session = requests.Session()
+    # Connection: keep-alive is the default of requests sessions, but be
+    # explicit as it is the whole point of this registry.
+    session.headers['Connection'] = 'keep-alive'
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                          pool_maxsize=maxsize,
+                                          pool_block=POOL_BLOCK))
+    return session
+
+
+def _check_pid():
+    """
+    Drop sessions inherited from a parent process.
+    """
+    if _PID != os.getpid():
+        _after_fork()
+
+
+def _after_fork():
+    """
+    Forget the sessions of the parent process without closing their sockets
+    which are still in use by the parent.
+    """
+    global _LOCK, _PID
+    _LOCK = threading.Lock()
+    _SESSIONS.clear()
+    _PID = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+This module offers the instrumentation of the workers : the duration of each
+stage of the processing of a request (download, processing, update_state
+calls, annotations submission, upload, callback), the bytes transferred, the
+retries and the completed tasks are recorded as histograms and counters
+labelled by service type.
+
+Metrics are kept in memory by the process recording them, at the cost of a
+dictionary lookup under a lock per record. They are exposed in the
+Prometheus text format by :py:func:`render`, which :py:func:`start_http_server`
+serves over HTTP, and are forwarded as they are recorded to the sinks
+registered with :py:func:`add_sink` (e.g. a StatsD client)::
+
+    metrics.start_http_server(9191)
+
+Each process has its own metrics : with the prefork pool, either start an
+endpoint on a distinct port in each pool process (worker_process_init
+signal) or forward the metrics to a sink. Setting ENABLED to False turns
+the instrumentation off.
+"""
+
+# -- standard library --------------------------------------------------------
+from contextlib import contextmanager
+import functools
+import threading
+import logging
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# -- project-specific --------------------------------------------------------
+from .Report import LatencyHistogram
+
+# -- Configuration ------------------------------------------------------------
+ENABLED = True
+PORT = 9191
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metric names.
+STAGE_SECONDS = 'vesta_stage_duration_seconds'
+BYTES = 'vesta_transferred_bytes_total'
+RETRIES = 'vesta_retries_total'
+TASKS = 'vesta_tasks_total'
+CALLBACKS = 'vesta_callbacks_total'
+
+HELP = {
+    STAGE_SECONDS: "Duration of the stages of the processing of requests.",
+    BYTES: "Bytes transferred, by direction.",
+    RETRIES: "Remote calls tried again, by reason.",
+    TASKS: "Completed tasks, by final state.",
+    CALLBACKS: "Completion callbacks, by outcome.",
+}
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+_LOCK = threading.Lock()
+_COUNTERS = {}
+_HISTOGRAMS = {}
+_SINKS = []
+_CONTEXT = threading.local()
+
+
+def set_service_type(service_type):
+    """
+    Set the service type with which the metrics recorded by the current
+    thread are labelled.
+
+    :param service_type: Service type of the request being processed.
+    """
+    _CONTEXT.service_type = service_type
+
+
+def get_service_type():
+    """
+    :returns: The service type of the metrics recorded by the current thread.
+    """
+    return getattr(_CONTEXT, 'service_type', None)
+
+
+def propagate(func):
+    """
+    :param func: Function called in another thread (e.g. by an executor).
+    :returns: A wrapper of func recording its metrics with the service type
+              of the current thread.
+    """
+    service_type = get_service_type()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        set_service_type(service_type)
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def inc(name, amount=1, **labels):
+    """
+    Increment a counter.
+
+    :param name: Name of the counter.
+    :param amount: Increment.
+    :param labels: Labels of the counter. service_type defaults to the one of
+                   the current thread.
+    """
+    if not ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + amount
+    if _SINKS:
+        _notify(COUNTER, name, amount, key[1])
+
+
+def observe(name, value, **labels):
+    """
+    Add a value to a histogram.
+
+    :param name: Name of the histogram.
+    :param value: Observed value (duration in seconds).
+    :param labels: Labels of the histogram. service_type defaults to the one
+                   of the current thread.
+    """
+    if not ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _LOCK:
+        histogram = _HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = _HISTOGRAMS[key] = LatencyHistogram()
+        histogram.add(value)
+    if _SINKS:
+        _notify(HISTOGRAM, name, value, key[1])
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Context manager adding the duration of its block to a histogram, even if
+    the block raises.
+
+    :param name: Name of the histogram.
+    :param labels: Labels of the histogram.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def add_sink(sink):
+    """
+    Forward the metrics to a sink as they are recorded. Sinks are called by
+    the recording thread and must thus be quick.
+
+    :param sink: Object with a record(kind, name, value, labels) method,
+                 kind being COUNTER (value is an increment) or HISTOGRAM and
+                 labels a dict.
+    """
+    _SINKS.append(sink)
+
+
+def remove_sink(sink):
+    """
+    Stop forwarding the metrics to a sink.
+    """
+    _SINKS.remove(sink)
+
+
+def reset():
+    """
+    Forget the recorded metrics.
+    """
+    with _LOCK:
+        _COUNTERS.clear()
+        _HISTOGRAMS.clear()
+
+
+def render():
+    """
+    :returns: The recorded metrics in the Prometheus text format.
+    """
+    with _LOCK:
+        counters = sorted(_COUNTERS.items())
+        histograms = sorted(
+            (key, (histogram.buckets, list(histogram.counts),
+                   histogram.total, histogram.count))
+            for key, histogram in _HISTOGRAMS.items())
+    lines = []
+    last_name = None
+    for (name, labels), value in counters:
+        if name != last_name:
+            _header(lines, name, COUNTER)
+            last_name = name
+        lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                      _format_value(value)))
+    for (name, labels), (buckets, counts, total, count) in histograms:
+        if name != last_name:
+            _header(lines, name, HISTOGRAM)
+            last_name = name
+        cumulated = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulated += bucket_count
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels + (('le', repr(bound)),)),
+                cumulated))
+        lines.append('{}_bucket{} {}'.format(
+            name, _format_labels(labels + (('le', '+Inf'),)), count))
+        lines.append('{}_sum{} {}'.format(name, _format_labels(labels),
+                                          _format_value(total)))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels),
+                                            count))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics on /metrics (and /).
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # Scrapes are too frequent to be logged.
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port=PORT, addr=''):
+    """
+    Serve the metrics of the current process over HTTP from a background
+    thread.
+
+    :param port: Port to listen on (0 : any free port).
+    :param addr: Address to listen on (all by default).
+    :returns: The HTTP server, whose shutdown method stops it.
+    """
+    server = _ThreadingHTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    logging.getLogger(__name__).info("Serving metrics on port %s",
+                                     server.server_address[1])
+    return server
+
+
+def _labels(labels):
+    if labels.get('service_type') is None:
+        labels['service_type'] = get_service_type() or ''
+    return tuple(sorted(labels.items()))
+
+
+def _notify(kind, name, value, labels):
+    for sink in list(_SINKS):
+        try:
+            sink.record(kind, name, value, dict(labels))
+        except Exception as exc:
+            logging.getLogger(__name__).debug("Metrics sink %s failed : %s",
+                                              sink, exc)
+
+
+def _header(lines, name, kind):
+    if name in HELP:
+        lines.append('# HELP {} {}'.format(name, HELP[name]))
+    lines.append('# TYPE {} {}'.format(name, kind))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+This module offers a pipelined worker mode, in which the documents of the
+tasks reserved by a worker are downloaded in the background while the
+current task is processed, so that network transfers overlap computation.
+
+Once enabled with :py:func:`enable`, a :py:class:`DocumentPrefetcher` starts
+downloading the document of each task as soon as the worker receives it
+(Celery ``task_received`` signal, see the worker_prefetch_multiplier
+setting) and :py:class:`~.request.Request` claims the prefetched
+:py:class:`~.Document.Document` instead of downloading it. At most
+nb_workers documents are downloaded at once and prefetching pauses while the
+unclaimed documents (including those being downloaded) use more than
+disk_budget bytes.
+
+The hand-off of a Document happens within a process, which is the case with
+the thread, gevent, eventlet and solo pools. With the prefork pool, tasks are
+received by the parent process : prefetching there is only useful along with
+a :py:class:`~.document_cache.DocumentCache` (RemoteAccess.DOCUMENT_CACHE),
+into which documents are prefetched so that the pool processes only have to
+revalidate them.
+"""
+
+# -- standard library --------------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import threading
+import logging
+import time
+import os
+
+# -- third-party --------------------------------------------------------------
+from celery.signals import task_received, task_revoked
+
+# -- project-specific --------------------------------------------------------
+from . import RemoteAccess
+
+# -- Configuration ------------------------------------------------------------
+NB_WORKERS = 2
+DISK_BUDGET = 2 * 1024 * 1024 * 1024
+# Time in seconds after which an unclaimed document is removed.
+MAX_AGE = 600.
+
+# Instance of DocumentPrefetcher of the worker, set by enable.
+PREFETCHER = None
+
+
+class _Prefetch(object):
+    """
+    Download of the document of a task.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.future = None
+        self.size = 0
+
+
+class DocumentPrefetcher(object):
+    """
+    Background download of the documents of upcoming tasks.
+    """
+
+    def __init__(self, nb_workers=NB_WORKERS, disk_budget=DISK_BUDGET,
+                 max_age=MAX_AGE, download_options=None):
+        """
+        Constructor.
+
+        :param nb_workers: Number of documents downloaded at once.
+        :param disk_budget: Size in bytes of the unclaimed documents over
+                            which no more documents are prefetched.
+        :param max_age: Time in seconds after which an unclaimed document is
+                        removed.
+        :param download_options: Keyword arguments passed along to
+                                 :py:func:`~.RemoteAccess.download`.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.disk_budget = disk_budget
+        self.max_age = max_age
+        self.download_options = download_options or {}
+        self.pid = os.getpid()
+        self.disk_usage = 0
+        self.nb_prefetched = 0
+        self.nb_claimed = 0
+        self.nb_skipped = 0
+        self.nb_failed = 0
+        self.nb_expired = 0
+        self._prefetches = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=nb_workers)
+
+    def prefetch(self, task_id, doc_msg):
+        """
+        Start downloading the document of a task.
+
+        :param task_id: UUID of the task.
+        :param doc_msg: Document part of the request message of the task.
+        :returns: False if the document is not prefetched.
+        """
+        with self._lock:
+            self._expire()
+            if task_id in self._prefetches:
+                return True
+            if self.disk_usage >= self.disk_budget:
+                self.logger.debug("Not prefetching %s : disk budget of %s "
+                                  "bytes is used", doc_msg['url'],
+                                  self.disk_budget)
+                self.nb_skipped += 1
+                return False
+            prefetch = _Prefetch()
+            self._prefetches[task_id] = prefetch
+            prefetch.future = self._executor.submit(self._download, task_id,
+                                                    prefetch, doc_msg)
+        return True
+
+    def claim(self, task_id, timeout=None):
+        """
+        Obtain the prefetched document of a task, waiting for the end of its
+        download if needed. The caller is responsible for the document.
+
+        :param task_id: UUID of the task.
+        :param timeout: Maximal time to wait for the download in seconds.
+        :returns: Instance of :py:class:`~.Document.Document` or None if the
+                  document was not prefetched by this process.
+        """
+        if os.getpid() != self.pid:
+            # Forked processes do not inherit the download threads.
+            return None
+        with self._lock:
+            prefetch = self._prefetches.get(task_id)
+        if prefetch is None:
+            return None
+        try:
+            doc = prefetch.future.result(timeout)
+        except FutureTimeoutError:
+            self.logger.warning("Prefetching of the document of task %s is "
+                                "too slow, downloading it again", task_id)
+            self.discard(task_id)
+            return None
+        with self._lock:
+            if self._prefetches.pop(task_id, None) is None:
+                # Discarded meanwhile.
+                return None
+            self.disk_usage -= prefetch.size
+            if doc is not None:
+                self.nb_claimed += 1
+        return doc
+
+    def discard(self, task_id):
+        """
+        Remove the prefetched document of a task which will not be processed.
+
+        :param task_id: UUID of the task.
+        """
+        with self._lock:
+            prefetch = self._prefetches.pop(task_id, None)
+        if prefetch is not None:
+            prefetch.future.add_done_callback(self._remove)
+            with self._lock:
+                self.disk_usage -= prefetch.size
+
+    def close(self):
+        """
+        Wait for the downloads in progress and remove the unclaimed
+        documents.
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            prefetches = list(self._prefetches.values())
+            self._prefetches.clear()
+            self.disk_usage = 0
+        for prefetch in prefetches:
+            self._remove(prefetch.future)
+
+    def _download(self, task_id, prefetch, doc_msg):
+        options = dict(self.download_options)
+        callback = options.get('progress_callback')
+
+        def progress_callback(downloaded, total):
+            # Documents being downloaded use the budget too.
+            self._resize(task_id, prefetch, max(downloaded, total or 0))
+            if callback:
+                callback(downloaded, total)
+        options['progress_callback'] = progress_callback
+
+        try:
+            doc = RemoteAccess.download(doc_msg, **options)
+        except Exception as exc:
+            self.logger.warning("Could not prefetch %s : %s", doc_msg['url'],
+                                exc)
+            self._resize(task_id, prefetch, 0)
+            with self._lock:
+                self.nb_failed += 1
+            return None
+        if doc.cache_ref:
+            # The document stays in the cache, from which any process
+            # obtains it : do not hold it.
+            RemoteAccess.cleanup(doc)
+            doc = None
+        if doc is None:
+            size = 0
+        elif doc.length is not None:
+            size = doc.length
+        else:
+            size = os.path.getsize(doc.local_path)
+        self._resize(task_id, prefetch, size)
+        with self._lock:
+            self.nb_prefetched += 1
+        return doc
+
+    def _resize(self, task_id, prefetch, size):
+        """
+        Update the disk usage of a document which is still unclaimed.
+        """
+        with self._lock:
+            if self._prefetches.get(task_id) is prefetch:
+                self.disk_usage += size - prefetch.size
+                prefetch.size = size
+
+    def _expire(self):
+        """
+        Remove the documents unclaimed for max_age seconds. Must be called
+        with the lock held.
+        """
+        deadline = time.time() - self.max_age
+        for task_id, prefetch in list(self._prefetches.items()):
+            if prefetch.start_time < deadline and prefetch.future.done():
+                del self._prefetches[task_id]
+                self.disk_usage -= prefetch.size
+                self.nb_expired += 1
+                self._remove(prefetch.future)
+
+    def _remove(self, future):
+        try:
+            doc = future.result()
+        except Exception:
+            return
+        if doc is not None:
+            RemoteAccess.cleanup(doc)
+
+
+def enable(nb_workers=NB_WORKERS, disk_budget=DISK_BUDGET, max_age=MAX_AGE,
+           **download_options):
+    """
+    Enable the pipelined mode in the current worker process, in which the
+    documents of the received tasks are prefetched.
+
+    :param nb_workers: Number of documents downloaded at once.
+    :param disk_budget: Size in bytes of the unclaimed documents over which
+                        no more documents are prefetched.
+    :param max_age: Time in seconds after which an unclaimed document is
+                    removed.
+    :param download_options: Keyword arguments passed along to
+                             :py:func:`~.RemoteAccess.download`. A warning
+                             is logged if no document cache is given or
+                             configured, which the prefork pool requires.
+    :returns: The :py:class:`DocumentPrefetcher` of the worker.
+    """
+    global PREFETCHER
+    disable()
+    if RemoteAccess.DOCUMENT_CACHE is None and \
+            download_options.get('cache') is None:
+        logging.getLogger(__name__).warning(
+            "Prefetching without a document cache : with the prefork pool, "
+            "documents are downloaded twice (see RemoteAccess.DOCUMENT_CACHE)")
+    PREFETCHER = DocumentPrefetcher(nb_workers=nb_workers,
+                                    disk_budget=disk_budget, max_age=max_age,
+                                    download_options=download_options)
+    return PREFETCHER
+
+
+def disable():
+    """
+    Disable the pipelined mode, removing the unclaimed documents.
+    """
+    global PREFETCHER
+    prefetcher, PREFETCHER = PREFETCHER, None
+    if prefetcher is not None and prefetcher.pid == os.getpid():
+        prefetcher.close()
+
+
+@task_received.connect
+def received_handler(request=None, **kwargs):
+    """
+    Prefetch the document of a task received by the worker.
+    """
+    prefetcher = PREFETCHER
+    if prefetcher is None or prefetcher.pid != os.getpid():
+        return
+    doc_msg = _document_message(request)
+    if doc_msg is not None:
+        prefetcher.prefetch(request.id, doc_msg)
+
+
+@task_revoked.connect
+def revoked_handler(request=None, **kwargs):
+    """
+    Remove the prefetched document of a revoked task.
+    """
+    prefetcher = PREFETCHER
+    if prefetcher is not None and request is not None:
+        prefetcher.discard(request.id)
+
+
+def _document_message(request):
+    """
+    :returns: The document part of the request message of a task, or None
+              if the task does not process a request.
+    """
+    args = getattr(request, 'args', None)
+    try:
+        if args is None:
+            # Celery < 4.4 only exposes the decoded message payload : a
+            # (args, kwargs, embed) tuple, or a dict with protocol 1.
+            payload = request._payload
+            args = payload['args'] if isinstance(payload, dict) \
+                else payload[0]
+        doc_msg = args[0]['service']['document']
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return None
+    if not isinstance(doc_msg, dict) or not doc_msg.get('url'):
+        return None
+    return doc_msg
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+This module offers the publishing of the progress of a processing request.
+
+A :py:class:`ProgressPublisher` stores progress updates in the Celery result
+backend (and sends them as task events) from a background thread, so that
+reporting progress never blocks processing on backend I/O. Updates are
+rate-limited :
+
+* an update changing neither the progress by at least MIN_DELTA nor any of
+  its other values is dropped ;
+* at most one update is stored every MIN_INTERVAL seconds, the latest one
+  replacing those which were waiting ;
+* a progress of 100 is always stored, without waiting.
+"""
+
+# -- standard library --------------------------------------------------------
+from threading import Thread, Condition
+import logging
+import weakref
+import time
+
+# -- project-specific --------------------------------------------------------
+from .status_stream import PROGRESS_EVENT
+from . import metrics
+
+# -- Configuration ------------------------------------------------------------
+# Shortest time in seconds between two stored updates.
+MIN_INTERVAL = 1.
+# Smallest change of progress worth an update.
+MIN_DELTA = 1
+
+_PUBLISHERS = weakref.WeakValueDictionary()
+
+
+class ProgressPublisher(object):
+    """
+    Rate-limited, background publishing of the progress of a task.
+    """
+
+    def __init__(self, task_handler, min_interval=MIN_INTERVAL,
+                 min_delta=MIN_DELTA, send_events=True):
+        """
+        Constructor. Must be called while the task is executed, to capture
+        its id.
+
+        :param task_handler: Task instance of a Celery application.
+        :param min_interval: Shortest time in seconds between two stored
+                             updates.
+        :param min_delta: Smallest change of progress worth an update.
+        :param send_events: Also send updates as task-progress events.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.task_handler = task_handler
+        request = getattr(task_handler, 'request', None)
+        # The request of a task is local to the thread executing it.
+        self.task_id = getattr(request, 'id', None)
+        self.hostname = getattr(request, 'hostname', None)
+        self.min_interval = min_interval
+        self.min_delta = min_delta
+        self.send_events = send_events
+        self.nb_sent = 0
+        self.nb_suppressed = 0
+        self.closed = False
+        self._condition = Condition()
+        self._pending = None
+        self._in_flight = False
+        self._flushing = 0
+        self._last = None
+        self._last_time = 0.
+        self._thread = None
+        if self.task_id is not None:
+            _PUBLISHERS[self.task_id] = self
+
+    def publish(self, progress, meta):
+        """
+        Schedule the publishing of a progress update.
+
+        :param progress: Progress value between 0 and 100.
+        :param meta: Values stored in the backend.
+        """
+        with self._condition:
+            if self.closed:
+                return
+            if self._pending is not None:
+                # Replaces an update which was never sent.
+                self.nb_suppressed += 1
+            elif not self._significant(progress, meta):
+                self.nb_suppressed += 1
+                return
+            self._pending = (progress, meta)
+            if self._thread is None:
+                self._thread = Thread(target=self._run,
+                                      name='progress-publisher')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Send the waiting update at once and wait for it to be stored.
+
+        :param timeout: Maximal time to wait in seconds.
+        :returns: True if no update remains to be sent.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            self._flushing += 1
+            try:
+                self._condition.notify_all()
+                while self._pending is not None or self._in_flight:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return False
+                    self._condition.wait(remaining)
+                return True
+            finally:
+                self._flushing -= 1
+
+    def close(self, discard=False):
+        """
+        Stop publishing.
+
+        :param discard: Drop the waiting update rather than sending it.
+        """
+        if not discard:
+            self.flush()
+        with self._condition:
+            if self.closed:
+                return
+            self.closed = True
+            if self._pending is not None:
+                self.nb_suppressed += 1
+                self._pending = None
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.logger.debug("Sent %s progress updates, suppressed %s",
+                          self.nb_sent, self.nb_suppressed)
+
+    def _significant(self, progress, meta):
+        if self._last is None or progress == 100:
+            return True
+        last_progress, last_meta = self._last
+        if abs(progress - last_progress) >= self.min_delta:
+            return True
+        return any(value != last_meta.get(key)
+                   for key, value in meta.items() if key != 'current')
+
+    def _run(self):
+        with self._condition:
+            while True:
+                while self._pending is None and not self.closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                progress, meta = self._pending
+                delay = self._last_time + self.min_interval - time.time()
+                if delay > 0 and progress != 100 and not self._flushing:
+                    self._condition.wait(delay)
+                    continue
+                self._pending = None
+                self._in_flight = True
+                self._condition.release()
+                try:
+                    self._send(meta)
+                finally:
+                    self._condition.acquire()
+                    self._in_flight = False
+                    self._last = (progress, meta)
+                    self._last_time = time.time()
+                    self._condition.notify_all()
+
+    def _send(self, meta):
+        start = time.time()
+        try:
+            if self.task_id is None:
+                self.task_handler.update_state(state='PROGRESS', meta=meta)
+            else:
+                self.task_handler.update_state(task_id=self.task_id,
+                                               state='PROGRESS', meta=meta)
+            self.nb_sent += 1
+        except Exception as exc:
+            self.logger.warning("Could not set progress at back-end : %s",
+                                exc)
+            return
+        finally:
+            # Sent from the publisher thread : label with the type of meta.
+            metrics.observe(metrics.STAGE_SECONDS, time.time() - start,
+                            stage='update_state',
+                            service_type=meta.get('type'))
+        app = getattr(self.task_handler, 'app', None)
+        if not self.send_events or app is None or self.task_id is None:
+            return
+        fields = dict(meta)
+        fields['service_type'] = fields.pop('type', None)
+        try:
+            with app.events.default_dispatcher(
+                    hostname=self.hostname) as dispatcher:
+                dispatcher.send(PROGRESS_EVENT, uuid=self.task_id, **fields)
+        except Exception as exc:
+            self.logger.warning("Could not send progress event : %s", exc)
+
+
+def stop(task_id):
+    """
+    Stop publishing the progress of a task which ended, dropping the update
+    waiting to be sent.
+
+    :param task_id: UUID of the task.
+    :returns: True if updates were stored by a publisher which was still
+              open, and which may thus have overwritten the final state of
+              the task.
+    """
+    publisher = _PUBLISHERS.pop(task_id, None)
+    if publisher is None or publisher.closed:
+        return False
+    publisher.close(discard=True)
+    return publisher.nb_sent > 0
@@ -8,52 +8,125 @@ This module documents most elements of a processing request.
 # -- standard library --------------------------------------------------------
 from datetime import datetime
 from socket import getfqdn
+import functools
+import threading
 import logging
+import time
 import os
 
 # -- project-specific --------------------------------------------------------
-from .annotations_dispatcher import submit_annotations
-from .service_exceptions import MissingArgumentError
+from .annotations_dispatcher import (submit_annotations,
+                                     submit_annotations_batches)
+from .service_exceptions import (MissingArgumentError,
+                                 AnnotationsUndeliverable)
+from .annotation_stream import AnnotationStream
+from .Report import QUEUE_WAIT, DOWNLOAD, PROCESSING, UPLOAD
+from .progress import ProgressPublisher, stop as stop_progress
+from .Message import CALLBACK_HEADER
 from . import RemoteAccess
+from . import prefetch
+from . import metrics
+from .callback_dispatcher import send_callback
 from . import sentry_agent
 
 # -- third-party --------------------------------------------------------------
 from celery.utils.log import get_task_logger
-from requests.exceptions import HTTPError
-from celery.signals import task_postrun
-from requests import post
+from celery import states
+from celery.signals import task_postrun, worker_ready, worker_process_init
 
 # -- Configuration ------------------------------------------------------------
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
 THIS_DIR = os.path.dirname(__file__)
 
-CALLBACK_URL = None
+# Also publish progress as task events, which StatusStream consumes.
+SEND_PROGRESS_EVENTS = True
+
+# Callback URLs of the tasks in progress in this process, keyed by task id,
+# so that concurrent tasks (thread, gevent or eventlet pools) each notify
+# their own caller.
+_CALLBACK_URLS = {}
+# Service types of the requests of the tasks in progress, keyed by task id,
+# with which their completion is counted.
+_SERVICE_TYPES = {}
 
 
-# Ideally this should be a method of the class Request and not potentially
-# share a global variable with other requests...
 # Also see :
 # http://stackoverflow.com/questions/12526606/callback-for-celery-apply-async
 @task_postrun.connect
-def postrun_handler(task_id, state, **kwargs):
+def postrun_handler(task_id, state, task=None, retval=None, **kwargs):
     """
     This function will call a caller-supplied callback URL when the
-    celery processing finishes.
+    celery processing finishes. The callback is posted in the background
+    (see :py:mod:`~.callback_dispatcher`).
+
+    The callback URL is the one given in the request processed by the task
+    or else the one found in the CALLBACK_HEADER header of the task message
+    (see :py:mod:`~.Message`).
 
     :param state: State of the task upon completion.
     :param task_id: UUID of the task.
+    :param task: Task instance which completed.
+    :param retval: Return value (or exception) of the task.
     """
     logger = get_task_logger(__name__)
-    if CALLBACK_URL:
+    # The final state is stored before this signal : progress updates of a
+    # request which was not closed may have overwritten it since.
+    if stop_progress(task_id) and task is not None:
+        _restore_final_state(task, task_id, state, retval)
+    service_type = _SERVICE_TYPES.pop(task_id, None)
+    if service_type is None and getattr(task, 'name', None):
+        # Task names are prefixed by the application name
+        # (app.service_type).
+        service_type = task.name.rsplit('.', 1)[-1]
+    metrics.inc(metrics.TASKS, state=state, service_type=service_type)
+    callback_url = _CALLBACK_URLS.pop(task_id, None)
+    if callback_url is None and task is not None:
+        callback_url = _header_callback_url(task.request)
+    if callback_url:
         payload = {'uuid': task_id,
                    'status': state}
-        logger.info("Posting callback with contents %s at %s",
-                    payload, CALLBACK_URL)
-        try:
-            res = post(CALLBACK_URL, json=payload)
-            res.raise_for_status()
-        except HTTPError as exc:
-            logger.error("Could not complete callback : %s", exc)
+        logger.info("Queueing callback with contents %s for %s",
+                    payload, callback_url)
+        send_callback(callback_url, payload, service_type=service_type)
+
+
+def _restore_final_state(task, task_id, state, retval):
+    """
+    Store the final state of a task again if a progress update replaced it.
+    """
+    if state not in states.READY_STATES or \
+            getattr(task, 'ignore_result', False):
+        return
+    backend = task.backend
+    try:
+        if backend.get_state(task_id) != 'PROGRESS':
+            return
+        backend.store_result(task_id, retval, state, request=task.request)
+    except Exception as exc:
+        get_task_logger(__name__).warning(
+            "Could not restore the final state of task %s : %s", task_id,
+            exc)
+
+
+@worker_ready.connect
+@worker_process_init.connect
+def sweep_handler(**kwargs):
+    """
+    Remove the local copies left behind by crashed workers when a worker
+    starts, and when a pool process starts (which replaces one which may have
+    crashed).
+    """
+    RemoteAccess.sweep_orphans()
+
+
+def _header_callback_url(task_request):
+    # Custom headers are request attributes, or nested in a headers
+    # attribute depending on the Celery version and protocol.
+    callback_url = getattr(task_request, CALLBACK_HEADER, None)
+    if callback_url is None:
+        headers = getattr(task_request, 'headers', None) or {}
+        callback_url = headers.get(CALLBACK_HEADER)
+    return callback_url
 
 
 class Request(object):
@@ -74,8 +147,16 @@ class Request(object):
     ann_srv_url = None
     annotations = None
     callback_url = None
+    task_report = None
+    progress_publisher = None
+    closed = False
+    _streams = None
+    _download_step = None
+    _thread_id = None
+    _processing_start = None
 
-    def __init__(self, body, task_handler, required_args=None, download=True):
+    def __init__(self, body, task_handler, required_args=None, download=True,
+                 download_options=None, in_memory=False, task_report=None):
         """
         Constructor.
 
@@ -85,9 +166,31 @@ class Request(object):
                               where the key is the name of the arg and the
                               value is a description of it's use.
         :param download: Automatically download document (default=True).
+        :param download_options: Keyword arguments passed along to
+                                 :py:func:`~.RemoteAccess.download`
+                                 (e.g. ranged=True, nb_parallel=4).
+                                 A document prefetched in pipelined mode (see
+                                 :py:mod:`~.prefetch`) is used instead of
+                                 downloading it.
+        :param in_memory: The service reads the document through
+                          Document.view or Document.open, so that it can be
+                          kept in memory (see RemoteAccess.IN_MEMORY_MAX).
+                          Otherwise a document kept in memory is written to a
+                          local file (Document.to_file) and
+                          document.local_path is always set.
+        :param task_report: Instance of :py:class:`~.Report.TaskReport` in
+                            which the durations of the stages of the request
+                            are recorded : queue wait (since the request_time
+                            of the message), download, processing (until
+                            :py:meth:`store_annotations` or :py:meth:`close`)
+                            and upload of the annotations.
         """
         self.body = body
         self.type = self.body['service']['type']
+        # Metrics recorded while processing the request are labelled with
+        # its type.
+        metrics.set_service_type(self.type)
+        self._thread_id = threading.current_thread().ident
         self.logger = logging.getLogger(__name__)
         self.logger.info("Handling task")
         self.logger.debug("Body has contents %s", body)
@@ -105,24 +208,78 @@ class Request(object):
         self.url = doc['url']
         self.ann_srv_url = self.body['annotation_service']['url']
 
+        self.task_handler = task_handler
+        self.task_report = task_report
+        self.start_time = datetime.now().strftime(DATETIME_FORMAT)
+        self._record_queue_wait()
+
+        # Registered before downloading so that the caller is also notified
+        # of a failed download.
+        self.callback_url = (self.misc or {}).get('callback_url', None)
+        task_id = getattr(getattr(task_handler, 'request', None), 'id', None)
+        if self.callback_url and task_id:
+            _CALLBACK_URLS[task_id] = self.callback_url
+        if task_id:
+            _SERVICE_TYPES[task_id] = self.type
+
+        download_start = time.time()
         if download:
-            self.document = RemoteAccess.download(doc)
+            options = dict(download_options or {})
+            if task_handler:
+                options.setdefault('progress_callback',
+                                   self._download_progress)
+            if prefetch.PREFETCHER is not None and task_id:
+                self.document = prefetch.PREFETCHER.claim(task_id)
+            if self.document is None:
+                self.document = RemoteAccess.download(doc, **options)
+            else:
+                self.logger.info("Using prefetched document %s",
+                                 self.document.local_path)
+            if not in_memory and self.document.in_memory:
+                # For services which read document.local_path.
+                self.document.to_file()
+            self._set_timing(DOWNLOAD, time.time() - download_start)
         else:
             self.logger.warning("Choosing NOT to download source document %s",
                                 doc)
+        self._processing_start = time.time()
 
-        self.task_handler = task_handler
-        self.start_time = datetime.now().strftime(DATETIME_FORMAT)
+    def _set_timing(self, stage, duration):
+        if self.task_report is not None:
+            self.task_report.set_timing(stage, duration)
 
-        global CALLBACK_URL
-        CALLBACK_URL = self.misc.get('callback_url', None)
+    def _record_queue_wait(self):
+        """
+        Record the time elapsed since the request was sent.
+        """
+        try:
+            request_time = datetime.strptime(self.body['request_time'],
+                                             DATETIME_FORMAT)
+        except (KeyError, TypeError, ValueError):
+            return
+        wait = (datetime.now() - request_time).total_seconds()
+        self._set_timing(QUEUE_WAIT, max(wait, 0.))
 
-    def set_progress(self, progress):
+    def _end_processing(self):
+        """
+        Record the duration of the processing, once.
+        """
+        if self._processing_start is not None:
+            self._set_timing(PROCESSING,
+                             time.time() - self._processing_start)
+            self._processing_start = None
+
+    def set_progress(self, progress, **details):
         """
         Helper function to set the progress state in the Celery Task backend.
 
+        Progress is stored in the background and rate-limited (see
+        :py:mod:`~.progress`) : call :py:meth:`flush_progress` to wait for
+        the last update to be stored.
+
         :param progress: Progress value between 0 and 100.
         :type progress: int
+        :param details: Additional values published along with the progress.
         """
         self.logger.debug("Setting progress to value %s", progress)
         if not isinstance(progress, int):
@@ -138,11 +295,37 @@ class Request(object):
                     'start_time': self.start_time,
                     'host': self.host,
                     'type': self.type}
-            self.task_handler.update_state(state='PROGRESS', meta=meta)
+            meta.update(details)
+            if self.progress_publisher is None:
+                self.progress_publisher = ProgressPublisher(
+                    self.task_handler, send_events=SEND_PROGRESS_EVENTS)
+            self.progress_publisher.publish(progress, meta)
         else:
             self.logger.warning("Could not set progress at back-end")
 
-    def store_annotations(self, annotations):
+    def flush_progress(self, timeout=None):
+        """
+        Wait for the last progress update to be stored in the backend.
+
+        :param timeout: Maximal time to wait in seconds.
+        """
+        if self.progress_publisher is not None:
+            self.progress_publisher.flush(timeout)
+
+    def _download_progress(self, downloaded, total):
+        """
+        Publish the byte-level progress of the document download, at most
+        once per percent of the document (or per chunk if its size is
+        unknown).
+        """
+        step = (total // 100 or 1) if total else RemoteAccess.CHUNK_SIZE
+        if downloaded != total and downloaded // step == self._download_step:
+            return
+        self._download_step = downloaded // step
+        self.set_progress(0, downloaded_bytes=downloaded, total_bytes=total)
+
+    def store_annotations(self, annotations, batch_size=None,
+                          batch_bytes=None, task_report=None):
         """
         Store the annotations on an Annotation Storage Service (JASS) if the
         JASS's URL was specified in the request body and the annotation has a
@@ -151,16 +334,30 @@ class Request(object):
         Creates a transitory state which is called STORING which can be used to
         debug a hanging call to the JASS.
 
+        When a batch size (in annotations or in bytes) is given, annotations
+        are sent in several concurrent requests (see
+        :py:func:`~.annotations_dispatcher.submit_annotations_batches`).
+
         :param annotations: Actual annotations to send to the JASS.
+        :param batch_size: Maximal number of annotations per request.
+        :param batch_bytes: Maximal size of the annotations of a request.
+        :param task_report: Instance of :py:class:`~.Report.TaskReport` in
+                            which a delivery by batches is recorded.
+                            Defaults to the task report of the request.
         """
+        self._end_processing()
+        if task_report is None:
+            task_report = self.task_report
         self.annotations = annotations
+        self.flush_progress()
 
         if self.task_handler:
             meta = {'worker_id_version': self.process_version,
                     'start_time': self.start_time,
                     'host': self.host,
                     'type': self.type}
-            self.task_handler.update_state(state='STORING', meta=meta)
+            with metrics.timer(metrics.STAGE_SECONDS, stage='update_state'):
+                self.task_handler.update_state(state='STORING', meta=meta)
         else:
             self.logger.warning("Could not set custom state STORING at"
                                 " back-end")
@@ -173,14 +370,137 @@ class Request(object):
             self.logger.warning("Not submitting empty annotations")
             return
 
-        submit_annotations(self.ann_srv_url,
-                           self.annotations)
+        upload_start = time.time()
+        if batch_size or batch_bytes:
+            submit_annotations_batches(self.ann_srv_url,
+                                       self.annotations,
+                                       batch_size=batch_size,
+                                       batch_bytes=batch_bytes,
+                                       task_report=task_report)
+        else:
+            submit_annotations(self.ann_srv_url,
+                               self.annotations)
+        if task_report is not None:
+            task_report.set_timing(UPLOAD, time.time() - upload_start)
+
+    def open_annotation_stream(self, **options):
+        """
+        Start sending annotations to the Annotation Storage Service (JASS)
+        while they are produced, rather than all at once through
+        :py:meth:`store_annotations`.
+
+        The stream must be closed once all annotations were pushed, which
+        waits for their delivery. Streams still open are closed along with
+        the request.
+
+        :param options: Keyword arguments of
+                        :py:class:`~.annotation_stream.AnnotationStream`
+                        (flush_size, flush_interval, max_pending,
+                        compression).
+        :returns: Instance of
+                  :py:class:`~.annotation_stream.AnnotationStream`.
+        """
+        if not self.ann_srv_url:
+            self.logger.warning("Annotations will not be submitted to a "
+                                "null URL")
+        stream = AnnotationStream(self.ann_srv_url, **options)
+        if self._streams is None:
+            self._streams = []
+        self._streams.append(stream)
+        return stream
+
+    def close(self):
+        """
+        Release the resources of the request : wait for the last progress
+        update to be stored, deliver the annotations of the streams still
+        open and remove the local copy of the document. Does nothing once the
+        request is closed.
+
+        :raises AnnotationsUndeliverable: if annotations of a stream could not
+                                          be delivered. The other resources
+                                          are released anyway.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._end_processing()
+        error = None
+        try:
+            if self.progress_publisher is not None:
+                self.progress_publisher.close()
+            for stream in self._streams or []:
+                try:
+                    stream.close()
+                except AnnotationsUndeliverable as exc:
+                    error = error or exc
+        finally:
+            if self.document:
+                self.logger.info("Destroying local document copy of %s =>"
+                                 " %s", self.document,
+                                 self.document.local_path)
+                RemoteAccess.cleanup(self.document)
+                self.document = None
+            # Metrics recorded later by this thread are not about the
+            # request (close may also be called by another thread, from
+            # __del__).
+            if threading.current_thread().ident == self._thread_id:
+                metrics.set_service_type(None)
+        if error is not None:
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except Exception:
+            # Do not hide the error of the processing.
+            self.logger.exception("Could not close request")
 
     def __del__(self):
         """
-        Destructor method for cleanup purposes.
+        Destructor method for cleanup purposes, for requests which were not
+        closed.
         """
-        if self.document:
-            self.logger.info("Destroying local document copy of %s =>"
-                             " %s", self.document, self.document.local_path)
-            RemoteAccess.cleanup(self.document)
+        try:
+            self.close()
+        except Exception as exc:
+            self.logger.error("Could not close request : %s", exc)
+
+
+def with_request(required_args=None, download=True, download_options=None,
+                 in_memory=False):
+    """
+    Decorator of the functions of bound Celery tasks processing a request.
+
+    The decorated function receives a :py:class:`Request` built from the
+    message body, which is closed as soon as the function returns, before
+    the task state is stored. The duration of the function is recorded as
+    the processing stage of the request (see :py:mod:`~.metrics`)::
+
+        @app.task(bind=True)
+        @with_request(required_args={'model': 'Model name'})
+        def transcribe(request):
+            ...
+
+    :param required_args: As for :py:class:`Request`.
+    :param download: As for :py:class:`Request`.
+    :param download_options: As for :py:class:`Request`.
+    :param in_memory: As for :py:class:`Request`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(task_handler, body, *args, **kwargs):
+            with Request(body, task_handler, required_args=required_args,
+                         download=download,
+                         download_options=download_options,
+                         in_memory=in_memory) as request:
+                with metrics.timer(metrics.STAGE_SECONDS,
+                                   stage='processing'):
+                    return func(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -6,20 +6,37 @@ distributed request system.
 """
 
 # --Standard lib modules-------------------------------------------------------
+from itertools import islice
 import optparse
 import logging
+import threading
+import socket
+import copy
+import time
 import sys
 import imp  # Access import internals.
 import os
 
 # --3rd party modules----------------------------------------------------------
-from celery import Celery
+from celery import Celery, states
+from celery.backends.base import KeyValueStoreBackend
+from celery.result import AsyncResult
 
 # --Project specific-----------------------------------------------------------
-from .service_exceptions import ConfigFileNotFound
+from .service_exceptions import ConfigFileNotFound, PublishError
 from . import Message
 
 ENCODING = 'utf-8'
+# Number of messages published at once by send_task_requests.
+BATCH_SIZE = 500
+# Longest time in seconds to wait for the broker to confirm a batch.
+CONFIRM_TIMEOUT = 30.
+# Time in seconds during which get_requests_info reuses the information
+# fetched on a request.
+STATUS_CACHE_TTL = 2.
+
+_STATUS_CACHE = {}
+_STATUS_CACHE_LOCK = threading.Lock()
 
 
 # ----------------------------------------------------------------------------
@@ -56,7 +73,8 @@ def send_task_request(url,
                       app,
                       queue,
                       misc={},
-                      ann_srv_url=None):
+                      ann_srv_url=None,
+                      callback_url=None):
     """
     Send a request for a process on URL.
 
@@ -66,15 +84,12 @@ def send_task_request(url,
     :param queue: AMQP Queue to which the MSG will be sent.
     :param misc: Optional data that can be passed to a celery worker.
     :param ann_srv_url: URL to where the final annotations will be stored.
+    :param callback_url: URL notified of the completion of the request,
+                         carried in the task message headers.
     :returns: Instance of :py:class:`celery.result.AsyncResult`
     """
     logger = logging.getLogger(__name__)
-    # The message to send on the queue.
-    msg = Message.request_message_factory()
-    msg['service']['document']['url'] = url
-    msg['service']['type'] = name
-    msg['service']['misc'] = misc
-    msg['annotation_service']['url'] = ann_srv_url
+    msg = _request_message(url, name, misc, ann_srv_url)
 
     logger.debug("URL is %s", url)
     logger.debug("Task name is %s", name)
@@ -82,20 +97,207 @@ def send_task_request(url,
     logger.debug("Celery queue is: %s", queue)
     logger.debug("misc structure is : %s", misc)
 
-    # TODO : This should be updated in the context of natural naming for Celery
-    # tasks...
-    task_name = '{}.{}'.format(app.main, name)
     # See:
     # http://docs.celeryproject.org/en/3.1/reference/celery.app.task.html#celery.app.task.Task.apply_async
     # Explicitly give the queue name, otherwise Celery will use the
     # CELERY_ROUTES configuration structure which reduces tasks routes to task
     # names. Hence we respect here the configuration given to the application
     # (VestaRestPackage ?).
-    result = app.send_task(task_name, queue=queue, args=(msg,))
-    logger.info("Sent message %s to queue %s", msg, queue)
+    headers = {}
+    if callback_url:
+        headers[Message.CALLBACK_HEADER] = callback_url
+    result = app.send_task(_task_name(app, name), queue=queue, args=(msg,),
+                           headers=headers)
+    logger.info("Sent request for %s to queue %s", url, queue)
+    logger.debug("Message contents : %s", msg)
     return result
 
 
+class PublishStats(object):
+    """
+    Throughput of the messages published by :py:func:`send_task_requests`.
+    """
+
+    def __init__(self):
+        self.nb_messages = 0
+        self.nb_batches = 0
+        self.start_time = None
+        self.elapsed = 0.
+
+    def rate(self):
+        """
+        :returns: Number of messages published per second.
+        """
+        if not self.elapsed:
+            return 0.
+        return self.nb_messages / self.elapsed
+
+
+def send_task_requests(items,
+                       name,
+                       app,
+                       queue,
+                       batch_size=BATCH_SIZE,
+                       confirm_publish=True,
+                       stats=None,
+                       confirm_timeout=CONFIRM_TIMEOUT):
+    """
+    Send requests for a process on many URLs.
+
+    All messages are published through a single broker connection and
+    producer, by batches of batch_size messages. Publishing is lazy : a batch
+    is only sent once the results of the previous ones were consumed, and the
+    connection is held until the returned generator is exhausted or closed.
+
+    With publisher confirms, the messages of a batch are published without
+    waiting and the confirms of the whole batch are then awaited at once,
+    which costs one broker round trip per batch instead of one per message.
+    Publisher confirms are only supported by the py-amqp transport (RabbitMQ)
+    : other transports publish without confirms.
+
+    :param items: Iterable of (url, misc, ann_srv_url) tuples, as the
+                  arguments of :py:func:`send_task_request`.
+    :param name: Name of the process.
+    :param app: Handle to the Celery application.
+    :param queue: AMQP Queue to which the messages will be sent.
+    :param batch_size: Number of messages published before waiting for their
+                       confirms, logging and updating the throughput.
+    :param confirm_publish: Wait for the broker to confirm each batch (on
+                            transports supporting publisher confirms).
+    :param stats: Instance of :py:class:`PublishStats` updated after each
+                  batch.
+    :param confirm_timeout: Longest time in seconds to wait for the confirms
+                            of a batch.
+    :returns: Generator of :py:class:`celery.result.AsyncResult`, one per item
+              and in the same order.
+    :raises PublishError: if the broker rejects messages or does not confirm
+                          them in time.
+    """
+    logger = logging.getLogger(__name__)
+    task_name = _task_name(app, name)
+    stats = stats if stats is not None else PublishStats()
+    items = iter(items)
+
+    with app.connection_for_write() as connection:
+        channel = connection.default_channel
+        confirms = _BatchConfirms.create(connection, channel) \
+            if confirm_publish else None
+        producer = app.amqp.Producer(channel)
+        stats.start_time = stats.start_time or time.time()
+        while True:
+            batch = list(islice(items, batch_size))
+            if not batch:
+                break
+            results = [app.send_task(task_name, queue=queue,
+                                     args=(_request_message(url, name, misc,
+                                                            ann_srv_url),),
+                                     producer=producer)
+                       for url, misc, ann_srv_url in batch]
+            if confirms is not None:
+                confirms.wait(len(results), confirm_timeout)
+            stats.nb_messages += len(results)
+            stats.nb_batches += 1
+            stats.elapsed = time.time() - stats.start_time
+            logger.info("Sent %s messages to queue %s (%s in total, %.1f "
+                        "messages/s)", len(results), queue,
+                        stats.nb_messages, stats.rate())
+            for result in results:
+                yield result
+
+
+class _BatchConfirms(object):
+    """
+    Publisher confirms of a py-amqp channel, awaited once per batch.
+    """
+
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.nb_published = 0
+        self.rejected = False
+        # Delivery tags, numbered from 1 in the order of publishing, are all
+        # confirmed up to confirmed_through and individually above.
+        self.confirmed_through = 0
+        self._confirmed = set()
+        channel.confirm_select()
+        channel.events['basic_ack'].add(self._on_ack)
+        channel.events['basic_nack'].add(self._on_nack)
+
+    @classmethod
+    def create(cls, connection, channel):
+        """
+        :returns: Instance of _BatchConfirms, or None if the transport of the
+                  channel does not support publisher confirms.
+        """
+        # py-amqp channels have confirm_select and an events mapping (a
+        # defaultdict, empty until a callback is registered).
+        if not hasattr(channel, 'confirm_select') or \
+                getattr(channel, 'events', None) is None:
+            return None
+        return cls(connection, channel)
+
+    def wait(self, nb_messages, timeout):
+        """
+        Wait for the confirms of the last nb_messages published messages.
+
+        :raises PublishError: if messages were rejected or not confirmed in
+                              time.
+        """
+        self.nb_published += nb_messages
+        deadline = time.time() + timeout
+        while self._nb_unconfirmed():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise PublishError("{} messages were not confirmed by the "
+                                   "broker".format(self._nb_unconfirmed()))
+            try:
+                self.connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                continue
+        self.confirmed_through = self.nb_published
+        self._confirmed.clear()
+        if self.rejected:
+            self.rejected = False
+            raise PublishError("Messages were rejected by the broker")
+
+    def _nb_unconfirmed(self):
+        return self.nb_published - self.confirmed_through - \
+            len(self._confirmed)
+
+    def _confirm(self, delivery_tag, multiple):
+        if multiple:
+            if delivery_tag > self.confirmed_through:
+                self.confirmed_through = delivery_tag
+                self._confirmed = set(tag for tag in self._confirmed
+                                      if tag > delivery_tag)
+        elif delivery_tag > self.confirmed_through:
+            self._confirmed.add(delivery_tag)
+
+    def _on_ack(self, delivery_tag, multiple):
+        self._confirm(delivery_tag, multiple)
+
+    def _on_nack(self, delivery_tag, multiple):
+        self.rejected = True
+        self._confirm(delivery_tag, multiple)
+
+
+def _request_message(url, name, misc, ann_srv_url):
+    """
+    Build the message of a request for a process on URL.
+    """
+    msg = Message.request_message_factory()
+    msg['service']['document']['url'] = url
+    msg['service']['type'] = name
+    msg['service']['misc'] = misc
+    msg['annotation_service']['url'] = ann_srv_url
+    return msg
+
+
+def _task_name(app, name):
+    # TODO : This should be updated in the context of natural naming for Celery
+    # tasks...
+    return '{}.{}'.format(app.main, name)
+
+
 def get_request_info(uuid, app):
     """
     Get information on a processing request.
@@ -111,15 +313,154 @@ def get_request_info(uuid, app):
 
     logger.info("Obtaining information for task %s", uuid)
     async_result = app.AsyncResult(id=uuid)
-    status = async_result.state
-    result = async_result.result
+    return _request_information(uuid, async_result.state, async_result.result,
+                                async_result.traceback, async_result.backend)
+
+
+def get_requests_info(uuids, app, batch_size=BATCH_SIZE,
+                      cache_ttl=STATUS_CACHE_TTL):
+    """
+    Get information on many processing requests.
 
+    States and results are fetched from the result backend by batches : a
+    single multi-get on key-value backends (Redis, Memcached, ...), a single
+    query on database backends and one lookup per request on other backends.
+    Information obtained less than cache_ttl seconds ago is not fetched
+    again, so that frequent polls of the same requests spare the backend.
+
+    :param uuids: Iterable of request UUIDs.
+    :param app: Handle to the Celery application.
+    :param batch_size: Maximal number of requests fetched at once.
+    :param cache_ttl: Time in seconds during which the information on a
+                      request is reused. 0 disables the cache.
+    :returns: dict mapping each UUID to the dict returned by
+              :py:func:`get_request_info`. Instead of being raised, the
+              :py:class:`WorkerExceptionWrapper` of a request in the
+              FAILURE, RETRY or REVOKED state is given under the 'error' key,
+              the 'result' being None. Each call returns its own copies of
+              the cached information.
+    """
+    logger = logging.getLogger(__name__)
+    now = time.time()
+    informations = {}
+    missing = []
+    with _STATUS_CACHE_LOCK:
+        for uuid, (expiry, _) in list(_STATUS_CACHE.items()):
+            if expiry <= now:
+                del _STATUS_CACHE[uuid]
+        for uuid in uuids:
+            if uuid in informations:
+                continue
+            cached = _STATUS_CACHE.get(uuid) if cache_ttl > 0 else None
+            if cached is not None:
+                informations[uuid] = _copy_information(cached[1])
+            else:
+                informations[uuid] = None
+                missing.append(uuid)
+    logger.info("Obtaining information for %s tasks (%s cached)",
+                len(informations), len(informations) - len(missing))
+
+    backend = app.backend
+    for start in range(0, len(missing), batch_size):
+        batch = missing[start:start + batch_size]
+        for uuid, meta in zip(batch, _get_task_metas(backend, batch)):
+            try:
+                information = _request_information(
+                    uuid, meta['status'], meta.get('result'),
+                    meta.get('traceback'), backend)
+            except WorkerExceptionWrapper as exc:
+                information = {
+                    'uuid': uuid,
+                    'status': exc.task_status,
+                    'result': None,
+                    'error': exc
+                }
+            informations[uuid] = information
+
+    if cache_ttl > 0 and missing:
+        expiry = time.time() + cache_ttl
+        with _STATUS_CACHE_LOCK:
+            for uuid in missing:
+                _STATUS_CACHE[uuid] = (expiry,
+                                       _copy_information(informations[uuid]))
+    return informations
+
+
+def _copy_information(information):
+    """
+    Copy the information on a request, so that callers changing what they
+    obtain do not change the cache. The error (if any) is shared.
+    """
+    information = dict(information)
+    information['result'] = copy.deepcopy(information.get('result'))
+    return information
+
+
+def clear_status_cache():
+    """
+    Forget the information cached by :py:func:`get_requests_info`.
+    """
+    with _STATUS_CACHE_LOCK:
+        _STATUS_CACHE.clear()
+
+
+def _get_task_metas(backend, uuids):
+    """
+    Fetch the meta data of many tasks from a result backend.
+
+    :returns: List of meta data dict, in the order of uuids.
+    """
+    if isinstance(backend, KeyValueStoreBackend):
+        keys = [backend.get_key_for_task(uuid) for uuid in uuids]
+        values = backend.mget(keys)
+        if not hasattr(values, 'items'):
+            # Some clients return a list rather than a mapping.
+            values = dict(zip(keys, values))
+        return [backend.decode_result(values[key])
+                if values.get(key) is not None else
+                {'status': states.PENDING, 'result': None}
+                for key in keys]
+
+    if hasattr(backend, 'ResultSession'):
+        # Database backend.
+        task_cls = getattr(backend, 'task_cls', None)
+        if task_cls is None:
+            from celery.backends.database.models import Task as task_cls
+        session = backend.ResultSession()
+        try:
+            tasks = session.query(task_cls).filter(
+                task_cls.task_id.in_(uuids)).all()
+            metas = dict((task.task_id,
+                          backend.meta_from_decoded(task.to_dict()))
+                         for task in tasks)
+        finally:
+            session.close()
+        return [metas.get(uuid, {'status': states.PENDING, 'result': None})
+                for uuid in uuids]
+
+    metas = []
+    for uuid in uuids:
+        async_result = AsyncResult(uuid, backend=backend)
+        metas.append({'status': async_result.state,
+                      'result': async_result.result,
+                      'traceback': async_result.traceback})
+    return metas
+
+
+def _request_information(uuid, status, result, exc_traceback, backend):
+    """
+    Build the information on a processing request from its state.
+
+    :raises WorkerExceptionWrapper: For requests in the FAILURE, RETRY or
+                                    REVOKED state.
+    """
+    logger = logging.getLogger(__name__)
     # Result for PENDING, PROGRESS and SUCCESS can be sent as is
 
     # For the moment I cannot validate the returned result for
     # RECEIVED and STARTED so force a None value as it's what
     # should be returned anyway
-    logger.info("Task has status %s", status)
+    logger.info("Task %s has status %s", uuid, status)
     if status == 'RECEIVED' or status == 'STARTED':
         result = None
 
@@ -130,9 +471,8 @@ def get_request_info(uuid, app):
     # Raise the exception so that it can be handled at a higher level
     elif status == 'FAILURE' or status == 'RETRY' or status == 'REVOKED':
         if status == 'RETRY':
-            result = async_result.backend.exception_to_python(result)
+            result = backend.exception_to_python(result)
 
-        exc_traceback = async_result.traceback
         raise WorkerExceptionWrapper(uuid, status, result, exc_traceback)
 
     information = {
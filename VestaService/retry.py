@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# coding:utf-8
+
+"""
+This module offers the retry policy shared by all remote calls.
+
+A :py:class:`RetryPolicy` retries a call on a configurable set of exceptions
+and response status codes, waiting between tries with an exponential backoff
+with jitter, or as long as the server asked through a ``Retry-After``
+header.
+
+Failures are also accounted per remote host by a :py:class:`CircuitBreaker`:
+after FAILURE_THRESHOLD consecutive failures a host is considered down and
+calls to it fail at once with :py:class:`~.service_exceptions.CircuitOpenError`
+for RESET_TIMEOUT seconds, after which a single trial call decides whether it
+is back up. This keeps worker slots from being tied up retrying a host known
+to be unreachable.
+"""
+
+# --Standard lib modules------------------------------------------------------
+from email.utils import parsedate_tz, mktime_tz
+from logging import getLogger
+import threading
+import random
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+
+# --3rd party modules----------------------------------------------------------
+import requests
+
+# --Project specific----------------------------------------------------------
+from .service_exceptions import CircuitOpenError
+from . import metrics
+
+# -- Configuration ------------------------------------------------------------
+MAX_TRY = 5
+BACKOFF_FACTOR = 0.5
+MAX_BACKOFF = 30.
+# Longest wait honored from a Retry-After header.
+MAX_RETRY_AFTER = 120.
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+RETRY_EXCEPTIONS = (requests.exceptions.Timeout,
+                    requests.exceptions.ConnectionError)
+
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30.
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+class RetryPolicy(object):
+    """
+    Describes when and how often a remote call is tried again.
+    """
+
+    def __init__(self, max_try=MAX_TRY, backoff_factor=BACKOFF_FACTOR,
+                 max_backoff=MAX_BACKOFF, jitter=True,
+                 retry_statuses=RETRY_STATUSES,
+                 retry_exceptions=RETRY_EXCEPTIONS, circuit_breaker=True):
+        """
+        Constructor.
+
+        :param max_try: Maximal number of tries.
+        :param backoff_factor: Wait before the second try, doubled for each
+                               subsequent try.
+        :param max_backoff: Longest wait between two tries.
+        :param jitter: Wait a random time between 0 and the backoff ("full
+                       jitter") so that clients do not retry in lockstep.
+        :param retry_statuses: Response status codes which are retried.
+        :param retry_exceptions: Exception types which are retried.
+        :param circuit_breaker: Account failures per host and refuse calls to
+                                hosts which are down.
+        """
+        self.max_try = max_try
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = frozenset(retry_statuses)
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.circuit_breaker = circuit_breaker
+
+    def with_max_try(self, max_try):
+        """
+        :returns: A copy of this policy with another maximal number of tries.
+        """
+        policy = RetryPolicy.__new__(RetryPolicy)
+        policy.__dict__.update(self.__dict__)
+        policy.max_try = max_try
+        return policy
+
+    def backoff(self, cur_try, retry_after=None):
+        """
+        :param cur_try: Number of the try which just failed (starting at 1).
+        :param retry_after: Value of a Retry-After response header.
+        :returns: Time to wait in seconds before the next try.
+        """
+        delay = parse_retry_after(retry_after)
+        if delay is not None:
+            return min(delay, MAX_RETRY_AFTER)
+        delay = min(self.max_backoff,
+                    self.backoff_factor * 2 ** (cur_try - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def call(self, func, url, *args, **kwargs):
+        """
+        Call func(url, \\*args, \\*\\*kwargs) until it succeeds or the tries
+        are exhausted.
+
+        :param func: Function sending a request and returning its response.
+        :param url: URL of the request.
+        :returns: The response of the last try. It has a retried status code
+                  if all tries got one.
+        :raises CircuitOpenError: if the host of the URL is considered down.
+        :raises: The exception of the last try if all tries raised one.
+        """
+        breaker = self.breaker(url)
+        cur_try = 1
+        while True:
+            if breaker:
+                breaker.before_call()
+            try:
+                response = func(url, *args, **kwargs)
+            except self.retry_exceptions as error:
+                delay = self.on_error(error, url, cur_try, breaker)
+                if delay is None:
+                    raise
+            except Exception:
+                if breaker:
+                    breaker.cancel_trial()
+                raise
+            else:
+                delay = self.on_response(response, url, cur_try, breaker)
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+            cur_try += 1
+
+    def breaker(self, url):
+        """
+        :returns: The :py:class:`CircuitBreaker` accounting the calls to the
+                  host of a URL, or None without circuit breaker.
+        """
+        return get_breaker(url) if self.circuit_breaker else None
+
+    def on_error(self, error, url, cur_try, breaker=None):
+        """
+        Account a try which raised a retried exception. Shared by
+        :py:meth:`call` and its asynchronous counterpart.
+
+        :param error: Exception raised by the try.
+        :param url: URL of the request.
+        :param cur_try: Number of the try (starting at 1).
+        :param breaker: Circuit breaker of the host of the URL.
+        :returns: Time to wait in seconds before the next try, or None if the
+                  tries are exhausted and the exception must be raised.
+        """
+        if breaker:
+            breaker.record_failure()
+        if cur_try >= self.max_try:
+            return None
+        delay = self.backoff(cur_try)
+        metrics.inc(metrics.RETRIES, reason='error')
+        getLogger(__name__).warning("%s on %s, retrying in %.2fs (%s/%s)",
+                                    type(error).__name__, url, delay,
+                                    cur_try + 1, self.max_try)
+        return delay
+
+    def on_response(self, response, url, cur_try, breaker=None):
+        """
+        Account a try which got a response. Shared by :py:meth:`call` and its
+        asynchronous counterpart.
+
+        :param response: Response of the try (requests or aiohttp).
+        :param url: URL of the request.
+        :param cur_try: Number of the try (starting at 1).
+        :param breaker: Circuit breaker of the host of the URL.
+        :returns: Time to wait in seconds before the next try, or None if the
+                  response must be returned.
+        """
+        status = _status(response)
+        if status not in self.retry_statuses:
+            if breaker:
+                breaker.record_success()
+            return None
+        if breaker:
+            breaker.record_failure()
+        if cur_try >= self.max_try:
+            return None
+        delay = self.backoff(cur_try, response.headers.get('Retry-After'))
+        metrics.inc(metrics.RETRIES, reason='status')
+        getLogger(__name__).warning("Got status %s from %s, retrying in "
+                                    "%.2fs (%s/%s)", status, url, delay,
+                                    cur_try + 1, self.max_try)
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Consecutive failures account of a remote host.
+    """
+
+    def __init__(self, host, failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """
+        :raises CircuitOpenError: if the host is considered down.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at >= self.reset_timeout and \
+                    not self.trial_in_progress:
+                # Half open : let a single call find out if the host is back.
+                self.trial_in_progress = True
+                return
+        raise CircuitOpenError("Host {} is considered down after {} "
+                               "consecutive failures".format(self.host,
+                                                             self.failures))
+
+    def cancel_trial(self):
+        """
+        Let another call try the host when a trial call ended without telling
+        whether the host is up.
+        """
+        with self.lock:
+            self.trial_in_progress = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_in_progress or \
+                    self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    getLogger(__name__).error(
+                        "Host %s is considered down after %s consecutive "
+                        "failures", self.host, self.failures)
+                self.opened_at = time.time()
+                self.trial_in_progress = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+def get_breaker(url):
+    """
+    :param url: Any URL on a host.
+    :returns: The :py:class:`CircuitBreaker` of the host of a URL.
+    """
+    host = urlsplit(url).netloc
+    breaker = _BREAKERS.get(host)
+    if breaker is None:
+        with _BREAKERS_LOCK:
+            breaker = _BREAKERS.setdefault(host, CircuitBreaker(host))
+    return breaker
+
+
+def reset_breakers():
+    """
+    Forget the failures of all hosts.
+    """
+    with _BREAKERS_LOCK:
+        _BREAKERS.clear()
+
+
+def parse_retry_after(value):
+    """
+    :param value: Value of a Retry-After header, in seconds or as a date.
+    :returns: Time to wait in seconds or None if there is no valid value.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(mktime_tz(date) - time.time(), 0.)
+
+
+def _status(response):
+    # requests and aiohttp name the status code differently.
+    return getattr(response, 'status_code', getattr(response, 'status', None))
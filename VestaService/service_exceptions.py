@@ -75,3 +75,17 @@ class MissingArgumentError(ServiceException):
     Indicates that a required argument was not supplied.
     """
     pass
+
+
+class CircuitOpenError(ServiceException):
+    """
+    Indicates that a remote host is considered down and was not contacted.
+    """
+    pass
+
+
+class PublishError(ServiceException):
+    """
+    Exception raised when the broker does not confirm published messages.
+    """
+    pass
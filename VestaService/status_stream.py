@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# coding:utf-8
+
+"""
+This module offers a way to follow processing requests as they progress,
+without polling the result backend.
+
+A :py:class:`StatusStream` consumes the Celery task events (workers must be
+started with events enabled, ``-E``) in a background thread and yields an
+update each time a followed request changes state or reports progress through
+:py:meth:`~.request.Request.set_progress`. Requests are followed by UUID, by
+task type or both; a single stream can follow thousands of requests.
+
+The stream can be iterated over from blocking code::
+
+    with StatusStream(app, uuids=uuids) as stream:
+        for update in stream:
+            print(update['uuid'], update['status'])
+
+or asynchronously with ``async for`` from an asyncio event loop (Python 3).
+"""
+
+# -- standard library --------------------------------------------------------
+from threading import Thread, Event
+import logging
+import time
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:  # Python 2
+    from Queue import Queue, Empty, Full
+
+# -- Configuration ------------------------------------------------------------
+# Number of updates waiting to be consumed over which events are no longer
+# read from the broker.
+MAX_PENDING = 10000
+# Time to wait before reconnecting to the broker after an error.
+RECONNECT_INTERVAL = 1.
+
+PROGRESS_EVENT = 'task-progress'
+
+# Status of a request after each type of task event.
+EVENT_STATUSES = {
+    'task-sent': 'PENDING',
+    'task-received': 'RECEIVED',
+    'task-started': 'STARTED',
+    PROGRESS_EVENT: 'PROGRESS',
+    'task-succeeded': 'SUCCESS',
+    'task-failed': 'FAILURE',
+    'task-retried': 'RETRY',
+    'task-revoked': 'REVOKED',
+    'task-rejected': 'REJECTED',
+}
+READY_STATUSES = frozenset(['SUCCESS', 'FAILURE', 'REVOKED', 'REJECTED'])
+
+# Event fields which are not copied in the progress of an update.
+_EVENT_FIELDS = frozenset(['type', 'uuid', 'hostname', 'timestamp',
+                           'utcoffset', 'pid', 'clock', 'local_received',
+                           'service_type'])
+_CLOSE = object()
+
+
+class StatusStream(object):
+    """
+    Iterator of the status and progress updates of processing requests.
+
+    Each update is a dict with the following keys:
+
+       :uuid: UUID of the request.
+       :status: Status of the request (same values as
+                :py:func:`~.request_process_mesg.get_request_info`).
+       :type: Task type of the request when known, else None.
+       :timestamp: Time of the event.
+       :hostname: Worker which sent the event.
+
+    PROGRESS updates also have a progress key holding the values published by
+    :py:meth:`~.request.Request.set_progress`, SUCCESS updates a result key
+    and FAILURE and RETRY updates exception and traceback keys.
+    """
+
+    def __init__(self, app, uuids=None, task_types=None,
+                 max_pending=MAX_PENDING):
+        """
+        Constructor. Events are consumed from the broker as soon as the
+        stream is created.
+
+        :param app: Handle to the Celery application.
+        :param uuids: UUIDs of the requests to follow. When only UUIDs are
+                      given, iteration stops once all of them are ready.
+        :param task_types: Task types (service types or task names) of the
+                           requests to follow.
+        :param max_pending: Number of updates waiting to be consumed over
+                            which events are no longer read.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+        self.uuids = set(uuids) if uuids is not None else None
+        self.task_types = frozenset(task_types or [])
+        self.closed = False
+        self.nb_events = 0
+        self.nb_updates = 0
+        self._remaining = set(self.uuids or [])
+        self._types = {}
+        self._ready = Event()
+        self._receiver = None
+        self._queue = Queue(maxsize=max_pending)
+        self._thread = Thread(target=self._run, name='status-stream')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait until events are consumed from the broker. Events sent before
+        are not seen by the stream.
+
+        :param timeout: Maximal time to wait in seconds.
+        :returns: True if the stream is consuming events.
+        """
+        return self._ready.wait(timeout)
+
+    def get(self, timeout=None):
+        """
+        :param timeout: Maximal time to wait for an update in seconds.
+        :returns: The next update, or None if there was none before the
+                  timeout.
+        :raises StopIteration: once the stream is closed or all the
+                               followed requests are ready.
+        """
+        try:
+            update = self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+        if update is _CLOSE:
+            # Let other consumers see the end of the stream too.
+            self._queue.put(_CLOSE)
+            raise StopIteration
+        return update
+
+    def close(self):
+        """
+        Stop consuming events.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        receiver = self._receiver
+        if receiver is not None:
+            receiver.should_stop = True
+        self._thread.join()
+        self._put(_CLOSE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    next = __next__  # Python 2
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(None, self._anext)
+
+    def _anext(self):
+        try:
+            return self.get()
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _put(self, update):
+        """
+        Queue an update, waiting for room while the stream is open.
+        """
+        while True:
+            try:
+                self._queue.put(update, timeout=1.)
+                return
+            except Full:
+                if update is not _CLOSE:
+                    if self.closed:
+                        return
+                    continue
+                # Make room for the end of the stream.
+                try:
+                    self._queue.get_nowait()
+                except Empty:
+                    pass
+
+    def _run(self):
+        while not self.closed:
+            try:
+                with self.app.connection_for_read() as connection:
+                    receiver = self.app.events.Receiver(
+                        connection, handlers={'*': self._on_event})
+                    on_consume_ready = receiver.on_consume_ready
+
+                    def ready(*args, **kwargs):
+                        on_consume_ready(*args, **kwargs)
+                        self._ready.set()
+                    receiver.on_consume_ready = ready
+                    self._receiver = receiver
+                    if self.closed:
+                        return
+                    receiver.capture(limit=None, timeout=None, wakeup=False)
+            except Exception as exc:
+                self._ready.clear()
+                if self.closed:
+                    return
+                self.logger.error("Lost the connection to the task events "
+                                  "(%s), reconnecting", exc)
+                time.sleep(RECONNECT_INTERVAL)
+
+    def _on_event(self, event):
+        status = EVENT_STATUSES.get(event.get('type'))
+        uuid = event.get('uuid')
+        if status is None or uuid is None:
+            return
+        self.nb_events += 1
+        task_type = self._follow(uuid, event)
+        if task_type is False:
+            return
+
+        update = {'uuid': uuid,
+                  'status': status,
+                  'type': task_type,
+                  'timestamp': event.get('timestamp'),
+                  'hostname': event.get('hostname')}
+        if status == 'PROGRESS':
+            update['progress'] = dict((key, value)
+                                      for key, value in event.items()
+                                      if key not in _EVENT_FIELDS)
+        elif status == 'SUCCESS':
+            update['result'] = event.get('result')
+        elif status in ('FAILURE', 'RETRY'):
+            update['exception'] = event.get('exception')
+            update['traceback'] = event.get('traceback')
+        self.nb_updates += 1
+        self._put(update)
+
+        if status in READY_STATUSES:
+            self._types.pop(uuid, None)
+            if self._remaining:
+                self._remaining.discard(uuid)
+                if not self._remaining and not self.task_types:
+                    self.logger.info("All followed requests are ready")
+                    self._receiver.should_stop = True
+                    self.closed = True
+                    self._put(_CLOSE)
+
+    def _follow(self, uuid, event):
+        """
+        :returns: The task type of a followed request (None if unknown) or
+                  False if the request is not followed.
+        """
+        task_type = self._types.get(uuid) or event.get('name') or \
+            event.get('service_type')
+        if not (self.uuids is not None and uuid in self.uuids or
+                task_type and self._matches(task_type)):
+            return False
+        if task_type and uuid not in self._types and \
+                EVENT_STATUSES[event['type']] not in READY_STATUSES:
+            # Only sent and received events carry the task name and progress
+            # events the service type : remember it for the other events.
+            self._types[uuid] = task_type
+        return task_type
+
+    def _matches(self, task_type):
+        if not self.task_types:
+            return False
+        # Task names are prefixed by the application name (app.service_type).
+        return task_type in self.task_types or \
+            task_type.rsplit('.', 1)[-1] in self.task_types
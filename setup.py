@@ -23,9 +23,16 @@ else:
 REQUIREMENTS = [
     "celery==4.3.0",
     "requests[security]>=2.20.0",
+    'futures; python_version < "3"',
     "sentry-sdk"
 ]
 
+EXTRA_REQUIREMENTS = {
+    'async': ['aiohttp>=3.5'],
+    'zstd': ['zstandard'],
+    's3': ['boto3'],
+}
+
 TEST_REQUIREMENTS = [
     'nose',
 ]
@@ -63,6 +70,7 @@ setup(
     package_dir={'VestaService': 'VestaService'},
     include_package_data=True,
     install_requires=REQUIREMENTS,
+    extras_require=EXTRA_REQUIREMENTS,
     zip_safe=False,
 
     # -- self - tests --------------------------------------------------------
@@ -9,26 +9,44 @@ Test functionality of Service elements.
 from cgi import parse_header, FieldStorage
 from threading import Thread
 import unittest
+import subprocess
 import tempfile
+import hashlib
 import zipfile
+import shutil
 import socket
+import gzip
+import time
 import json
 import sys
 import os
 
 # -- Third-party imports ------------------------------------------------------
+from celery import Celery
 import requests
 
 # --Modules to test -----------------------------------------------------------
 from VestaService import (Document, Message, RemoteAccess,
-                          annotations_dispatcher)
+                          annotations_dispatcher, http_session,
+                          document_cache, annotation_stream, retry,
+                          progress, callback_dispatcher, request,
+                          prefetch, metrics)
 
 from VestaService.service_exceptions import DownloadError
+from VestaService.Report import TaskReport
+
+try:
+    import asyncio
+    from VestaService import async_access
+except (ImportError, SyntaxError):
+    async_access = None
 
 if sys.version_info >= (3, 1):
     from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
 else:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 
 CURRENT_DIR = os.path.dirname(__file__)
 TEST_DOC_DURATION = 19.9375
@@ -53,6 +71,9 @@ class MockServerRequestHandler(BaseHTTPRequestHandler):
         if ctype == "application/json":
             content_len = int(self.headers.get("Content-Length"))
             post_body = self.rfile.read(content_len)
+            if self.headers.get("Content-Encoding") == "gzip":
+                post_body = gzip.decompress(post_body)
+                content_len = len(post_body)
             body = json.loads(post_body.decode('utf-8'))
             if body["data"] is not None:
                 self.send_response(requests.codes.ok)
@@ -96,6 +117,123 @@ class MockServerRequestHandler(BaseHTTPRequestHandler):
                 os.remove(temp_file_path)
 
 
+def make_data(size):
+    """
+    Build a non-uniform payload of a given size.
+    """
+    return (bytes(bytearray(range(256))) * (size // 256 + 1))[:size]
+
+
+class MockStorageRequestHandler(BaseHTTPRequestHandler):
+    """
+    Mock storage server keeping connections alive between requests.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        '''
+        Serve /bytes/<n> with n bytes of data, honoring byte ranges.
+        /flaky/<n> serves the same data but drops the connection half way
+        through full (non-ranged) transfers.
+        '''
+        if self.path.startswith('/storage?filename='):
+            filename = self.path.split('=', 1)[1]
+            body = json.dumps({'upload_url': '{}/upload/{}'.format(
+                                   self.server.url, filename),
+                               'storage_doc_id': filename}).encode('utf-8')
+            self.send_response(requests.codes.ok)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith('/busy/'):
+            # Unavailable for the number of requests given in the path.
+            self.server.busy_count = getattr(self.server, 'busy_count', 0) + 1
+            if self.server.busy_count <= int(self.path.split('/')[-1]):
+                self.send_response(requests.codes.unavailable)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.path = '/bytes/10'
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[0] not in ('bytes', 'flaky'):
+            self.send_response(requests.codes.not_found)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        data = make_data(int(parts[1]))
+        etag = '"{}"'.format(len(data))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(requests.codes.not_modified)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        byte_range = self.headers.get('Range')
+        if byte_range:
+            start, end = byte_range.split('=')[1].split('-')
+            start, end = int(start), int(end or len(data) - 1)
+            self.send_response(requests.codes.partial_content)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(requests.codes.ok)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        if parts[0] == 'flaky' and not byte_range:
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+    def do_PUT(self):
+        '''
+        Store an uploaded document, sent with a Content-Length or chunked.
+        '''
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            data = b''
+            size = int(self.rfile.readline().strip(), 16)
+            while size:
+                data += self.rfile.read(size)
+                self.rfile.readline()
+                size = int(self.rfile.readline().strip(), 16)
+            self.rfile.readline()
+        else:
+            data = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.uploads[self.path.split('/')[-1]] = data
+        self.send_response(requests.codes.ok)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        '''
+        Collect submitted annotations and callbacks.
+        '''
+        body = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])).decode('utf-8'))
+        if self.path.split('?')[0] == '/callback':
+            self.server.callbacks.append(body)
+        else:
+            self.server.annotations.extend(body['data'])
+        self.send_response(requests.codes.ok)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server handling each (kept alive) connection in its own thread.
+    """
+    daemon_threads = True
+
+
 def get_free_port():
     s = socket.socket(socket.AF_INET, type=socket.SOCK_STREAM)
     s.bind(('localhost', 0))
@@ -121,8 +259,23 @@ class TestUtilities(unittest.TestCase):
         self.mock_server_thread.setDaemon(True)
         self.mock_server_thread.start()
 
+        self.storage_port = get_free_port()
+        self.storage_server = ThreadedHTTPServer(
+            ('localhost', self.storage_port), MockStorageRequestHandler)
+        self.storage_thread = Thread(target=self.storage_server.serve_forever)
+        self.storage_thread.setDaemon(True)
+        self.storage_thread.start()
+        self.storage_url = "http://localhost:{}".format(self.storage_port)
+        self.storage_server.url = self.storage_url
+        self.storage_server.uploads = {}
+        self.storage_server.annotations = []
+        self.storage_server.callbacks = []
+
     def tearDown(self):
         self.mock_server.server_close()
+        http_session.reset()
+        self.storage_server.shutdown()
+        self.storage_server.server_close()
 
     def test_document_creation(self):
         """
@@ -165,6 +318,166 @@ class TestUtilities(unittest.TestCase):
         self.assertEqual(os.stat(doc.local_path).st_size, 1024)
         RemoteAccess.cleanup(doc)
 
+    def test_connection_reuse(self):
+        """
+        Check that consecutive downloads from a host share a connection.
+        """
+        http_session.reset()
+        for _ in range(3):
+            doc = RemoteAccess.download(
+                {"url": "{}/bytes/1024".format(self.storage_url)})
+            self.assertEqual(os.stat(doc.local_path).st_size, 1024)
+            RemoteAccess.cleanup(doc)
+        stats = http_session.connection_stats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['reused'], 2)
+
+    def test_document_cache(self):
+        """
+        Check revalidation, reference counting and eviction of cached copies.
+        """
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = document_cache.DocumentCache(cache_dir, max_bytes=3000)
+        doc_msg = {"url": "{}/bytes/1024".format(self.storage_url)}
+
+        doc = RemoteAccess.download(doc_msg, cache=cache)
+        doc_2 = RemoteAccess.download(doc_msg, cache=cache)
+        self.assertEqual(doc.local_path, doc_2.local_path)
+        self.assertEqual(cache.stats(),
+                         {'hits': 1, 'misses': 1, 'evictions': 0})
+
+        # Copy is kept while another task still uses it.
+        RemoteAccess.cleanup(doc)
+        self.assertTrue(os.path.exists(doc_2.local_path))
+        RemoteAccess.cleanup(doc_2)
+
+        doc_3 = RemoteAccess.download(
+            {"url": "{}/bytes/2048".format(self.storage_url)}, cache=cache)
+        self.assertFalse(os.path.exists(doc.local_path))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        RemoteAccess.cleanup(doc_3)
+
+    def test_ranged_download(self):
+        """
+        Check resumption and parallel fetching of byte ranges.
+        """
+        progress = []
+
+        # Interrupted transfer resumes from the last byte written.
+        doc = RemoteAccess.download(
+            {"url": "{}/flaky/100000".format(self.storage_url)},
+            ranged=True, progress_callback=lambda *p: progress.append(p))
+        with open(doc.local_path, 'rb') as doc_file:
+            self.assertEqual(doc_file.read(), make_data(100000))
+        self.assertEqual(progress[-1], (100000, 100000))
+        RemoteAccess.cleanup(doc)
+
+        min_parallel_size = RemoteAccess.MIN_PARALLEL_SIZE
+        RemoteAccess.MIN_PARALLEL_SIZE = 0
+        self.addCleanup(setattr, RemoteAccess, 'MIN_PARALLEL_SIZE',
+                        min_parallel_size)
+        doc = RemoteAccess.download(
+            {"url": "{}/bytes/100001".format(self.storage_url)},
+            ranged=True, nb_parallel=4)
+        with open(doc.local_path, 'rb') as doc_file:
+            self.assertEqual(doc_file.read(), make_data(100001))
+        RemoteAccess.cleanup(doc)
+
+    def test_retry_policy(self):
+        """
+        Check retries on unavailability and the circuit breaker.
+        """
+        retry.reset_breakers()
+        self.addCleanup(retry.reset_breakers)
+        doc = RemoteAccess.download(
+            {"url": "{}/busy/2".format(self.storage_url)})
+        self.assertEqual(os.stat(doc.local_path).st_size, 10)
+        RemoteAccess.cleanup(doc)
+
+        self.storage_server.busy_count = 0
+        breaker = retry.get_breaker(self.storage_url)
+        breaker.failure_threshold = 3
+        with self.assertRaises(DownloadError):
+            RemoteAccess.download(
+                {"url": "{}/busy/100".format(self.storage_url)}, max_try=3)
+        self.assertTrue(breaker.is_open)
+        with self.assertRaises(DownloadError):
+            RemoteAccess.download(
+                {"url": "{}/bytes/10".format(self.storage_url)})
+        self.assertEqual(self.storage_server.busy_count, 3)
+
+        self.assertEqual(retry.parse_retry_after("12"), 12)
+        self.assertEqual(retry.parse_retry_after(
+            "Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        self.assertIsNone(retry.parse_retry_after("soon"))
+
+    def test_upload(self):
+        """
+        Check uploads with a Content-Length, chunked and prefetched targets.
+        """
+        paths = []
+        for size in (1000, 3000):
+            with tempfile.NamedTemporaryFile(delete=False) as doc_file:
+                doc_file.write(make_data(size))
+            self.addCleanup(os.remove, doc_file.name)
+            paths.append(doc_file.name)
+        storage = "{}/storage".format(self.storage_url)
+
+        doc = RemoteAccess.upload(Document.Document(storage, paths[0]))
+        self.assertEqual(doc.url, os.path.basename(paths[0]))
+        self.assertEqual(doc.length, 1000)
+        self.assertTrue(doc.throughput() > 0)
+
+        docs = [Document.Document(storage, path) for path in paths]
+        targets = RemoteAccess.prefetch_upload_urls(docs)
+        for doc, target in zip(docs, targets):
+            RemoteAccess.upload(doc, upload_target=target, chunked=True)
+        for path, size in zip(paths, (1000, 3000)):
+            self.assertEqual(
+                self.storage_server.uploads[os.path.basename(path)],
+                make_data(size))
+
+    @unittest.skipIf(async_access is None, "aiohttp is not installed")
+    def test_async_transfers(self):
+        """
+        Check the asyncio download and annotation submission.
+        """
+        post_url = "http://localhost:{}".format(self.mock_server_port)
+        urls = ["{}/bytes/{}".format(self.storage_url, size)
+                for size in (10, 1024, 4096)]
+
+        async def transfer():
+            try:
+                docs = await asyncio.gather(
+                    *[async_access.download({"url": url}) for url in urls])
+                with self.assertRaises(DownloadError):
+                    await async_access.download(
+                        {"url": "{}/nothing".format(self.storage_url)})
+                uploaded = await async_access.upload(Document.Document(
+                    "{}/storage".format(self.storage_url), docs[0].local_path))
+                statuses = [
+                    (await async_access.submit_annotations(
+                        post_url, iter([{"annotation": "annotation"}]),
+                        compression=compression)).status
+                    for compression in (None, 'zip', 'gzip')]
+            finally:
+                await async_access.close()
+            return docs, uploaded, statuses
+
+        docs, uploaded, statuses = asyncio.run(transfer())
+        self.assertEqual([os.stat(doc.local_path).st_size for doc in docs],
+                         [10, 1024, 4096])
+        self.assertEqual([doc.length for doc in docs], [10, 1024, 4096])
+        self.assertEqual(docs[1].sha256,
+                         hashlib.sha256(make_data(1024)).hexdigest())
+        self.assertEqual(statuses, [200, 200, 200])
+        self.assertEqual(uploaded.url, os.path.basename(docs[0].local_path))
+        self.assertEqual(uploaded.length, 10)
+        for doc in docs:
+            RemoteAccess.cleanup(doc)
+
     def test_submit_annotations(self):
         """
         Check the annotations_dispatcher.submit_annotation function
@@ -190,6 +503,572 @@ class TestUtilities(unittest.TestCase):
         self.assertEqual(zip_resp["Content-Length"],
                          no_zip_resp["Content-Length"])
 
+        # Sending the annotations with a gzip content encoding
+        result = annotations_dispatcher.submit_annotations(
+            post_url, annotations, compression='gzip')
+        self.assertEqual(result.status_code, 200)
+        gzip_resp = json.loads(result.content.decode('utf-8'))
+        self.assertEqual(gzip_resp["Content-Length"],
+                         no_zip_resp["Content-Length"])
+
+    def test_submit_annotations_batches(self):
+        """
+        Check the delivery of annotations by concurrent batches.
+        """
+        post_url = "http://localhost:{}".format(self.storage_port)
+        annotations = [{"annotation": i} for i in range(25)]
+        batches = list(annotations_dispatcher.iter_batches(annotations, 10))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        batches = list(annotations_dispatcher.iter_batches(
+            annotations, batch_bytes=40))
+        self.assertEqual([len(batch) for batch in batches], [2] * 12 + [1])
+
+        task_report = TaskReport(doc_id="doc", tool="annotator")
+        results = annotations_dispatcher.submit_annotations_batches(
+            post_url, iter(annotations), batch_size=10, nb_workers=2,
+            task_report=task_report)
+        self.assertEqual([r.status_code for r in results], [200] * 3)
+        received = sorted(self.storage_server.annotations,
+                          key=lambda a: a["annotation"])
+        self.assertEqual(received, annotations)
+        self.assertEqual(task_report.to_dict()["delivery"],
+                         {"batches": 3, "annotations": 25,
+                          "failed_batches": 0})
+
+        # Annotations encoded to measure the batches are sent as such.
+        batches = list(annotations_dispatcher.iter_batches(
+            annotations, batch_bytes=40, encoded=True))
+        self.assertIsInstance(batches[0][0],
+                              annotations_dispatcher.EncodedAnnotation)
+        self.assertEqual(json.loads(b''.join(
+            annotations_dispatcher.iter_payload(batches[0]))
+            .decode('utf-8')), {'common': {}, 'data': annotations[:2]})
+        self.storage_server.annotations = []
+        annotations_dispatcher.submit_annotations_batches(
+            post_url, iter(annotations), batch_bytes=100, nb_workers=2)
+        self.assertEqual(sorted(self.storage_server.annotations,
+                                key=lambda a: a["annotation"]), annotations)
+
+    def test_annotation_stream(self):
+        """
+        Check the background delivery of pushed annotations.
+        """
+        post_url = "http://localhost:{}".format(self.storage_port)
+        annotations = [{"annotation": i} for i in range(25)]
+        stream = annotation_stream.AnnotationStream(
+            post_url, flush_size=10, flush_interval=0.2, max_pending=1)
+        for annotation in annotations[:-1]:
+            stream.push(annotation)
+        # Buffered annotations are sent once they are old enough.
+        deadline = time.time() + 5
+        while len(self.storage_server.annotations) < 24 and \
+                time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.storage_server.annotations, annotations[:-1])
+        stream.push(annotations[-1])
+        stream.close()
+        self.assertEqual(self.storage_server.annotations, annotations)
+        self.assertEqual(stream.nb_annotations, 25)
+
+        # Old buffered annotations are queued while batches are being sent.
+        class SlowStream(annotation_stream.AnnotationStream):
+            def _send(self, batch):
+                time.sleep(0.1)
+                sent.append((time.time(), batch))
+
+        sent = []
+        stream = SlowStream(post_url, flush_size=2, flush_interval=0.4,
+                            max_pending=100)
+        for annotation in annotations[:21]:
+            stream.push(annotation)
+        deadline = time.time() + 5
+        while len(sent) < 11 and time.time() < deadline:
+            time.sleep(0.05)
+        stream.close()
+        self.assertEqual([a for _, batch in sent for a in batch],
+                         annotations[:21])
+        # Sent right after the last full batch, without waiting for the
+        # queue to be idle.
+        self.assertTrue(sent[10][0] - sent[9][0] < 0.15)
+
+    def test_iter_payload(self):
+        """
+        Check the incremental encoding of annotations given as an iterator.
+        """
+        annotations = [{"annotation": i, "text": u"«{}»".format(i)}
+                       for i in range(50000)]
+        chunks = list(annotations_dispatcher.iter_payload(iter(annotations)))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')),
+                         {'common': {}, 'data': annotations})
+        self.assertEqual(json.loads(b''.join(
+            annotations_dispatcher.iter_payload([])).decode('utf-8')),
+            {'common': {}, 'data': []})
+
+    def test_progress_publisher(self):
+        """
+        Check the rate limiting and coalescing of progress updates.
+        """
+        class TaskHandler(object):
+            request = None
+
+            def __init__(self):
+                self.states = []
+
+            def update_state(self, state, meta):
+                time.sleep(0.01)
+                self.states.append((state, meta['current']))
+
+        task_handler = TaskHandler()
+        publisher = progress.ProgressPublisher(task_handler, min_interval=0.1,
+                                               min_delta=5)
+        publisher.publish(0, {'current': 0})
+        # Changes smaller than min_delta are dropped.
+        publisher.flush()
+        publisher.publish(2, {'current': 2})
+        start = time.time()
+        for value in range(3, 101):
+            publisher.publish(value, {'current': value})
+            time.sleep(0.002)
+        # Publishing never waits for the backend.
+        self.assertTrue(time.time() - start < 1)
+        publisher.close()
+        values = [value for _, value in task_handler.states]
+        self.assertEqual(values[0], 0)
+        self.assertEqual(values[-1], 100)
+        self.assertEqual(values, sorted(values))
+        self.assertTrue(len(values) < 20)
+        self.assertEqual(publisher.nb_sent, len(values))
+        self.assertEqual(publisher.nb_sent + publisher.nb_suppressed, 100)
+
+    def test_callback_dispatcher(self):
+        """
+        Check the background delivery of callbacks, batched by URL.
+        """
+        url = "http://localhost:{}/callback".format(self.storage_port)
+        dispatcher = callback_dispatcher.CallbackDispatcher(
+            batch_size=3, batch_interval=0.2)
+        for i in range(4):
+            self.assertTrue(dispatcher.send(url, {'uuid': str(i)}))
+        deadline = time.time() + 5
+        while len(self.storage_server.callbacks) < 2 and \
+                time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.storage_server.callbacks,
+                         [[{'uuid': '0'}, {'uuid': '1'}, {'uuid': '2'}],
+                          [{'uuid': '3'}]])
+        self.assertEqual(dispatcher.latency.count, 4)
+
+        # Failed callbacks are counted, not raised.
+        unreachable = "http://localhost:{}/callback".format(get_free_port())
+        dispatcher.retry_policy = retry.RetryPolicy(max_try=1,
+                                                    circuit_breaker=False)
+        dispatcher.send(unreachable, {'uuid': '4'})
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual((dispatcher.nb_sent, dispatcher.nb_failed), (4, 1))
+
+        # Receivers retried for a while do not delay the others.
+        dispatcher.retry_policy = retry.RetryPolicy(
+            max_try=3, backoff_factor=1., jitter=False,
+            circuit_breaker=False)
+        dispatcher.batch_size = 1
+        dispatcher.send(unreachable, {'uuid': '5'})
+        dispatcher.send(url, {'uuid': '6'})
+        deadline = time.time() + 1
+        while len(self.storage_server.callbacks) < 3 and \
+                time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.storage_server.callbacks[-1], {'uuid': '6'})
+        self.assertEqual(dispatcher.nb_failed, 1)
+        self.assertTrue(dispatcher.flush(10))
+        dispatcher.close()
+        self.assertEqual((dispatcher.nb_sent, dispatcher.nb_failed), (5, 2))
+        self.assertFalse(dispatcher.send(url, {'uuid': '7'}))
+
+    def test_callback_routing(self):
+        """
+        Check that concurrent tasks notify their own callback URL.
+        """
+        url = "http://localhost:{}/callback".format(self.storage_port)
+
+        class Context(object):
+            def __init__(self, task_id, **headers):
+                self.id = task_id
+                self.headers = headers
+
+        class TaskHandler(object):
+            def __init__(self, task_id, **headers):
+                self.request = Context(task_id, **headers)
+
+        def make_request(task_id, callback_url):
+            body = Message.request_message_factory()
+            body['service']['misc'] = {'callback_url': callback_url}
+            return request.Request(body, TaskHandler(task_id),
+                                   download=False)
+
+        # Both requests are in progress before any completes.
+        make_request('task-1', url + '?1')
+        make_request('task-2', None)
+        make_request('task-3', url)
+        for task_id in ('task-3', 'task-2', 'task-1'):
+            request.postrun_handler(task_id, 'SUCCESS',
+                                    task=TaskHandler(task_id))
+        request.postrun_handler('task-4', 'FAILURE',
+                                task=TaskHandler('task-4', callback_url=url))
+        callback_dispatcher.get_dispatcher().flush(5)
+        # Distinct URLs are posted concurrently.
+        self.assertEqual(sorted(self.storage_server.callbacks,
+                                key=lambda payload: payload['uuid']),
+                         [{'uuid': 'task-1', 'status': 'SUCCESS'},
+                          {'uuid': 'task-3', 'status': 'SUCCESS'},
+                          {'uuid': 'task-4', 'status': 'FAILURE'}])
+
+    def test_late_progress(self):
+        """
+        Check that a late progress update does not replace the final state of
+        a task whose request was not closed.
+        """
+        app = Celery('worker', broker='memory://', backend='cache+memory://')
+
+        @app.task(bind=True)
+        def transcription(self):
+            pass
+
+        transcription.push_request(id='task-late')
+        try:
+            body = Message.request_message_factory()
+            req = request.Request(body, transcription, download=False)
+            error = ValueError('oops')
+            app.backend.mark_as_failure('task-late', error)
+            req.set_progress(50)
+            req.flush_progress()
+            self.assertEqual(app.backend.get_state('task-late'), 'PROGRESS')
+            request.postrun_handler('task-late', 'FAILURE', task=transcription,
+                                    retval=error)
+        finally:
+            transcription.pop_request()
+        self.assertEqual(app.backend.get_state('task-late'), 'FAILURE')
+        self.assertIsInstance(app.backend.get_result('task-late'),
+                              ValueError)
+        req.close()
+
+    def test_request_lifetime(self):
+        """
+        Check the deterministic cleanup of requests and the sweeping of the
+        local copies of dead processes.
+        """
+        body = Message.request_message_factory()
+        body['service']['document']['url'] = \
+            "http://localhost:{}/bytes/10".format(self.storage_port)
+
+        @request.with_request()
+        def process(req, suffix):
+            self.assertTrue(os.path.basename(
+                req.document.local_path).startswith(
+                    RemoteAccess.temp_prefix()))
+            return req.document.local_path + suffix
+
+        path = process(None, body, '')
+        self.assertFalse(os.path.exists(path))
+
+        with request.Request(body, None) as req:
+            stream = req.open_annotation_stream()
+            path = req.document.local_path
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(stream.closed)
+        req.close()
+
+        # The durations of the stages are recorded in the task report.
+        body['annotation_service']['url'] = "http://localhost:{}".format(
+            self.mock_server_port)
+        task_report = TaskReport(doc_id="doc", tool="tool")
+        with request.Request(body, None, task_report=task_report) as req:
+            req.store_annotations([{"annotation": "annotation"}])
+        self.assertEqual(sorted(task_report.timings),
+                         ['download', 'processing', 'queue_wait', 'upload'])
+        self.assertTrue(all(duration >= 0
+                            for duration in task_report.timings.values()))
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+            dead.wait()
+            prefix = 'vesta-{}-'.format(RemoteAccess.host_token())
+            names = [prefix + '{}-a.wav'.format(dead.pid),
+                     RemoteAccess.temp_prefix() + 'b.wav',
+                     'vesta-otherhost-{}-c.wav'.format(dead.pid),
+                     'other.wav']
+            for name in names:
+                path = os.path.join(tmp_dir, name)
+                open(path, 'w').close()
+                os.utime(path, (time.time() - 3600,) * 2)
+            # Recent copies are kept.
+            open(os.path.join(tmp_dir, prefix + '{}-d.wav'.format(dead.pid)),
+                 'w').close()
+            self.assertEqual(RemoteAccess.sweep_orphans([tmp_dir]), 1)
+            self.assertEqual(sorted(os.listdir(tmp_dir)),
+                             sorted(names[1:] + [prefix + '{}-d.wav'.format(
+                                 dead.pid)]))
+            # Copies of live processes are kept whatever their age, like a
+            # hard link to an old file.
+            self.assertEqual(RemoteAccess.sweep_orphans([tmp_dir]), 0)
+            source = os.path.join(tmp_dir, 'source.wav')
+            open(source, 'w').close()
+            os.utime(source, (time.time() - 3 * 24 * 3600,) * 2)
+            RemoteAccess.LINK_DIR = tmp_dir
+            try:
+                doc = RemoteAccess.link_local('file://' + source, source,
+                                              link='hardlink')
+            finally:
+                RemoteAccess.LINK_DIR = None
+            self.assertEqual(os.path.dirname(doc.local_path), tmp_dir)
+            self.assertEqual(RemoteAccess.sweep_orphans([tmp_dir]), 0)
+            self.assertTrue(os.path.exists(doc.local_path))
+            RemoteAccess.cleanup(doc)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_prefetch(self):
+        """
+        Check the hand-off of prefetched documents and the disk budget.
+        """
+        url = "http://localhost:{}/bytes/1000".format(self.storage_port)
+        with self.assertLogs('VestaService.prefetch', 'WARNING'):
+            prefetcher = prefetch.enable(disk_budget=500)
+        try:
+            self.assertTrue(prefetcher.prefetch('task-1', {'url': url}))
+            doc = prefetcher.claim('task-1')
+            self.assertEqual(os.path.getsize(doc.local_path), 1000)
+            RemoteAccess.cleanup(doc)
+
+            self.assertTrue(prefetcher.prefetch('task-2', {'url': url}))
+            deadline = time.time() + 5
+            while prefetcher.nb_prefetched < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(prefetcher.disk_usage, 1000)
+            # The budget is used until the document is claimed.
+            self.assertFalse(prefetcher.prefetch('task-3', {'url': url}))
+            self.assertIsNone(prefetcher.claim('task-3'))
+
+            class TaskHandler(object):
+                class request(object):
+                    id = 'task-2'
+            body = Message.request_message_factory()
+            body['service']['document']['url'] = url
+            with request.Request(body, TaskHandler()) as req:
+                path = req.document.local_path
+                self.assertTrue(os.path.exists(path))
+                # The request used the prefetched document.
+                self.assertEqual((prefetcher.nb_claimed,
+                                  prefetcher.nb_prefetched), (2, 2))
+            self.assertFalse(os.path.exists(path))
+            self.assertIsNone(prefetcher.claim('task-2'))
+
+            # A discarded document frees the budget and cannot be claimed.
+            self.assertTrue(prefetcher.prefetch('task-4', {'url': url}))
+            prefetcher.discard('task-4')
+            self.assertIsNone(prefetcher.claim('task-4'))
+            self.assertTrue(prefetcher.prefetch('task-5', {'url': url}))
+            prefetcher.discard('task-5')
+            self.assertEqual((prefetcher.nb_claimed, prefetcher.nb_skipped,
+                              prefetcher.disk_usage), (2, 1, 0))
+
+            # Messages of older Celery versions only expose their payload.
+            class Received(object):
+                def __init__(self, payload):
+                    self._payload = payload
+            body = Message.request_message_factory()
+            body['service']['document']['url'] = url
+            for payload in (((body,), {}, {}), {'args': [body]}):
+                self.assertEqual(
+                    prefetch._document_message(Received(payload)),
+                    body['service']['document'])
+            for payload in ({'kwargs': {}}, ((), {}, {})):
+                self.assertIsNone(
+                    prefetch._document_message(Received(payload)))
+        finally:
+            prefetch.disable()
+
+    def test_scheme_handlers(self):
+        """
+        Check that local and shared documents are not copied.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'doc.wav')
+            with open(path, 'wb') as file_handle:
+                file_handle.write(make_data(1000))
+            url = 'file://' + path
+
+            # Files outside of the local directories are never read.
+            self.assertRaises(DownloadError, RemoteAccess.download,
+                              {'url': url})
+            RemoteAccess.register_local_dir(tmp_dir)
+            self.assertRaises(DownloadError, RemoteAccess.download,
+                              {'url': 'file://' + tmp_dir + '/../etc/passwd'})
+            doc = RemoteAccess.download({'url': url})
+            self.assertEqual((doc.local_path, doc.owned, doc.length),
+                             (path, False, 1000))
+            view = doc.mmap()
+            self.assertEqual(view[:], make_data(1000))
+            view.close()
+            RemoteAccess.cleanup(doc)
+            self.assertTrue(os.path.exists(path))
+
+            for link in ('hardlink', 'reflink'):
+                doc = RemoteAccess.link_local(url, path, link=link)
+                with open(doc.local_path, 'rb') as file_handle:
+                    self.assertEqual(file_handle.read(), make_data(1000))
+                RemoteAccess.cleanup(doc)
+                self.assertTrue(os.path.exists(path))
+
+            shared_url = "http://localhost:{}/shared/".format(
+                self.storage_port)
+            RemoteAccess.register_mount(shared_url, tmp_dir)
+            try:
+                doc = RemoteAccess.download({'url': shared_url + 'doc.wav'})
+                self.assertEqual(doc.local_path, path)
+                # Files outside of the mount are never read.
+                for escape in ('%2Fetc%2Fpasswd', '..%2F..%2Fetc%2Fhostname',
+                               'sub/../../doc.wav'):
+                    self.assertRaises(DownloadError, RemoteAccess.download,
+                                      {'url': shared_url + escape})
+            finally:
+                del RemoteAccess.SHARED_MOUNTS[shared_url]
+
+            RemoteAccess.register_scheme(
+                'test', lambda doc_msg, **options: Document.Document(
+                    url=doc_msg['url'], path=path))
+            try:
+                doc = RemoteAccess.download({'url': 'test://doc.wav'})
+                self.assertEqual(doc.local_path, path)
+            finally:
+                del RemoteAccess.SCHEME_HANDLERS['test']
+            self.assertRaises(DownloadError, RemoteAccess.download,
+                              {'url': 'test://doc.wav'})
+            self.assertRaises(DownloadError, RemoteAccess.download,
+                              {'url': url + '.missing'})
+        finally:
+            RemoteAccess.LOCAL_DIRS.remove(tmp_dir)
+            shutil.rmtree(tmp_dir)
+
+    def test_document_content(self):
+        """
+        Check in-memory documents, content views and digests.
+        """
+        base_url = "http://localhost:{}/bytes/".format(self.storage_port)
+        doc = RemoteAccess.download({'url': base_url + '1000'},
+                                    in_memory_max=2000)
+        self.assertTrue(doc.in_memory)
+        self.assertIsNone(doc.local_path)
+        self.assertEqual(doc.view(), make_data(1000))
+        self.assertEqual(doc.open().read(), make_data(1000))
+        self.assertEqual(doc.length, 1000)
+        self.assertEqual(doc.sha256,
+                         hashlib.sha256(make_data(1000)).hexdigest())
+        path = doc.to_file()
+        with open(path, 'rb') as file_handle:
+            self.assertEqual(file_handle.read(), make_data(1000))
+        # The content is no longer held in memory.
+        self.assertIsNone(doc.data)
+        view = doc.view()
+        self.assertEqual(view.tobytes(), make_data(1000))
+        view.release()
+        doc.close()
+        RemoteAccess.cleanup(doc)
+        self.assertFalse(os.path.exists(path))
+
+        doc = RemoteAccess.download({'url': base_url + '5000'},
+                                    in_memory_max=2000)
+        self.assertFalse(doc.in_memory)
+        view = doc.view()
+        self.assertEqual(view.tobytes(), make_data(5000))
+        self.assertEqual(doc.sha256,
+                         hashlib.sha256(make_data(5000)).hexdigest())
+        view.release()
+        RemoteAccess.cleanup(doc)
+        self.assertFalse(os.path.exists(doc.local_path))
+
+        # Documents kept in memory are uploaded from memory.
+        doc = Document.Document("{}/storage".format(self.storage_url))
+        doc.data = make_data(1000)
+        RemoteAccess.upload(doc)
+        self.assertEqual(doc.length, 1000)
+        self.assertEqual(self.storage_server.uploads[doc.url],
+                         make_data(1000))
+
+        # Requests of services which did not opt in have a local path.
+        body = Message.request_message_factory()
+        body['service']['document']['url'] = base_url + '1000'
+        options = {'in_memory_max': 2000}
+        with request.Request(body, None, download_options=options) as req:
+            with open(req.document.local_path, 'rb') as file_handle:
+                self.assertEqual(file_handle.read(), make_data(1000))
+        with request.Request(body, None, download_options=options,
+                             in_memory=True) as req:
+            self.assertTrue(req.document.in_memory)
+
+    def test_metrics(self):
+        """
+        Check the instrumentation of downloads and the metrics endpoint.
+        """
+        class Sink(object):
+            def __init__(self):
+                self.records = []
+
+            def record(self, kind, name, value, labels):
+                self.records.append((kind, name, value, labels))
+
+        retry.reset_breakers()
+        metrics.reset()
+        sink = Sink()
+        metrics.add_sink(sink)
+        metrics.set_service_type('transcription')
+        self.addCleanup(metrics.reset)
+        self.addCleanup(metrics.set_service_type, None)
+        self.addCleanup(metrics.remove_sink, sink)
+        doc = RemoteAccess.download(
+            {"url": "{}/busy/2".format(self.storage_url)})
+        RemoteAccess.cleanup(doc)
+        self.assertIn((metrics.COUNTER, metrics.BYTES, 10,
+                       {'service_type': 'transcription',
+                        'direction': 'download'}), sink.records)
+
+        server = metrics.start_http_server(port=0, addr='localhost')
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        res = requests.get("http://localhost:{}/metrics".format(
+            server.server_address[1]))
+        self.assertEqual(res.status_code, 200)
+        lines = res.text.splitlines()
+        self.assertIn('vesta_retries_total{reason="status",'
+                      'service_type="transcription"} 2', lines)
+        self.assertIn('vesta_transferred_bytes_total{direction="download",'
+                      'service_type="transcription"} 10', lines)
+        self.assertIn('vesta_stage_duration_seconds_count{service_type='
+                      '"transcription",stage="download"} 1', lines)
+        self.assertIn('vesta_stage_duration_seconds_bucket{service_type='
+                      '"transcription",stage="download",le="+Inf"} 1', lines)
+        self.assertIn('# TYPE vesta_stage_duration_seconds histogram', lines)
+
+        # Completed tasks are counted with the service type of their request,
+        # which no longer labels the metrics of the thread once closed.
+        class Context(object):
+            id = 'task-metrics'
+
+        class TaskHandler(object):
+            name = 'worker.other_name'
+            request = Context()
+
+        body = Message.request_message_factory()
+        body['service']['type'] = 'diarization'
+        with request.Request(body, TaskHandler(), download=False):
+            self.assertEqual(metrics.get_service_type(), 'diarization')
+        self.assertIsNone(metrics.get_service_type())
+        request.postrun_handler('task-metrics', 'SUCCESS', task=TaskHandler())
+        self.assertIn('vesta_tasks_total{service_type="diarization",'
+                      'state="SUCCESS"} 1', metrics.render().splitlines())
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,10 +2,14 @@
 
 # -- standard library ---------------------------------------------------------
 import json
+import io
+import os
+import tempfile
 import unittest
 
 # --Modules to test -----------------------------------------------------------
-from VestaService.Report import WorkerReport, TaskReport
+from VestaService.Report import (WorkerReport, TaskReport,
+                                  WorkerReportEncoder, DOWNLOAD, PROCESSING)
 
 
 class UtilsTests(unittest.TestCase):
@@ -66,8 +70,132 @@ class UtilsTests(unittest.TestCase):
         attended_wrjson_str = ('{"nb_success": 1, "nb_ignores": 0, '
                                '"nb_failures": 1, "completion_ratio" : 1.0, '
                                '"nb_tasks" : 2, "status" : "success",'
-                               '"full_report_url":"http://mss:1234"'
+                               '"full_report_url":"http://mss:1234",'
+                               '"aggregates": {'
+                               '"failures_per_code": {"444": 1},'
+                               '"latencies": {}}'
                                '}')
-        wrjson = wr.abbreviated_json("http://mss:1234")
-        self.assertEqual(json.JSONDecoder().decode(wrjson),
+        wrjson = json.JSONDecoder().decode(
+            wr.abbreviated_json("http://mss:1234"))
+        throughput = wrjson["aggregates"].pop("throughput")
+        self.assertEqual(sum(period["tasks"] for period in throughput), 2)
+        self.assertEqual(wrjson,
                          json.JSONDecoder().decode(attended_wrjson_str))
+
+    def test_WorkerReport_columns(self):
+        wr = WorkerReport(nb_tasks=3)
+        for i in range(3):
+            tr = TaskReport(doc_id="doc{}".format(i), tool="screwdriver")
+            if i == 1:
+                tr.set_failed(code=444, message="Missing")
+            else:
+                tr.set_succeeded()
+            wr.update(tr)
+        # Later changes of a task report do not alter the worker report.
+        tr.set_failed(code=500, message="Late")
+        self.assertEqual(len(wr.detail), 3)
+        self.assertEqual(wr.detail.steps, ["screwdriver"])
+        self.assertEqual(wr.detail[1].code, 444)
+        self.assertEqual(wr.detail[-1].status.name, "Success")
+        self.assertEqual([t.doc_id for t in wr.detail],
+                         ["doc0", "doc1", "doc2"])
+        self.assertFalse(hasattr(tr, "__dict__"))
+
+    def test_WorkerReport_stream(self):
+        wr = WorkerReport(nb_tasks=5)
+        for i in range(5):
+            tr = TaskReport(doc_id="doc{}".format(i), tool="screwdriver")
+            tr.set_succeeded()
+            wr.update(tr)
+        chunks = list(wr.iter_json(chunk_size=2))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(json.loads("".join(chunks)), json.loads(wr.to_json()))
+        fp = io.StringIO()
+        json.dump(wr, fp, cls=WorkerReportEncoder)
+        self.assertEqual(json.loads(fp.getvalue()), json.loads(wr.to_json()))
+
+        fp = io.StringIO()
+        written = wr.dump_ndjson(fp)
+        tr = TaskReport(doc_id="doc5", tool="screwdriver")
+        tr.set_failed(code=444, message="Missing")
+        wr.update(tr)
+        self.assertEqual(wr.dump_ndjson(fp, start=written), 6)
+        lines = fp.getvalue().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(json.loads(lines[-1])["code"], 444)
+
+    def test_WorkerReport_checkpoint(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            wr = WorkerReport(nb_tasks=4)
+            wr.set_processing()
+            for i in range(3):
+                tr = TaskReport(doc_id="doc{}".format(i), tool="screwdriver")
+                if i == 2:
+                    tr.set_failed(code=444, message="Missing")
+                else:
+                    tr.set_succeeded()
+                wr.update(tr)
+                if i == 0:
+                    wr.checkpoint(path)
+                    delta = json.loads(wr.delta_json())
+                    self.assertEqual(delta["first_task"], 0)
+                    self.assertEqual(len(delta["detail"]), 1)
+            # Tasks completed an hour ago.
+            wr.throughput.periods[0][0] -= 3600
+            wr.checkpoint(path)
+            delta = json.loads(wr.delta_json())
+            self.assertEqual(delta["first_task"], 1)
+            self.assertEqual([t["doc_id"] for t in delta["detail"]],
+                             ["doc1", "doc2"])
+
+            # An interrupted write is dropped on resume.
+            with open(path, "a") as fp:
+                fp.write('{"doc_id": "doc3", "st')
+            resumed = WorkerReport.resume(path)
+            self.assertEqual(json.loads(resumed.to_json()),
+                             json.loads(wr.to_json()))
+            self.assertEqual(resumed.nb_failures, 1)
+            self.assertEqual(resumed.nb_published, 1)
+            # Replayed tasks keep the throughput of their completion.
+            self.assertEqual(resumed.throughput.to_list(),
+                             wr.throughput.to_list())
+            tr = TaskReport(doc_id="doc3", tool="screwdriver")
+            tr.set_succeeded()
+            resumed.update(tr)
+            resumed.checkpoint(path)
+            self.assertEqual(len(WorkerReport.resume(path).detail), 4)
+        finally:
+            os.remove(path)
+
+    def test_WorkerReport_aggregates(self):
+        wr = WorkerReport(nb_tasks=100)
+        for i in range(100):
+            tr = TaskReport(doc_id="doc{}".format(i), tool="screwdriver")
+            tr.set_timing(PROCESSING, (i + 1) / 100.)
+            if i % 10 == 0:
+                tr.set_failed(code=500 if i else 444, message="Failed")
+            else:
+                tr.set_timing(DOWNLOAD, 0.2)
+                tr.set_succeeded()
+            wr.update(tr)
+        aggregates = wr.aggregates()
+        self.assertEqual(aggregates["failures_per_code"],
+                         {"444": 1, "500": 9})
+        processing = aggregates["latencies"]["screwdriver"][PROCESSING]
+        self.assertEqual(processing["count"], 100)
+        self.assertAlmostEqual(processing["mean"], 0.505)
+        self.assertEqual(processing["max"], 1.)
+        self.assertTrue(0.4 <= processing["p50"] <= 0.6)
+        self.assertTrue(0.85 <= processing["p90"] <= 1.)
+        download = aggregates["latencies"]["screwdriver"][DOWNLOAD]
+        self.assertEqual(download["count"], 90)
+        self.assertTrue(0.1 < download["p99"] <= 0.2)
+
+        # Timings are kept in the detail.
+        self.assertEqual(wr.detail[0].timings, {PROCESSING: 0.01})
+        self.assertEqual(wr.detail[1].to_dict()["timings"],
+                         {PROCESSING: 0.02, DOWNLOAD: 0.2})
+        self.assertEqual(json.loads(wr.to_json())["detail"][1]["timings"],
+                         {PROCESSING: 0.02, DOWNLOAD: 0.2})
@@ -0,0 +1,123 @@
+# coding:utf-8
+
+# -- standard library ---------------------------------------------------------
+from collections import defaultdict
+import unittest
+
+# -- Third-party imports ------------------------------------------------------
+from celery import Celery
+
+# --Modules to test -----------------------------------------------------------
+from VestaService import request_process_mesg
+from VestaService.service_exceptions import PublishError
+
+
+class RequestProcessMesgTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Celery('worker', broker='memory://',
+                          backend='cache+memory://')
+
+    def test_send_task_requests(self):
+        items = [("http://host/doc_{}.wav".format(i), {"i": i}, None)
+                 for i in range(7)]
+        stats = request_process_mesg.PublishStats()
+        results = request_process_mesg.send_task_requests(
+            items, 'transcription', self.app, 'queue', batch_size=3,
+            stats=stats)
+        # Nothing is published before results are consumed.
+        self.assertEqual(stats.nb_messages, 0)
+        results = list(results)
+        self.assertEqual(len(set(r.id for r in results)), 7)
+        self.assertEqual(stats.nb_messages, 7)
+        self.assertEqual(stats.nb_batches, 3)
+        self.assertTrue(stats.rate() > 0)
+
+        with self.app.connection_for_read() as connection:
+            queue = connection.SimpleQueue('queue')
+            message = queue.get(timeout=1)
+            msg = message.payload[0][0]
+            queue.close()
+        self.assertEqual(msg['service']['document']['url'],
+                         "http://host/doc_0.wav")
+        self.assertEqual(msg['service']['type'], 'transcription')
+        self.assertEqual(message.headers['task'], 'worker.transcription')
+
+    def test_batch_confirms(self):
+        class Channel(object):
+            def __init__(self):
+                # Like py-amqp, no event has a callback yet.
+                self.events = defaultdict(set)
+
+            def confirm_select(self):
+                pass
+
+        class Connection(object):
+            def __init__(self, channel):
+                self.channel = channel
+                self.replies = []
+
+            def drain_events(self, timeout=None):
+                kind, tag, multiple = self.replies.pop(0)
+                for callback in self.channel.events[kind]:
+                    callback(tag, multiple)
+
+        connection = Connection(Channel())
+        confirms = request_process_mesg._BatchConfirms.create(
+            connection, connection.channel)
+        self.assertIsNotNone(confirms)
+        self.assertEqual(len(connection.channel.events['basic_ack']), 1)
+        # Confirms are awaited once for the whole batch, in any order.
+        connection.replies = [('basic_ack', 2, False), ('basic_ack', 1, False),
+                              ('basic_ack', 3, False)]
+        confirms.wait(3, 1)
+        connection.replies = [('basic_ack', 6, True)]
+        confirms.wait(3, 1)
+        connection.replies = [('basic_nack', 7, False)]
+        self.assertRaises(PublishError, confirms.wait, 1, 1)
+        self.assertIsNone(request_process_mesg._BatchConfirms.create(
+            connection, object()))
+
+    def test_get_requests_info(self):
+        request_process_mesg.clear_status_cache()
+        backend = self.app.backend
+        backend.mark_as_done('done', {'annotations': []})
+        backend.mark_as_started('started')
+        backend.mark_as_failure('failed', ValueError('oops'))
+        backend.mark_as_retry('retried', IOError('again'))
+
+        uuids = ['done', 'started', 'failed', 'retried', 'unknown']
+        infos = request_process_mesg.get_requests_info(uuids, self.app,
+                                                       batch_size=2)
+        self.assertEqual(sorted(infos), sorted(uuids))
+        self.assertEqual(infos['done']['status'], 'SUCCESS')
+        self.assertEqual(infos['done']['result'], {'annotations': []})
+        self.assertEqual(infos['started']['status'], 'STARTED')
+        self.assertIsNone(infos['started']['result'])
+        self.assertEqual(infos['unknown']['status'], 'PENDING')
+        for uuid, status in (('failed', 'FAILURE'), ('retried', 'RETRY')):
+            error = infos[uuid]['error']
+            self.assertEqual(infos[uuid]['status'], status)
+            self.assertIsInstance(error,
+                                  request_process_mesg.WorkerExceptionWrapper)
+            self.assertEqual(error.task_uuid, uuid)
+        self.assertIsInstance(infos['failed']['error'].worker_exception,
+                              ValueError)
+
+        # Repeated polls are answered from the cache.
+        backend.mark_as_done('unknown', 42)
+        infos = request_process_mesg.get_requests_info(['unknown'], self.app)
+        self.assertEqual(infos['unknown']['status'], 'PENDING')
+        infos = request_process_mesg.get_requests_info(['unknown'], self.app,
+                                                       cache_ttl=0)
+        self.assertEqual(infos['unknown']['result'], 42)
+
+        # Callers changing the information do not change the cache.
+        for _ in range(2):
+            info = request_process_mesg.get_requests_info(['done'],
+                                                          self.app)['done']
+            self.assertEqual((info['status'], info['result']),
+                             ('SUCCESS', {'annotations': []}))
+            info['status'] = 'CHANGED'
+            info['result']['annotations'].append('changed')
+        request_process_mesg.clear_status_cache()
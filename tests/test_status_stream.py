@@ -0,0 +1,58 @@
+# coding:utf-8
+
+# -- standard library ---------------------------------------------------------
+import unittest
+import asyncio
+
+# -- Third-party imports ------------------------------------------------------
+from celery import Celery
+
+# --Modules to test -----------------------------------------------------------
+from VestaService import status_stream
+
+
+class StatusStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Celery('worker', broker='memory://',
+                          backend='cache+memory://')
+
+    def test_status_stream(self):
+        stream = status_stream.StatusStream(self.app, uuids=['a', 'b'])
+        self.assertTrue(stream.wait_ready(5))
+        with self.app.events.default_dispatcher(hostname='worker') as disp:
+            disp.send('task-received', uuid='a', name='worker.transcription')
+            disp.send('task-received', uuid='other', name='worker.other')
+            disp.send('task-progress', uuid='a', current=50, total=100,
+                      service_type='transcription')
+            disp.send('task-succeeded', uuid='a', result='{}')
+            disp.send('task-failed', uuid='b', exception='ValueError()')
+        updates = list(stream)
+        stream.close()
+        self.assertEqual([(u['uuid'], u['status']) for u in updates],
+                         [('a', 'RECEIVED'), ('a', 'PROGRESS'),
+                          ('a', 'SUCCESS'), ('b', 'FAILURE')])
+        self.assertEqual(updates[1]['progress'],
+                         {'current': 50, 'total': 100})
+        self.assertEqual(updates[2]['type'], 'worker.transcription')
+        self.assertEqual(updates[3]['exception'], 'ValueError()')
+
+        # Follow by task type, asynchronously.
+        stream = status_stream.StatusStream(self.app,
+                                            task_types=['transcription'])
+        self.assertTrue(stream.wait_ready(5))
+        with self.app.events.default_dispatcher(hostname='worker') as disp:
+            disp.send('task-received', uuid='c', name='worker.transcription')
+            disp.send('task-received', uuid='d', name='worker.other')
+            disp.send('task-started', uuid='d')
+            disp.send('task-started', uuid='c')
+
+        async def follow():
+            updates = []
+            async for update in stream:
+                updates.append((update['uuid'], update['status']))
+                if len(updates) == 2:
+                    stream.close()
+            return updates
+        self.assertEqual(asyncio.run(follow()),
+                         [('c', 'RECEIVED'), ('c', 'STARTED')])